@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Benchmark of MPR stages with synthetic data
+#
+# e.g.,
+#   python benchmarks/bench_mpr.py --ny 2000 --nx 3000 --nhru 20000 --output bench.json
+#   python benchmarks/bench_mpr.py --ny 2000 --nx 3000 --nhru 20000 --baseline bench.json   # check regression
+#   python benchmarks/bench_mpr.py --validate-precision   # deviation of float32 storage from float64 run
+#
+# each record has stage name, wall time [s], throughput and peak RSS [MB] of process so far (process_peak_rss_mb,
+# cumulative over the preceding stages, so it grows only when a stage exceeds the peak of all the earlier stages).
+# exit status is 1 if any stage is slower than baseline by more than tolerance and by more than min-diff,
+# so that timer noise of sub-millisecond stages is not reported.
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+import xarray as xr
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mpr.IO import load_geophysical_attributes, load_mapping_data, process_mapping_data, write_param
+from mpr.scaling import comp_remap_operator, horizontal_weighted_mean, vertical_weighted_mean
+from mpr.model_layer import comp_layer_weight
+from mpr.transfer_function import transfer_function
+from mpr.pipeline import run_mpr
+from mpr.precision import validate_precision
+from synthetic import make_attributes, make_mapping
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config')
+
+RECORDS = []
+
+
+@contextmanager
+def timed(stage, size=None, unit=None):
+    start = time.perf_counter()
+    yield
+    wall = time.perf_counter() - start
+    RECORDS.append({'stage': stage, 'wall': wall,
+                    'throughput': size/wall if size and wall > 0 else None, 'unit': unit,
+                    'process_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.})
+    print(f'  {stage:40s} {wall:10.4f} s', flush=True)
+
+
+def run(args):
+    with open(os.path.join(CONFIG_DIR, 'IO.yml')) as f:
+        io_cfg = yaml.safe_load(f)
+    with open(os.path.join(CONFIG_DIR, 'param_meta.yml')) as f:
+        cfg = yaml.safe_load(f)
+    with open(os.path.join(CONFIG_DIR, 'tf_coef.yml')) as f:
+        tf_coef = yaml.safe_load(f)
+    param_meta = cfg['param']
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='mpr_bench_')
+    io_cfg['INPUT'] = {'DIRE': workdir, 'MAP_FILE': 'spatialweights.nc'}
+    io_cfg['OUTPUT'] = {'DIRE': workdir, 'PARAM_FILE_NAME': 'param.nc'}
+    io_cfg.pop('CACHE', None)
+
+    nCell = args.ny*args.nx
+    print(f'\n Synthetic data in {workdir}: {args.ny} x {args.nx} grid', flush=True)
+    make_attributes(workdir, io_cfg, args.ny, args.nx, seed=args.seed)
+    nhru = make_mapping(os.path.join(workdir, 'spatialweights.nc'), io_cfg, args.ny, args.nx, args.nhru,
+                        layout=args.layout, seed=args.seed)
+    print(f' {nhru} HRUs, {args.layout} layout', flush=True)
+
+    var_list = ['polyid', 'overlaps', 'weight', 'i_index', 'j_index']
+
+    with timed('load_geophysical_attributes', nCell, 'cell/s'):
+        attr_data = load_geophysical_attributes(io_cfg, param_meta=param_meta).load()
+
+    with timed('load_mapping_data', nhru, 'hru/s'):
+        mapping_data = load_mapping_data(io_cfg, var_list=var_list)
+
+    with xr.open_dataset(os.path.join(workdir, 'spatialweights.nc')) as ds:
+        ds.load()
+    with timed('process_mapping_data', nhru, 'hru/s'):
+        process_mapping_data(ds, io_cfg, var_list=var_list)
+    with timed('process_mapping_data(compact)', nhru, 'hru/s'):
+        process_mapping_data(ds, io_cfg, var_list=var_list, compact=True)
+
+    with timed('comp_remap_operator', nhru, 'hru/s'):
+        remap_op = comp_remap_operator(mapping_data, (args.ny, args.nx))
+
+    # transfer functions at native resolution, in order of param_meta
+    param_data = {}
+    for par, meta in param_meta.items():
+        if not meta['compute']:
+            continue
+        with timed(f'tf:{meta["tf"]}', nCell, 'cell/s'):
+            native = getattr(transfer_function, meta['tf'])(attr_data=attr_data, param_data=param_data,
+                                                            param_cfg=meta, coef=tf_coef.get(par))
+            param_data[par] = native.values if isinstance(native, xr.DataArray) else native
+
+    layer_op = comp_layer_weight(cfg['layer_thickness']['soil'], args.model_thickness)
+    with timed('vertical_weighted_mean', nCell, 'cell/s'):
+        soil_param = vertical_weighted_mean(layer_op, param_data['theta_sat'], args.pvalue)
+    with timed('horizontal_weighted_mean(2D)', nhru, 'hru/s'):
+        horizontal_weighted_mean(mapping_data, param_data['summerLAI'], args.pvalue, remap_op=remap_op)
+    with timed('horizontal_weighted_mean(3D)', nhru, 'hru/s'):
+        horizontal_weighted_mean(mapping_data, soil_param, args.pvalue, remap_op=remap_op)
+    del param_data, soil_param
+
+    with timed('run_mpr(fused)', nhru, 'hru/s'):
+        out_data = run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op, pvalue=args.pvalue,
+                           workers=args.workers, remap_op=remap_op)
+
+    with timed('write_param', nhru, 'hru/s'):
+        write_param(out_data, param_meta, mapping_data['polyid'], cfg['hru_meta'], io_cfg)
+
+    result = {'config': vars(args), 'records': RECORDS}
+
+    if args.validate_precision:
+        result['precision'] = validate_precision(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op,
+                                                 pvalue=args.pvalue, remap_op=remap_op)
+        print_precision(result['precision'])
+
+    return result
+
+
+def print_precision(report, storage='float32', reference='float64'):
+    print(f'\n Precision {storage} against {reference}', flush=True)
+    print(f' {"parameter":25s} {"max abs":>12s} {"max rel":>12s} {"nan mismatch":>13s}', flush=True)
+    for par, stat in report.items():
+        print(f' {par:25s} {stat["max_abs"]:12.4e} {stat["max_rel"]:12.4e} {stat["nan_mismatch"]:13d}', flush=True)
+
+
+def compare(result, baseline, tolerance, min_diff=0.001):
+    # return list of stages slower than baseline by more than tolerance (relative) and min_diff [s] (absolute)
+    base = {rec['stage']: rec for rec in baseline['records']}
+    slower = []
+    for rec in result['records']:
+        if not rec['stage'] in base:
+            continue
+        wall = base[rec['stage']]['wall']
+        if rec['wall'] > wall*(1.0 + tolerance) and rec['wall'] - wall > min_diff:
+            slower.append((rec['stage'], wall, rec['wall']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MPR stages with synthetic data')
+    parser.add_argument('--ny', type=int, default=500, help='number of grid rows')
+    parser.add_argument('--nx', type=int, default=800, help='number of grid columns')
+    parser.add_argument('--nhru', type=int, default=2000, help='approximate number of HRUs')
+    parser.add_argument('--layout', default='grid2poly', choices=['grid2poly', 'poly2poly'], help='mapping data layout')
+    parser.add_argument('--model-thickness', type=float, nargs='+', default=[0.1, 0.3, 0.6], help='model layer thickness [m]')
+    parser.add_argument('--pvalue', type=float, default=1.0, help='parameter in generalized mean operator')
+    parser.add_argument('--workers', type=int, default=1, help='number of threads for transfer functions')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--validate-precision', action='store_true',
+                        help='compare parameters in float32 storage against float64 run')
+    parser.add_argument('--workdir', help='directory of synthetic data (temporary directory if not given)')
+    parser.add_argument('--output', help='json file of benchmark result')
+    parser.add_argument('--baseline', help='json file of baseline benchmark result to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown relative to baseline')
+    parser.add_argument('--min-diff', type=float, default=0.001, help='allowed slowdown [s], regardless of tolerance')
+    args = parser.parse_args()
+
+    result = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(result, json.load(f), args.tolerance, min_diff=args.min_diff)
+        for stage, base, wall in slower:
+            print(f' REGRESSION {stage}: {base:.4f} s -> {wall:.4f} s', flush=True)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Synthetic MPR input data for benchmark
+#
+#   make_attributes: geophysical attribute netcdfs, {categ}_data.nc for categories in GEO_ATTR_TYPE (IO.yml)
+#   make_mapping:    spatial weight netcdf with variables in MAPPING_VARS_META (IO.yml)
+#                    in grid2poly (HRUs without overlap skipped in data dimension)
+#                    or poly2poly (HRUs without overlap have one missing value) layout
+
+import os
+
+import numpy as np
+import xarray as xr
+
+# attributes with monthly and soil layer dimension. others are 2D [lat, lon]
+MONTHLY_ATTR = ['prec', 'tavg', 'wind', 'rh', 'lai']
+LAYER_CATEG  = ['soil']
+
+# value range of attributes, [0, 1] if not listed
+ATTR_RANGE = {'prec': (10., 300.), 'tavg': (-10., 30.), 'wind': (0.5, 8.), 'rh': (10., 100.), 'ai': (0.1, 5.),
+              'sand_pct': (5., 90.), 'clay_pct': (2., 50.), 'silt_pct': (2., 50.), 'bulk_density': (1000., 1800.),
+              'soc': (0., 100.), 'vegclass': (1., 20.), 'ch': (-1., 40.), 'lai': (0., 60.),
+              'ele_mean': (0., 4000.), 'ele_std_dev': (0., 300.), 'slope_mean': (0., 40.)}
+
+
+def make_attributes(dire, io_cfg, ny, nx, nlyr=6, seed=0):
+    '''
+    Write synthetic geophysical attributes in dire. return list of files
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(dire, exist_ok=True)
+
+    coords = {'lat': np.linspace(30., 50., ny), 'lon': np.linspace(-125., -100., nx), 'month': np.arange(1, 13)}
+
+    files = []
+    for categ, attrs in io_cfg['GEO_ATTR_TYPE'].items():
+        ds = xr.Dataset(coords=coords)
+        for name in attrs.values():
+            lo, hi = ATTR_RANGE.get(name, (0., 1.))
+            if name in MONTHLY_ATTR:
+                dims = ('month', 'lat', 'lon')
+            elif categ in LAYER_CATEG:
+                dims = ('lyr', 'lat', 'lon')
+            else:
+                dims = ('lat', 'lon')
+            shape = tuple({'month': 12, 'lyr': nlyr, 'lat': ny, 'lon': nx}[dim] for dim in dims)
+            data = (lo + (hi-lo)*rng.random(shape, dtype='float32')).astype('float32')
+            data[..., :max(ny//50, 1), :max(nx//50, 1)] = np.nan  # missing data, e.g., ocean
+            ds[name] = (dims, data)
+        fname = os.path.join(dire, f'{categ}_data.nc')
+        ds.to_netcdf(fname)
+        files.append(fname)
+
+    return files
+
+
+def make_mapping(fname, io_cfg, ny, nx, nhru, layout='grid2poly', empty_fraction=0.01, seed=0):
+    '''
+    Write synthetic spatial weight data. HRUs are rectangular blocks of grid cells with random weights
+    return number of HRUs
+    '''
+    rng = np.random.default_rng(seed)
+    meta = io_cfg['MAPPING_VARS_META']
+
+    # block size of HRU
+    size = max(int(np.sqrt(ny*nx/nhru)), 1)
+    nby, nbx = max(ny//size, 1), max(nx//size, 1)
+    nhru = nby*nbx
+
+    bj, bi = np.divmod(np.arange(nhru), nbx)
+    dj, di = np.divmod(np.arange(size*size), size)
+    j_index = (bj[:, np.newaxis]*size + dj).clip(max=ny-1)  # [nhru x size*size]
+    i_index = (bi[:, np.newaxis]*size + di).clip(max=nx-1)
+
+    overlaps = np.full(nhru, size*size, dtype='int32')
+    empty = rng.random(nhru) < empty_fraction
+    overlaps[empty] = 0
+
+    keep = ~empty[:, np.newaxis].repeat(size*size, axis=1)
+    if layout == 'poly2poly': # one missing value for HRU without overlap
+        keep[empty, 0] = True
+    elif layout != 'grid2poly':
+        raise ValueError(f'layout must be "grid2poly" or "poly2poly": {layout}')
+
+    weight = rng.random(keep.shape, dtype='float32')
+    weight /= weight.sum(axis=1, keepdims=True)
+
+    data = {'polyid':       ('polyid', np.arange(nhru) + 1),
+            'overlaps':     ('polyid', overlaps),
+            'i_index':      ('data', i_index[keep] + 1), # 1-based
+            'j_index':      ('data', j_index[keep] + 1),
+            'weight':       ('data', weight[keep]),
+            'intersector':  ('data', (j_index*nx + i_index)[keep]),
+            'IDmask':       ('data', np.repeat(np.arange(nhru) + 1, keep.sum(axis=1))),
+            'regridweight': ('data', weight[keep])}
+
+    ds = xr.Dataset()
+    for var, (dim, values) in data.items():
+        ds[meta[var]['name']] = (meta[var]['dim'], values.astype(meta[var]['type']))
+    ds.to_netcdf(fname)
+
+    return nhru
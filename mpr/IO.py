@@ -1,13 +1,26 @@
 
 import sys, os
+import json
 import warnings
+import threading
 
 from datetime import datetime
 import numpy as np
 import xarray as xr
 
+from mpr import cache
+from mpr.transfer_function import DERIVED_ATTR, DOMAIN_STAT, get_required_attributes, comp_derived_attribute, \
+                                  add_domain_statistics
+from mpr.profiler import traced, span, array_info
+from mpr.precision import get_dtype, as_storage
+from mpr.scaling import get_index_array
+from mpr import shared
+
 FILL_VALUE = -9999.0
 
+# mapping variables in data dimension (others are in polyid dimension)
+MAPPING_DATA_VARS = ['intersector', 'weight', 'i_index', 'j_index', 'IDmask', 'regridweight']
+
 
 class NoneError(Exception):
     pass
@@ -21,12 +34,39 @@ def progress(r):
         return r
 
 
-def load_geophysical_attributes(io_cfg,  **kwargs):
+@traced()
+def load_geophysical_attributes(io_cfg, var_list=None, param_meta=None, chunks=None, window=None, **kwargs):
+    # var_list:   list of attribute names to be read. if None, attributes used by transfer functions
+    #             of param_meta (compute: True) or all the attributes if param_meta is None too
+    # chunks:     dask chunks passed to xr.open_dataset. io_cfg['INPUT']['CHUNKS'] is used if None
+    #             data is read lazily, files without required attributes are not opened
+    # window:     (optional) (j_slice, i_slice) of source grid, e.g., get_mapping_window(). only window is read
+    # floating point attributes are cast to storage precision (see precision.py)
+    # derived attributes (see transfer_function.DERIVED_ATTR) in var_list are read from derived_<name>.nc if
+    # io_cfg['INPUT']['DERIVED_CACHE'] is set (computed and written if missing). all of them if var_list is None.
+    # without DERIVED_CACHE, their monthly attributes are returned instead, and derived attributes are computed
+    # at the cells used (see pipeline.gather_attributes and transfer_function.derived_attribute)
+    # domain statistics (see transfer_function.DOMAIN_STAT) in var_list are computed here over entire grid,
+    # even if window is given. all of them if var_list is None
     print('\n Loading geophysical attributes...', flush=True)
 
     root=io_cfg['INPUT']['DIRE']
     geotype=io_cfg['GEO_ATTR_TYPE']
 
+    if chunks is None:
+        chunks = io_cfg['INPUT'].get('CHUNKS')
+
+    if var_list is None and param_meta is not None:
+        var_list = get_required_attributes(param_meta)
+
+    if var_list is None:
+        read_list, derived_list, stat_list = None, list(DERIVED_ATTR), list(DOMAIN_STAT)
+    else:
+        source_list = list(dict.fromkeys(DOMAIN_STAT[var]['attr'] if var in DOMAIN_STAT else var for var in var_list))
+        read_list = list(dict.fromkeys(DERIVED_ATTR[var]['attr'] if var in DERIVED_ATTR else var for var in source_list))
+        derived_list = [var for var in source_list if var in DERIVED_ATTR]
+        stat_list = [var for var in var_list if var in DOMAIN_STAT]
+
     if isinstance(geotype, dict):
         geolist = geotype.keys()
     elif isinstance(geotype, list):
@@ -35,18 +75,134 @@ def load_geophysical_attributes(io_cfg,  **kwargs):
         raise NoneError("geotype must be provided in dictionary key or list")
 
     attr_data = xr.Dataset()
+    source_file = {}
     for categ in geolist:
-        attr_data = attr_data.merge(xr.open_dataset(os.path.join(root, f'{categ}_data.nc'), **kwargs))
+        if read_list is not None and isinstance(geotype, dict) and isinstance(geotype[categ], dict):
+            if not any(var in read_list for var in geotype[categ].values()):
+                continue
+
+        fname = os.path.join(root, f'{categ}_data.nc')
+        ds = xr.open_dataset(fname, chunks=chunks, **kwargs)
+        if read_list is not None:
+            ds = ds[[var for var in ds.data_vars if var in read_list]]
+        source_file.update({var: fname for var in ds.data_vars})
+        attr_data = attr_data.merge(ds)
+
+    if read_list is not None:
+        for var in read_list:
+            if not var in attr_data.data_vars:
+                warnings.warn('attribute: "%s" not exist' % var)
+
+    stat_data = xr.Dataset()
+    if window is not None:
+        stat_data = _load_domain_statistics(attr_data, stat_list, source_file, io_cfg, chunks=chunks)
+        attr_data = _isel_window(attr_data, window)
+
+    attr_data = as_storage(attr_data)
+    attr_data = _load_derived_attributes(attr_data, derived_list, source_file, io_cfg, chunks=chunks, window=window)
+    attr_data = add_domain_statistics(attr_data.merge(stat_data), stat_list)
+
+    if var_list is not None:
+        keep = [DERIVED_ATTR[var]['attr'] if var in DERIVED_ATTR and not var in attr_data.data_vars else var for var in var_list]
+        attr_data = attr_data[[var for var in dict.fromkeys(keep) if var in attr_data.data_vars]]
 
     return attr_data
 
 
-def load_mapping_data(io_cfg, var_list=None, **kwargs):
-    print('\n Loading mapping weight data...', flush=True)
+def _load_derived_attributes(attr_data, names, source_file, io_cfg, chunks=None, window=None):
+    # add derived attributes to attr_data. with DERIVED_CACHE in io_cfg['INPUT'] (True: INPUT DIRE, or directory),
+    # each is read from derived_<name>.nc, or computed and written there if the file is missing or
+    # its monthly attribute file has been modified. without DERIVED_CACHE, nothing is added (computation is
+    # deferred until attributes are gathered to the cells used)
+    # with window, window of cached file is read, and derived attribute computed from window is not written
+    cache_dir = io_cfg['INPUT'].get('DERIVED_CACHE')
+    if cache_dir is True:
+        cache_dir = io_cfg['INPUT']['DIRE']
+    if not cache_dir:
+        return attr_data
+
+    for name in names:
+        source = DERIVED_ATTR[name]['attr']
+        if not source in attr_data.data_vars:
+            continue
+
+        fname = os.path.join(cache_dir, f'derived_{name}.nc')
+        st = os.stat(source_file[source])
+        stamp = json.dumps({'source': os.path.abspath(source_file[source]), 'mtime_ns': st.st_mtime_ns,
+                            'size': st.st_size, 'attr': source, 'months': DERIVED_ATTR[name]['months'],
+                            'dtype': attr_data[source].dtype.name})
+
+        if os.path.isfile(fname):
+            ds = xr.open_dataset(fname, chunks=chunks)
+            if ds.attrs.get('derived_from') == stamp and name in ds.data_vars:
+                attr_data[name] = ds[name] if window is None else _isel_window(ds[name], window)
+                continue
+            ds.close()
+
+        da = comp_derived_attribute(attr_data[source], name).load()
+        attr_data[name] = da
+        if window is not None:
+            continue
+        try:
+            tmp = f'{fname}.{os.getpid()}.tmp'
+            da.to_dataset().assign_attrs(derived_from=stamp).to_netcdf(tmp)
+            os.replace(tmp, fname)
+        except OSError as e:
+            warnings.warn(f'derived attribute "{name}" is not cached: {e}')
+
+    return attr_data
+
+
+def _load_domain_statistics(attr_data, names, source_file, io_cfg, chunks=None):
+    # domain statistics in names over entire grid of attr_data, before window is selected.
+    # derived attributes are read from (or written to) DERIVED_CACHE of entire grid if it is set (see _load_derived_attributes),
+    # otherwise computed from monthly attributes of entire grid
+    sources = [DOMAIN_STAT[name]['attr'] for name in names]
+    read = [DERIVED_ATTR[var]['attr'] if var in DERIVED_ATTR else var for var in sources]
+    data = as_storage(attr_data[[var for var in dict.fromkeys(read) if var in attr_data.data_vars]])
+    data = _load_derived_attributes(data, [var for var in sources if var in DERIVED_ATTR], source_file, io_cfg, chunks=chunks)
+    data = add_domain_statistics(data, names)
+    return data[[name for name in names if name in data.data_vars]]
+
+
+def _isel_window(ds, window):
+    # select window (j_slice, i_slice) of spatial dimensions, the last two dimensions of 2D variables
+    for da in (ds.data_vars.values() if isinstance(ds, xr.Dataset) else [ds]):
+        if da.ndim >= 2:
+            return ds.isel({da.dims[-2]: window[0], da.dims[-1]: window[1]})
+    return ds
+
+
+@traced()
+def load_mapping_data(io_cfg, var_list=None, layout=None, compact=False, cache_dir=None, hru_ids=None, map_file=None, **kwargs):
     # var_list should be key in 'MAPPING_VARS_META'
+    # cache_dir: directory of processed mapping cache (see cache.py). io_cfg['CACHE']['DIRE'] is used if None
+    #            arrays loaded from cache are memory-mapped and read-only, copy them before modifying in place
+    # hru_ids:   (optional) list of HRU IDs (polyid) to be extracted, in this order. only data of these HRUs are read
+    #            from mapping file (cached mapping data of all the HRUs is used if exists, but subset is not cached)
+    # map_file:  mapping file name in INPUT DIRE. io_cfg['INPUT']['MAP_FILE'] is used if None (see get_map_files
+    #            for multiple targets)
 
     root=io_cfg['INPUT']['DIRE']
-    file=io_cfg['INPUT']['MAP_FILE']
+    file=map_file or io_cfg['INPUT']['MAP_FILE']
+    if not isinstance(file, str):
+        raise ValueError('multiple mapping files in MAP_FILE. give map_file (see get_map_files)')
+
+    cache_cfg = io_cfg.get('CACHE') or {}
+    if cache_dir is None:
+        cache_dir = cache_cfg.get('DIRE')
+
+    if cache_dir is not None:
+        key = cache.mapping_cache_key(os.path.join(root, file), io_cfg, hash_content=cache_cfg.get('HASH_CONTENT', False),
+                                      var_list=var_list, layout=layout, compact=compact)
+        mat_data = cache.load_cache(cache_dir, key)
+        if mat_data is not None:
+            print('\n Loading mapping weight data from cache...', flush=True)
+            if hru_ids is not None:
+                mat_data = subset_mapping_data(mat_data, get_hru_index(mat_data['polyid'], hru_ids))
+            return mat_data
+
+    print('\n Loading mapping weight data...', flush=True)
 
     with xr.open_dataset(os.path.join(root, file), **kwargs) as ds:
 
@@ -61,25 +217,85 @@ def load_mapping_data(io_cfg, var_list=None, **kwargs):
 
             drop_var = [ds_var for ds_var in ds.variables if not ds_var in ds_var_list]
 
-        mat_data = process_mapping_data(ds.drop_vars(drop_var), io_cfg, var_list=var_list)
+        ds = ds.drop_vars(drop_var)
+        if hru_ids is not None:
+            ds, layout = _subset_mapping_dataset(ds, io_cfg, hru_ids, layout=layout)
+
+        mat_data = process_mapping_data(ds, io_cfg, var_list=var_list, layout=layout, compact=compact)
+
+    if cache_dir is not None and hru_ids is None:
+        cache.save_cache(cache_dir, key, mat_data, source=os.path.abspath(os.path.join(root, file)))
+        cache.evict_cache(cache_dir, max_entries=cache_cfg.get('MAX_ENTRIES'), max_bytes=cache_cfg.get('MAX_BYTES'))
 
     return mat_data
 
 
-def process_mapping_data(mapping_data, io_cfg, var_list=None):
+def get_map_files(io_cfg):
+    # return dictionary {target name: mapping file name} of io_cfg['INPUT']['MAP_FILE']
+    #   MAP_FILE: file name                        -> {None: file name} (single target)
+    #             list of file names               -> {file name without extension: file name}
+    #             dictionary {target name: file}   -> as is
+    files = io_cfg['INPUT']['MAP_FILE']
+    if isinstance(files, str):
+        return {None: files}
+    if isinstance(files, dict):
+        return dict(files)
+    return {os.path.splitext(os.path.basename(file))[0]: file for file in files}
+
+
+def get_output_file(io_cfg, target=None, output=None):
+    # return output file name. <OUTPUT DIRE>/<PARAM_FILE_NAME> if output is None,
+    # with target name before extension for multiple targets, e.g., param_huc12.nc
+    # PARAM_FILE_NAME of shared memory "shm://<name>" is used as is (see shared.py)
+    if output is None:
+        output = io_cfg['OUTPUT']['PARAM_FILE_NAME']
+        if not str(output).startswith(shared.SHM_PREFIX):
+            output = os.path.join(io_cfg['OUTPUT']['DIRE'], output)
+    if target is None:
+        return output
+    root, ext = os.path.splitext(str(output).rstrip('/'))
+    return f'{root}_{target}{ext}'
+
+
+def get_layer_dims(param_meta, hru_meta):
+    # return list of model layer dimension names, dimensions other than HRU dimension of computed parameters
+    # with vertical_scale: True (e.g., ['lyr'] for dim: [lyr, hru])
+    hru_dim = _as_list(hru_meta['dim'])[0]
+    layer_dims = []
+    for meta in param_meta.values():
+        if meta['compute'] and meta.get('vertical_scale'):
+            layer_dims += [dim for dim in _as_list(meta['dim']) if dim != hru_dim and not dim in layer_dims]
+    return layer_dims
+
+
+@traced()
+def process_mapping_data(mapping_data, io_cfg, var_list=None, layout=None, compact=False):
     print("\n Pre-process mapping data arrays")
 
     # input:  xarray dataset,  mapping_data
     #         list,            list of key variable name to be processed
+    #         str,             layout of data dimension, 'grid2poly' or 'poly2poly'. detected from array size if None
+    #         logical,         True: return flat data dimension arrays with offsets instead of padded matrices
     # return: dictionary,      {kye variable name: numpy array}
 
     # data dimension variable reformat
-    #   mat_weight      [nHRU x maxOverlaps]
-    #   mat_i_index     [nHRU x maxOverlaps]
-    #   mat_j_index     [nHRU x maxOverlaps]
-    #   mat_intersector [nHRU x maxOverlaps]
-
-    datavar_list = ['intersector', 'weight', 'i_index', 'j_index', 'IDmask', 'regridweight']
+    #   compact=False (padded matrices)
+    #     mat_weight      [nHRU x maxOverlaps]
+    #     mat_i_index     [nHRU x maxOverlaps]
+    #     mat_j_index     [nHRU x maxOverlaps]
+    #     mat_intersector [nHRU x maxOverlaps]
+    #   compact=True (CSR style)
+    #     offsets         [nHRU+1], data of HRU p is in [offsets[p]:offsets[p+1]]
+    #     weight, i_index, j_index, intersector [sum(overlaps)]
+    #
+    # data dimension layout
+    #   grid2poly: HRUs without overlap are skipped in data dimension
+    #   poly2poly: HRUs without overlap have one missing value in data dimension
+
+    datavar_list = MAPPING_DATA_VARS
+
+    if var_list is None:
+        var_list = [var for var, meta in io_cfg['MAPPING_VARS_META'].items() if meta['name'] in mapping_data.variables]
 
     # enforce to include ['polyid', 'overlaps', 'weight']
     if not all(v in var_list for v in ['polyid', 'overlaps', 'weight']):
@@ -97,74 +313,401 @@ def process_mapping_data(mapping_data, io_cfg, var_list=None):
              # i_index is 1-based and starts at West ... make 0-based
             var_dic[var] = var_dic[var] - 1
 
-    # check number of target HRUs, maximum number of overlapping source polygons
-    nHRU = len(var_dic['polyid'])
-    maxOverlaps = var_dic['overlaps'].max()
+    overlaps = var_dic['overlaps'].astype('int64')
+    nHRU     = len(overlaps)
+    nData    = len(var_dic['weight'])
+
+    # number of entries each HRU occupies in data dimension
+    if layout is None:
+        layout = 'grid2poly' if overlaps.sum() == nData else 'poly2poly'
+    if layout == 'grid2poly':
+        span = overlaps
+    elif layout == 'poly2poly':
+        span = np.where(overlaps > 0, overlaps, 1)
+    else:
+        raise ValueError('layout must be "grid2poly" or "poly2poly": %s' % layout)
+    if span.sum() != nData:
+        raise ValueError('data dimension size (%d) is inconsistent with overlaps for %s layout (%d)' % (nData, layout, span.sum()))
 
-    # Check sum of overlapping polygon number is equal to data dimension
-    flag = True
-    if var_dic['overlaps'].sum() == len(var_dic['weight']):
-        flag = False
+    # drop missing value entries of HRUs without overlap, and compute start of each HRU in flat arrays
+    keep    = np.repeat(overlaps > 0, span)
+    offsets = np.concatenate(([0], np.cumsum(overlaps)))
 
-    # convert 1D data dimension array to a matrix (nHRU x maxOverlaps)
-    mat_dic = {}
+    flat_dic = {}
     for var in var_list:
         if var in datavar_list:
-            mat_dic[var] = np.zeros((nHRU, maxOverlaps), dtype=io_cfg['MAPPING_VARS_META'][var]['type'])
-
-    ix2=0;
-    for p in range(0, nHRU):
-        if var_dic['overlaps'][p]>0:
-            ix1 = ix2
-            ix2 = ix1+var_dic['overlaps'][p]
-        elif var_dic['overlaps'][p]==0:
-            if flag: # NOTE:  # WARNNG: grid2poly.py output skip data in data dimension, but poly2poly put missing values in data dimension
-                ix1 = ix2
-                ix2 = ix2+1
-            continue
+            flat_dic[var] = var_dic[var][keep].astype(io_cfg['MAPPING_VARS_META'][var]['type'])
+
+    # normalize in case sum of weight is not 1
+    has_data = overlaps > 0
+    if has_data.any():
+        sum_weight = np.add.reduceat(flat_dic['weight'], offsets[:-1][has_data])
+        flat_dic['weight'] /= np.repeat(sum_weight, overlaps[has_data]).astype(flat_dic['weight'].dtype)
 
-        for var in var_list:
-            if var in datavar_list:
-                if var == 'weight': # will normalize in case sum of weight is not 1
-                    mat_dic[var][p, 0:var_dic['overlaps'][p]] = var_dic[var][ix1:ix2]/var_dic[var][ix1:ix2].sum()
-                else:
-                    mat_dic[var][p, 0:var_dic['overlaps'][p]] = var_dic[var][ix1:ix2]
-            else: # add polyid dimension
-                mat_dic[var] = var_dic[var]
+    mat_dic = {}
+    for var in var_list:
+        if not var in datavar_list: # add polyid dimension
+            mat_dic[var] = var_dic[var]
+
+    if compact:
+        mat_dic['offsets'] = offsets
+        mat_dic.update(flat_dic)
+        return mat_dic
+
+    # convert flat data dimension array to a matrix (nHRU x maxOverlaps)
+    maxOverlaps = overlaps.max() if nHRU > 0 else 0
+    row = np.repeat(np.arange(nHRU), overlaps)
+    col = np.arange(offsets[-1]) - np.repeat(offsets[:-1], overlaps)
+    for var, flat in flat_dic.items():
+        mat_dic[var] = np.zeros((nHRU, maxOverlaps), dtype=io_cfg['MAPPING_VARS_META'][var]['type'])
+        mat_dic[var][row, col] = flat
 
     return mat_dic
 
 
-def write_param(param_data, param_meta, hru_data, hru_meta, io_cfg, par_list=None, output=None):
-    print("\n Write parameters", flush=True)
+# ---- domain subset by HRU ID
+# e.g.,
+#   attr_data, mapping_data = load_subset(io_cfg, [170100010101, 170100010102], param_meta=cfg['param'])
+#   param_data = run_mpr(attr_data, mapping_data, ...)
+# only mapping data of the HRUs and bounding window of their source grid cells are read.
 
-    if output is None:
-        output = os.path.join(io_cfg['OUTPUT']['DIRE'], io_cfg['OUTPUT']['PARAM_FILE_NAME'])
+def get_hru_index(polyid, hru_ids):
+    # return position of hru_ids in polyid. raise ValueError if some of hru_ids are not in polyid
+    polyid = np.asarray(polyid)
+    hru_ids = np.asarray(hru_ids, dtype=polyid.dtype).reshape(-1)
+    if len(polyid) == 0:
+        index = np.ma.array(np.zeros(len(hru_ids), dtype='int64'), mask=True)
+    else:
+        index = get_index_array(polyid, hru_ids)
+    missing = hru_ids[np.ma.getmaskarray(index)]
+    if len(missing) > 0:
+        raise ValueError('%d HRU IDs not in mapping data: %s' % (len(missing), missing[:10].tolist()))
+    return np.asarray(index, dtype='int64')
+
+
+def subset_mapping_data(mapping_data, hru_index):
+    # extract HRUs of hru_index (position in polyid dimension) from processed mapping data (padded or compact)
+    hru_index = np.asarray(hru_index, dtype='int64')
+    sub_data = {}
+    if 'offsets' in mapping_data:
+        offsets = np.asarray(mapping_data['offsets'])
+        count = offsets[hru_index+1] - offsets[hru_index]
+        data_index = _range_index(offsets[hru_index], count)
+        sub_data['offsets'] = np.concatenate(([0], np.cumsum(count)))
+    for var, array in mapping_data.items():
+        if var == 'offsets':
+            continue
+        if 'offsets' in mapping_data and var in MAPPING_DATA_VARS:
+            sub_data[var] = np.asarray(array[data_index])
+        else:
+            sub_data[var] = np.asarray(array[hru_index])
+    return sub_data
+
+
+def get_mapping_window(mapping_data):
+    # return bounding box (j_slice, i_slice) of source grid cells referenced in processed mapping data
+    j_index, i_index = _valid_index(mapping_data)
+    if len(j_index) == 0:
+        return (slice(0, 0), slice(0, 0))
+    return (slice(int(j_index.min()), int(j_index.max())+1), slice(int(i_index.min()), int(i_index.max())+1))
+
+
+def shift_mapping_index(mapping_data, window):
+    # return processed mapping data whose i_index and j_index are relative to window (j_slice, i_slice)
+    shifted = dict(mapping_data)
+    if 'offsets' in mapping_data:
+        shifted['j_index'] = mapping_data['j_index'] - window[0].start
+        shifted['i_index'] = mapping_data['i_index'] - window[1].start
+    else: # padded entries are kept zero
+        mask = _padded_mask(mapping_data)
+        shifted['j_index'] = np.where(mask, mapping_data['j_index'] - window[0].start, 0).astype(mapping_data['j_index'].dtype)
+        shifted['i_index'] = np.where(mask, mapping_data['i_index'] - window[1].start, 0).astype(mapping_data['i_index'].dtype)
+    return shifted
+
+
+def load_subset(io_cfg, hru_ids, var_list=None, param_meta=None, chunks=None, mapping_var_list=None, layout=None,
+                compact=False, cache_dir=None):
+    # input:  hru_ids,          list of HRU IDs (polyid)
+    #         mapping_var_list, var_list of load_mapping_data
+    #         others,           see load_geophysical_attributes and load_mapping_data
+    # return: xarray dataset,   geophysical attributes in bounding window of source grid cells of HRUs
+    #         dictionary,       mapping data of HRUs in order of hru_ids, i_index/j_index relative to window
+    #
+    # domain statistics in transfer functions (DOMAIN_STAT, e.g., domain mean in norm_prec_tf1) are
+    # computed over entire domain (see load_geophysical_attributes), so parameters of the subset are
+    # identical to those of entire domain run
+    if mapping_var_list is None:
+        mapping_var_list = ['polyid', 'overlaps', 'weight', 'i_index', 'j_index']
+
+    mapping_data = load_mapping_data(io_cfg, var_list=mapping_var_list, layout=layout, compact=compact,
+                                     cache_dir=cache_dir, hru_ids=hru_ids)
+    window = get_mapping_window(mapping_data)
+    print(f'\n Subset: {len(mapping_data["polyid"])} HRUs, source grid window '
+          f'[{window[0].start}:{window[0].stop}, {window[1].start}:{window[1].stop}]', flush=True)
+
+    attr_data = load_geophysical_attributes(io_cfg, var_list=var_list, param_meta=param_meta, chunks=chunks, window=window)
+
+    return attr_data, shift_mapping_index(mapping_data, window)
+
+
+def _subset_mapping_dataset(ds, io_cfg, hru_ids, layout=None):
+    # extract HRUs of hru_ids from mapping dataset before pre-processing. only range of data dimension
+    # spanned by the HRUs is read. return subset dataset and layout (detected from all the HRUs if None)
+    meta = io_cfg['MAPPING_VARS_META']
+    poly_dim, data_dim = meta['polyid']['dim'], meta['weight']['dim']
+
+    hru_index = get_hru_index(ds[meta['polyid']['name']].values, hru_ids)
+    overlaps  = ds[meta['overlaps']['name']].values.astype('int64')
+
+    if layout is None:
+        layout = 'grid2poly' if overlaps.sum() == ds.sizes[data_dim] else 'poly2poly'
+    span = overlaps if layout == 'grid2poly' else np.where(overlaps > 0, overlaps, 1)
+    offsets = np.concatenate(([0], np.cumsum(span)))
+
+    data_index = _range_index(offsets[hru_index], span[hru_index])
+    start = int(data_index.min()) if len(data_index) > 0 else 0
+    stop  = int(data_index.max())+1 if len(data_index) > 0 else 0
+
+    ds = ds.isel({poly_dim: hru_index, data_dim: slice(start, stop)}).load()
+    return ds.isel({data_dim: data_index - start}), layout
+
+
+def _range_index(start, count):
+    # concatenated np.arange(start[k], start[k]+count[k]) for all k
+    start, count = np.asarray(start, dtype='int64'), np.asarray(count, dtype='int64')
+    offsets = np.concatenate(([0], np.cumsum(count)))
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1] - start, count)
+
+
+def _padded_mask(mapping_data):
+    # True at entries with data in padded mapping data [nHRU x maxOverlaps]
+    return np.arange(mapping_data['weight'].shape[1]) < np.asarray(mapping_data['overlaps'])[:, np.newaxis]
+
+
+def _valid_index(mapping_data):
+    # j_index and i_index of entries with data in processed mapping data
+    if 'offsets' in mapping_data:
+        return np.asarray(mapping_data['j_index']), np.asarray(mapping_data['i_index'])
+    mask = _padded_mask(mapping_data)
+    return mapping_data['j_index'][mask], mapping_data['i_index'][mask]
+
+
+@traced()
+def write_param(param_data, param_meta, hru_data, hru_meta, io_cfg, par_list=None, output=None, **kwargs):
+    # write all the parameters at once. see ParamWriter to write parameters as they are computed
+    # kwargs: passed to ParamWriter (backend, complevel, chunksizes, dtype)
+    # par_list: parameters with compute: True and write: True if None. parameters with write: False (e.g., norm_prec)
+    #           are intermediate parameters and not returned by run_mpr, so they are written only if given in par_list
+    print("\n Write parameters", flush=True)
 
-    ds = xr.Dataset()
-    ds[hru_meta['name']]=((hru_meta['dim']), hru_data)
+    output = get_output_file(io_cfg, output=output)
 
     if par_list is None:
         par_list = []
         for par, meta in param_meta.items():
-            if meta['compute']:
+            if meta['compute'] and meta.get('write', True):
                 par_list.append(par)
-        #par_list = [*param_data]
 
-    else:  # Make sure that parameter in [par_list] exist in data, remove if not exist
-        for par in par_list:
-            if not par in param_data.keys():
-                warnings.warn(f'parameter: "{par}" not exist')
-                par_list.remove(par)
+    # Make sure that parameter in [par_list] exist in data, remove if not exist
+    for par in par_list:
+        if not par in param_data.keys():
+            warnings.warn(f'parameter: "{par}" not exist')
+    par_list = [par for par in par_list if par in param_data.keys()]
 
+    # dimension size from data
+    dim_sizes = {}
     for name in par_list:
-        ds[name] = ((param_meta[name]['dim']), param_data[name])
-
-        ds[name].attrs['long_name'] = param_meta[name]['long_name']
-        ds[name].attrs['units'] = param_meta[name]['units']
-        ds[name].encoding['_FillValue'] = FILL_VALUE
-
-    history = '{}: {}\n'.format(datetime.now().strftime('%c'),' '.join(sys.argv))
-    ds.attrs={'Conventions':'xxxx', 'title':'Hydrologic model parameter', 'history':history}
-
-    ds.to_netcdf(output)
+        dim_sizes.update(zip(_param_dims(name, param_meta[name]), np.shape(param_data[name])))
+
+    with ParamWriter(output, param_meta, hru_data, hru_meta, par_list=par_list, dim_sizes=dim_sizes, **kwargs) as writer:
+        for name in par_list:
+            writer.write(name, param_data[name])
+
+
+class ParamWriter():
+    '''
+    Streaming parameter writer. output file is created with all the parameter variables up front,
+    and each parameter (or HRU subset of parameter) is written as soon as it is computed
+
+    input:  output,     output file name. zarr store if backend is "zarr" or name ends with ".zarr",
+                        shared memory "shm://<name>" or memory-mapped file if backend is "shared" or name ends with ".mpr"
+                        (zero-copy handoff to coupled model, see shared.py), otherwise netcdf
+            param_meta, dictionary, parameter config (['param'] in param_meta.yml)
+            hru_data,   numpy array, HRU ID
+            hru_meta,   dictionary, HRU ID meta (['hru_meta'] in param_meta.yml)
+            par_list,   list of parameters to be written. parameters with compute: True and write: True if None
+            dim_sizes,  dictionary, size of dimensions other than HRU dimension, e.g., {'lyr': 3}
+                        (size of statistics dimension "<name>_stat" of parameters with list of horizontal_stat is from param_meta)
+            complevel,  (optional) compression level (netcdf: zlib 1-9, zarr: default compressor if not None)
+            chunksizes, (optional) dictionary, chunk size of each dimension, e.g., {'hru': 10000}
+            create,     False: open existing zarr store to write from multiple workers (output and backend only needed),
+                        or existing shared output to publish parameters again (e.g., in calibration loop)
+            dtype,      dtype of parameter variables. storage precision (see precision.py) if None
+
+    e.g.,
+      with ParamWriter(output, param_meta, hru_data, hru_meta, dim_sizes={'lyr': 3}) as writer:
+          writer.write('k_soil', k_soil)                      # entire parameter
+          writer.write('k_soil', k_soil_tile, hru_index=idx)  # subset of HRUs, index in hru_data
+
+    zarr store can be written by multiple processes in parallel if each process writes different chunks.
+    shared output is published (sequence number becomes even) when writer is closed
+    '''
+
+    def __init__(self, output, param_meta=None, hru_data=None, hru_meta=None, par_list=None, dim_sizes=None,
+                 backend=None, complevel=None, chunksizes=None, create=True, dtype=None):
+
+        if backend is None:
+            if str(output).rstrip('/').endswith('.zarr'):
+                backend = 'zarr'
+            elif shared.is_shared_output(output):
+                backend = 'shared'
+            else:
+                backend = 'netcdf'
+        if not backend in ['netcdf', 'zarr', 'shared']:
+            raise ValueError(f'backend must be "netcdf", "zarr" or "shared": {backend}')
+
+        self.output  = output
+        self.backend = backend
+        self.dtype   = np.dtype(dtype or get_dtype('storage'))
+        self._lock   = threading.Lock()  # write from multiple threads (see scheduler.py)
+
+        if not create:
+            self._open()
+            return
+
+        if par_list is None:
+            par_list = [par for par, meta in param_meta.items() if meta['compute'] and meta.get('write', True)]
+
+        hru_dim = _as_list(hru_meta['dim'])[0]
+        sizes = {hru_dim: len(hru_data)}
+        sizes.update(dim_sizes or {})
+        chunksizes = chunksizes or {}
+
+        history = '{}: {}\n'.format(datetime.now().strftime('%c'),' '.join(sys.argv))
+        global_attrs = {'Conventions':'xxxx', 'title':'Hydrologic model parameter', 'history':history}
+
+        variables = {}
+        for name in par_list:
+            dims = _param_dims(name, param_meta[name])
+            attrs = {'long_name': param_meta[name]['long_name'], 'units': param_meta[name]['units']}
+            if dims[0] == f'{name}_stat':
+                sizes.setdefault(dims[0], len(param_meta[name]['horizontal_stat']))
+                attrs['statistic'] = ' '.join(str(stat) for stat in param_meta[name]['horizontal_stat'])
+            for dim in dims:
+                if not dim in sizes:
+                    raise ValueError(f'size of dimension "{dim}" of parameter "{name}" is not given in dim_sizes')
+            variables[name] = {'dims': dims,
+                               'shape': tuple(sizes[dim] for dim in dims),
+                               'chunks': tuple(min(chunksizes.get(dim, sizes[dim]), sizes[dim]) for dim in dims),
+                               'attrs': attrs}
+
+        if backend == 'netcdf':
+            self._create_netcdf(hru_data, hru_meta, hru_dim, sizes, variables, global_attrs, complevel, chunksizes)
+        elif backend == 'shared':
+            self._create_shared(hru_data, hru_meta, hru_dim, variables, global_attrs)
+        else:
+            self._create_zarr(hru_data, hru_meta, hru_dim, variables, global_attrs, complevel)
+            self._open()
+
+    def write(self, name, data, hru_index=None):
+        '''
+        Write parameter. hru_index: (optional) sorted index of HRUs (last dimension) of data
+        '''
+        data = np.asarray(data)
+        data = np.where(np.isnan(data), FILL_VALUE, data)
+
+        with self._lock, span(f'write:{name}', **array_info(data)):
+            var = self._ds[name].oindex if self.backend == 'zarr' else self._ds[name]
+            if hru_index is None:
+                var[...] = data
+            else:
+                var[(slice(None),)*(data.ndim-1) + (np.asarray(hru_index),)] = data
+
+    def close(self):
+        if self.backend == 'netcdf' and self._ds is not None:
+            self._ds.close()
+        elif self.backend == 'shared' and self._ds is not None:
+            self._ds = None  # release views of buffer before closing it
+            shared.set_sequence(self._buf, shared.get_sequence(self._buf) + 1)
+            self._buf.release()
+            self._handle.close()
+        self._ds = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create_netcdf(self, hru_data, hru_meta, hru_dim, sizes, variables, global_attrs, complevel, chunksizes):
+        import netCDF4
+
+        self._ds = netCDF4.Dataset(self.output, 'w')
+        for dim, size in sizes.items():
+            self._ds.createDimension(dim, size)
+
+        hru_var = self._ds.createVariable(hru_meta['name'], np.asarray(hru_data).dtype, (hru_dim,))
+        hru_var[:] = hru_data
+
+        for name, var in variables.items():
+            v = self._ds.createVariable(name, self.dtype, var['dims'], fill_value=FILL_VALUE,
+                                        zlib=complevel is not None, complevel=complevel or 4,
+                                        chunksizes=var['chunks'] if chunksizes else None)
+            v.setncatts(var['attrs'])
+        self._ds.setncatts(global_attrs)
+
+    def _create_zarr(self, hru_data, hru_meta, hru_dim, variables, global_attrs, complevel):
+        import dask.array as da
+
+        # write metadata only (compute=False), data is written by write()
+        ds = xr.Dataset(attrs=global_attrs)
+        ds[hru_meta['name']] = ((hru_dim), hru_data)
+        encoding = {}
+        for name, var in variables.items():
+            ds[name] = (var['dims'], da.full(var['shape'], FILL_VALUE, dtype=self.dtype, chunks=var['chunks']))
+            ds[name].attrs = var['attrs']
+            encoding[name] = {'_FillValue': FILL_VALUE}
+            if complevel is None:
+                encoding[name]['compressors' if _zarr_v3() else 'compressor'] = None
+        ds.to_zarr(self.output, mode='w', compute=False, encoding=encoding)
+
+    def _create_shared(self, hru_data, hru_meta, hru_dim, variables, global_attrs):
+        header, size = shared.build_header(hru_data, hru_meta['name'], hru_dim, variables, self.dtype,
+                                           attrs=global_attrs, fill_value=FILL_VALUE)
+        self._buf, self._handle = shared.create_buffer(self.output, size)
+        shared.write_header(self._buf, header, sequence=1)  # odd: being written
+        shared.array_view(self._buf, header['hru'])[...] = hru_data
+        self._ds = {name: shared.array_view(self._buf, entry) for name, entry in header['variables'].items()}
+        for var in self._ds.values():
+            var[...] = FILL_VALUE
+
+    def _open(self):
+        if self.backend == 'netcdf':
+            import netCDF4
+            self._ds = netCDF4.Dataset(self.output, 'a')
+        elif self.backend == 'shared':
+            self._buf, self._handle = shared.attach_buffer(self.output, readonly=False)
+            header = shared.read_header(self._buf)
+            self._ds = {name: shared.array_view(self._buf, entry) for name, entry in header['variables'].items()}
+            shared.set_sequence(self._buf, shared.get_sequence(self._buf) + 1)
+        else:
+            import zarr
+            self._ds = zarr.open_group(self.output, mode='r+')
+
+
+def _zarr_v3():
+    import zarr
+    return int(zarr.__version__.split('.')[0]) >= 3
+
+
+def _as_list(dim):
+    return [dim] if isinstance(dim, str) else list(dim)
+
+
+def _param_dims(name, meta):
+    # dimensions of parameter variable. dimension "<name>_stat" is added in front for list of horizontal_stat
+    # (statistics stacked in first dimension, see pipeline.scale_param)
+    dims = _as_list(meta['dim'])
+    if meta.get('horizontal_scale') and isinstance(meta.get('horizontal_stat'), list):
+        dims = [f'{name}_stat'] + dims
+    return dims
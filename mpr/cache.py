@@ -0,0 +1,170 @@
+# on-disk cache of pre-processed mapping data
+#
+# ---- layout
+# <cache_dir>/<key>/<variable>.npy   one array per mapping variable (memory-mappable)
+# <cache_dir>/<key>/meta.json        source mapping file, creation/access time
+#
+# key is a hash of mapping file path, modification time and size (or content hash), MAPPING_VARS_META
+# and process options, so a modified mapping file or config never hits stale entries.
+# stale entries are removed by evict_cache (least recently used first) or clear_cache.
+# incomplete entries (e.g., array file removed) are treated as miss and rebuilt.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+META_FILE = 'meta.json'
+
+
+def mapping_cache_key(map_file, io_cfg, hash_content=False, **options):
+    '''
+    Compute cache key of processed mapping data
+
+    input:  map_file,     path to mapping netcdf
+            io_cfg,       dictionary, IO config (MAPPING_VARS_META is used)
+            hash_content, logical, True: hash file content instead of modification time and size
+            options,      keyword arguments passed to process_mapping_data (var_list, layout, compact)
+    return: str,          hex digest
+    '''
+    map_file = os.path.abspath(map_file)
+    # variables are cached by name, so order of var_list does not change processed mapping data
+    if options.get('var_list') is not None:
+        options['var_list'] = sorted(set(options['var_list']))
+
+    h = hashlib.sha1()
+    h.update(map_file.encode())
+
+    if hash_content:
+        with open(map_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                h.update(block)
+    else:
+        st = os.stat(map_file)
+        h.update(('%d:%d' % (st.st_mtime_ns, st.st_size)).encode())
+
+    h.update(json.dumps(io_cfg['MAPPING_VARS_META'], sort_keys=True).encode())
+    h.update(json.dumps(options, sort_keys=True, default=str).encode())
+
+    return h.hexdigest()
+
+
+def load_cache(cache_dir, key, mmap_mode='r'):
+    '''
+    Load cached arrays. return None if key is not in cache, or entry is incomplete (missing or unreadable array file),
+    in which case the entry is removed so that it is rebuilt by save_cache
+    arrays are memory-mapped and read-only with default mmap_mode. use mmap_mode=None (or 'c', copy-on-write)
+    if arrays are modified in place
+    '''
+    entry = os.path.join(cache_dir, key)
+    meta_file = os.path.join(entry, META_FILE)
+    if not os.path.isfile(meta_file):
+        return None
+
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        files = {var: os.path.join(entry, f'{var}.npy') for var in meta['variables']}
+        if not all(os.path.isfile(fname) for fname in files.values()):
+            raise FileNotFoundError(f'incomplete cache entry: {entry}')
+        data = {var: np.load(fname, mmap_mode=mmap_mode, allow_pickle=False) for var, fname in files.items()}
+    except (OSError, ValueError, KeyError):
+        shutil.rmtree(entry, ignore_errors=True)
+        return None
+
+    # update access time for LRU eviction. entry may be evicted by other process in the meantime
+    meta['accessed'] = time.time()
+    try:
+        _write_meta(entry, meta)
+    except OSError:
+        pass
+
+    return data
+
+
+def save_cache(cache_dir, key, data, source=None):
+    '''
+    Save dictionary of numpy arrays in cache. entry is written in temporary directory and renamed,
+    so that concurrent readers never see partially written entry
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+
+    tmp = tempfile.mkdtemp(prefix=f'.{key}.', dir=cache_dir)
+    try:
+        for var, array in data.items():
+            np.save(os.path.join(tmp, f'{var}.npy'), np.asarray(array), allow_pickle=False)
+        now = time.time()
+        _write_meta(tmp, {'source': source, 'variables': list(data.keys()), 'created': now, 'accessed': now})
+        os.rename(tmp, entry)
+    except OSError:
+        # entry is written by other process in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(entry):
+            raise
+
+
+def list_cache(cache_dir):
+    '''
+    Return list of cache entries, [(key, meta dictionary, size in bytes)], least recently used first
+    '''
+    if not os.path.isdir(cache_dir):
+        return []
+
+    entries = []
+    for key in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, key)
+        meta_file = os.path.join(entry, META_FILE)
+        if key.startswith('.') or not os.path.isfile(meta_file):
+            continue
+        with open(meta_file) as f:
+            meta = json.load(f)
+        size = sum(os.path.getsize(os.path.join(entry, fname)) for fname in os.listdir(entry))
+        entries.append((key, meta, size))
+
+    return sorted(entries, key=lambda e: e[1]['accessed'])
+
+
+def evict_cache(cache_dir, max_entries=None, max_bytes=None):
+    '''
+    Remove least recently used entries until number of entries <= max_entries and total size <= max_bytes
+    return list of removed keys
+    '''
+    entries = list_cache(cache_dir)
+    total = sum(e[2] for e in entries)
+
+    removed = []
+    for key, meta, size in entries:
+        if (max_entries is None or len(entries) - len(removed) <= max_entries) and \
+           (max_bytes is None or total <= max_bytes):
+            break
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+        removed.append(key)
+
+    return removed
+
+
+def clear_cache(cache_dir, source=None):
+    '''
+    Remove all cache entries, or only entries created from mapping file "source"
+    return list of removed keys
+    '''
+    removed = []
+    for key, meta, size in list_cache(cache_dir):
+        if source is None or meta['source'] == os.path.abspath(source):
+            shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+            removed.append(key)
+
+    return removed
+
+
+def _write_meta(entry, meta):
+    tmp = os.path.join(entry, f'.{META_FILE}.{os.getpid()}')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(entry, META_FILE))
@@ -0,0 +1,160 @@
+# Command line batch driver of MPR
+#
+#   load geophysical attributes and mapping data -> transfer functions -> vertical/horizontal scaling -> write
+#
+# e.g.,
+#   mpr -c ./config --workers 8
+#   mpr -c ./config --workers 4 --threads 2 --memory 8GB --profile profile.json
+#   mpr -c ./config --hru-file basin_hru.txt -o basin_param.nc
+#   mpr -c ./config -o shm://mpr_param     # shared memory, read by coupled model with mpr.shared.open_shared_params
+#
+# config directory contains IO.yml, param_meta.yml and tf_coef.yml (each can be given separately).
+# with multiple mapping files (MAP_FILE list or dictionary in IO.yml), one output is written per target.
+# parameters are written as soon as they are computed (see IO.ParamWriter).
+# heavy modules (numpy, xarray, mpr modules) are imported after arguments are parsed, so "mpr --help" is fast.
+
+import os
+import sys
+import argparse
+
+UNITS = {'': 1, 'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+
+def parse_size(size):
+    '''
+    Return number of bytes from string, e.g., "8GB", "512MB", "1e9"
+    '''
+    size = str(size).strip().upper()
+    unit = size.lstrip('0123456789.E+-')
+    if not unit in UNITS:
+        raise argparse.ArgumentTypeError(f'invalid size: {size}')
+    return int(float(size[:len(size)-len(unit)]) * UNITS[unit])
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='mpr', description='Run Multi-scale Parameter Regionalization')
+    parser.add_argument('-c', '--config-dir', default='./config',
+                        help='directory containing IO.yml, param_meta.yml and tf_coef.yml (default: ./config)')
+    parser.add_argument('--io', help='IO config file. <config-dir>/IO.yml if not given')
+    parser.add_argument('--param-meta', help='parameter config file. <config-dir>/param_meta.yml if not given')
+    parser.add_argument('--tf-coef', help='transfer function coefficient file. <config-dir>/tf_coef.yml if not given')
+    parser.add_argument('-o', '--output', help='output file (.nc, .zarr or .mpr memory-mapped file) or shared memory shm://<name>. OUTPUT in IO config if not given. '
+                        'target name is added before extension for multiple mapping files, e.g., param_huc12.nc')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of threads for transfer functions, or processes if --memory or --max-cells is given')
+    parser.add_argument('--threads', type=int, default=1, help='number of threads in each process of tiled run')
+    parser.add_argument('-m', '--memory', type=parse_size, help='memory budget of each tile, e.g., 8GB. enables tiled run')
+    parser.add_argument('--max-cells', type=int, help='maximum number of source grid cells of each tile. enables tiled run')
+    parser.add_argument('--hru', type=int, nargs='+', help='HRU IDs to be computed. all HRUs in mapping file if not given')
+    parser.add_argument('--hru-file', help='text file of HRU IDs to be computed (one per line)')
+    parser.add_argument('--cache-dir', help='cache directory of pre-processed mapping data. CACHE in IO config if not given')
+    parser.add_argument('--no-cache', action='store_true', help='do not use cache of mapping data')
+    parser.add_argument('--pvalue', type=float, default=1.0, help='parameter in generalized mean operator (default: 1.0)')
+    parser.add_argument('--model-thickness', type=float, nargs='+',
+                        help='model layer thickness [m]. layer_thickness: model in param_meta if not given')
+    parser.add_argument('--precision', choices=['float32', 'float64'],
+                        help='storage precision of attributes and parameters. PRECISION in IO config or float32 if not given')
+    parser.add_argument('--kernel', action='store_true', help='evaluate transfer functions with numpy kernels')
+    parser.add_argument('--complevel', type=int, help='compression level of output')
+    parser.add_argument('--profile', help='write per-stage timing report (.json or .csv)')
+    parser.add_argument('--trace-memory', action='store_true', help='record allocated memory in profile (slower)')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+
+    import yaml
+
+    io_file    = args.io or os.path.join(args.config_dir, 'IO.yml')
+    param_file = args.param_meta or os.path.join(args.config_dir, 'param_meta.yml')
+    coef_file  = args.tf_coef or os.path.join(args.config_dir, 'tf_coef.yml')
+
+    for fname in [io_file, param_file, coef_file]:
+        if not os.path.isfile(fname):
+            sys.exit(f'mpr: config file not found: {fname}')
+
+    with open(io_file) as f:
+        io_cfg = yaml.safe_load(f)
+    with open(param_file) as f:
+        cfg = yaml.safe_load(f)
+    with open(coef_file) as f:
+        tf_coef = yaml.safe_load(f)
+
+    from mpr import profiler, precision
+    precision_cfg = io_cfg.get('PRECISION') or {}
+    precision.set_precision(storage=args.precision or precision_cfg.get('STORAGE'), accum=precision_cfg.get('ACCUM'))
+
+    if args.profile:
+        profiler.enable(trace_memory=args.trace_memory)
+
+    try:
+        run(args, io_cfg, cfg, tf_coef)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.write_report(args.profile)
+            profiler.print_summary()
+
+
+def run(args, io_cfg, cfg, tf_coef):
+    from contextlib import ExitStack
+    import numpy as np
+    from mpr.IO import load_geophysical_attributes, load_mapping_data, load_subset, get_map_files, get_output_file, \
+                       get_layer_dims, ParamWriter
+    from mpr.model_layer import comp_layer_weight
+    from mpr.pipeline import run_mpr, run_mpr_tiled, run_mpr_multi
+
+    param_meta = cfg['param']
+    tiled = args.memory is not None or args.max_cells is not None
+
+    if args.no_cache:
+        io_cfg.pop('CACHE', None)
+
+    # multiple targets if MAP_FILE in IO config is list or dictionary (see IO.get_map_files)
+    map_files = get_map_files(io_cfg)
+    multi = list(map_files) != [None]
+
+    hru_ids = args.hru
+    if args.hru_file is not None:
+        hru_ids = list(hru_ids or []) + np.loadtxt(args.hru_file, dtype='int64', ndmin=1).tolist()
+    if hru_ids is not None and multi:
+        sys.exit('mpr: --hru and --hru-file cannot be used with multiple mapping files')
+
+    # attributes are read lazily in tiled run, so that each tile reads its bounding box only
+    chunks = io_cfg['INPUT'].get('CHUNKS') or ({} if tiled else None)
+    cache_dir = None if args.no_cache else args.cache_dir
+    if hru_ids is None:
+        attr_data = load_geophysical_attributes(io_cfg, param_meta=param_meta, chunks=chunks)
+        mapping_data = {target: load_mapping_data(io_cfg, var_list=['polyid', 'overlaps', 'weight', 'i_index', 'j_index'],
+                                                  cache_dir=cache_dir, map_file=map_file)
+                        for target, map_file in map_files.items()}
+    else: # read mapping data of the HRUs and window of attributes covering them only
+        attr_data, subset = load_subset(io_cfg, hru_ids, param_meta=param_meta, chunks=chunks, cache_dir=cache_dir)
+        mapping_data = {None: subset}
+
+    model_thickness = args.model_thickness or cfg['layer_thickness']['model']
+    layer_op = comp_layer_weight(cfg['layer_thickness']['soil'], model_thickness)
+    dim_sizes = {dim: len(model_thickness) for dim in get_layer_dims(param_meta, cfg['hru_meta'])}
+
+    kwargs = {'layer_op': layer_op, 'pvalue': args.pvalue, 'workers': args.workers, 'kernel': args.kernel}
+    if tiled:
+        kwargs.update(threads=args.threads, memory=args.memory, max_cells=args.max_cells)
+
+    with ExitStack() as stack:
+        writers = {}
+        for target, data in mapping_data.items():
+            output = get_output_file(io_cfg, target, output=args.output)
+            print(f'\n Run MPR: {len(data["polyid"])} HRUs -> {output}', flush=True)
+            writers[target] = stack.enter_context(ParamWriter(output, param_meta, data['polyid'], cfg['hru_meta'],
+                                                              dim_sizes=dim_sizes, complevel=args.complevel))
+        if multi:
+            run_mpr_multi(attr_data, mapping_data, param_meta, tf_coef, writers=writers, tiled=tiled, **kwargs)
+        elif tiled:
+            run_mpr_tiled(attr_data, mapping_data[None], param_meta, tf_coef, writer=writers[None], **kwargs)
+        else:
+            run_mpr(attr_data, mapping_data[None], param_meta, tf_coef, writer=writers[None], **kwargs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# Batched ensemble evaluation of transfer function coefficients (e.g., for calibration)
+#
+# ---- convention
+# coefficient array: [nEnsemble x nCoef] numpy array
+# coef_names:        list of (parameter name, index in tf_coef list) of each column, see get_coef_names
+#
+# each coefficient is given to transfer functions as xarray DataArray with ensemble dimension (ENS_DIM),
+# so that all ensemble members are computed in one vectorized pass via xarray broadcasting.
+# parameters are returned with leading ensemble axis, [nEnsemble, (lyr), hru]
+
+import numpy as np
+import xarray as xr
+
+from mpr.precision import get_dtype
+from mpr.scaling import FILL_VALUE, comp_remap_operator
+from mpr.scheduler import run_transfer_functions
+from mpr.pipeline import CELL_DIM, ENS_DIM, get_spatial_dims, gather_attributes, scale_param
+
+
+def get_coef_names(tf_coef, param_meta=None):
+    '''
+    Return list of (parameter name, coefficient index) of all the coefficients in tf_coef
+    only parameters with compute: True are included if param_meta is given
+    '''
+    names = []
+    for par, coef in tf_coef.items():
+        if not coef:
+            continue
+        if param_meta is not None and not (par in param_meta and param_meta[par]['compute']):
+            continue
+        names += [(par, k) for k in range(len(coef))]
+    return names
+
+
+def get_coef_array(tf_coef, coef_names):
+    '''
+    Return coefficient vector [nCoef] of tf_coef, in order of coef_names, in storage precision (see precision.py)
+    '''
+    return np.array([tf_coef[par][k] for par, k in coef_names], dtype=get_dtype())
+
+
+def ensemble_coef(tf_coef, coef_names, coef_array):
+    '''
+    Return copy of tf_coef where coefficients in coef_names are replaced with DataArray [ens] of coef_array columns
+    coefficients are cast to storage precision, so that ensemble members are computed in the same precision as
+    scalar coefficients in run_mpr
+    '''
+    coef_array = np.atleast_2d(coef_array).astype(get_dtype(), copy=False)
+    if coef_array.shape[1] != len(coef_names):
+        raise ValueError('number of coefficients (%d) does not match coef_names (%d)' % (coef_array.shape[1], len(coef_names)))
+
+    coef = {par: (list(val) if val else val) for par, val in tf_coef.items()}
+    for j, (par, k) in enumerate(coef_names):
+        coef[par][k] = xr.DataArray(coef_array[:, j], dims=ENS_DIM)
+
+    return coef
+
+
+def run_ensemble(attr_data, mapping_data, param_meta, tf_coef, coef_array, coef_names=None, layer_op=None, pvalue=1.0,
+                 workers=1, batch_size=None, remap_op=None, spatial_dims=None, default=FILL_VALUE):
+    '''
+    Compute model parameters at target HRUs for ensemble of transfer function coefficients
+
+    input:  attr_data,    xarray dataset, geophysical attributes [..., lat, lon] or gathered attributes [..., cell]
+                          (see pipeline.gather_attributes). pass gathered attributes to share them across calls
+            mapping_data, dictionary, mapping data (not used if remap_op is given)
+            param_meta,   dictionary, parameter config (['param'] in param_meta.yml)
+            tf_coef,      dictionary, transfer function coefficient (tf_coef.yml). used for coefficients not in coef_names
+            coef_array,   numpy array, [nEnsemble x nCoef]
+            coef_names,   list of (parameter name, coefficient index) of coef_array columns. get_coef_names(tf_coef, param_meta) if None
+            batch_size,   number of ensemble members computed at once. all members if None
+            others,       see pipeline.run_mpr
+    return: dictionary, {parameter name: numpy array [nEnsemble, (lyr), hru]} for parameters with write: True
+    '''
+    if coef_names is None:
+        coef_names = get_coef_names(tf_coef, param_meta)
+    coef_array = np.atleast_2d(coef_array)
+    nEns = coef_array.shape[0]
+
+    if not CELL_DIM in attr_data.dims:
+        if spatial_dims is None:
+            spatial_dims = get_spatial_dims(attr_data)
+        if remap_op is None:
+            remap_op = comp_remap_operator(mapping_data, tuple(attr_data.sizes[dim] for dim in spatial_dims))
+        attr_data = gather_attributes(attr_data, remap_op, spatial_dims=spatial_dims).load()
+    elif remap_op is None:
+        raise ValueError('remap_op is required for gathered attributes')
+
+    if batch_size is None:
+        batch_size = nEns
+
+    out_data = {}
+    for start in range(0, nEns, batch_size):
+        batch = coef_array[start:start+batch_size]
+
+        def _scale(name, native):
+            array = scale_param(native, param_meta[name], remap_op, layer_op=layer_op, pvalue=pvalue, default=default)
+            if not (isinstance(native, xr.DataArray) and ENS_DIM in native.dims):
+                array = np.broadcast_to(array, (len(batch), *array.shape))  # parameter independent of coefficients
+            return array
+
+        result = run_transfer_functions(attr_data, param_meta, ensemble_coef(tf_coef, coef_names, batch),
+                                        workers=workers, post=_scale)
+        for par, array in result.items():
+            out_data.setdefault(par, []).append(array)
+
+    return {par: np.concatenate(arrays, axis=0) for par, arrays in out_data.items()}
@@ -0,0 +1,163 @@
+# Forward-mode derivatives of model parameters w.r.t. transfer function coefficients (e.g., for calibration)
+#
+# ---- convention
+# coef_names: list of (parameter name, index in tf_coef list) of coefficients, see ensemble.get_coef_names
+# tangents:   [nDir x nCoef] numpy array, direction of coefficient perturbation. identity (Jacobian) if None
+#
+# tangents are propagated with parameters through transfer functions (see transfer_function.transfer_jvp),
+# vertical and horizontal generalized means (see scaling.vertical_weighted_mean_jvp and sparse_weighted_mean_jvp),
+# so that derivatives of all the parameters in all the directions are obtained in one MPR pass.
+# derivatives are returned with leading direction axis, [nDir, (stat), (lyr), hru]
+#
+# e.g.,
+#   param_data, jvp_data = run_mpr_jvp(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+#   jvp_data['k_soil'][j]   # d k_soil / d coefficient coef_names[j]
+
+import numpy as np
+import xarray as xr
+
+from mpr.scaling import FILL_VALUE, comp_remap_operator, gather_cells, parse_stat, vertical_weighted_mean, \
+                        sparse_weighted_mean_jvp, vertical_weighted_mean_jvp
+from mpr.scheduler import build_param_graph, topological_order, get_downstream
+from mpr.transfer_function import get_transfer_function, get_transfer_jvp, has_transfer_jvp
+from mpr.pipeline import CELL_DIM, get_spatial_dims, gather_attributes, scale_param, _is_grid_layer_op
+from mpr.ensemble import get_coef_names
+from mpr.precision import as_storage, get_dtype
+from mpr.profiler import traced, span
+
+
+@traced()
+def run_mpr_jvp(attr_data, mapping_data, param_meta, tf_coef, tangents=None, coef_names=None, layer_op=None, pvalue=1.0,
+                kernel=False, remap_op=None, spatial_dims=None, default=FILL_VALUE):
+    '''
+    Compute model parameters at target HRUs and their Jacobian-vector products w.r.t. transfer function coefficients
+
+    input:  attr_data,    xarray dataset, geophysical attributes [..., lat, lon] or gathered attributes [..., cell]
+                          (see pipeline.gather_attributes)
+            tangents,     numpy array, [nDir x nCoef] directions in coefficient space. identity matrix if None
+            coef_names,   list of (parameter name, coefficient index) of tangents columns. get_coef_names(tf_coef, param_meta) if None
+            others,       see pipeline.run_mpr
+    return: dictionary, {parameter name: numpy array [(lyr), hru]} for parameters with write: True (same as run_mpr)
+            dictionary, {parameter name: numpy array [nDir, (lyr), hru]} derivatives in accumulation precision
+
+    horizontal scaling supports generalized means only (horizontal_stat of mean, amean, gmean, hmean or pmean:<p>).
+    raise ValueError if derivative of transfer function of any parameter with compute: True is not defined
+    (see transfer_function.transfer_jvp), or horizontal_stat of any parameter to be written is not generalized mean,
+    before anything is computed
+    '''
+    unsupported = [par for par, meta in param_meta.items() if meta['compute'] and not has_transfer_jvp(meta['tf'])]
+    if unsupported:
+        raise ValueError(f'derivatives of transfer functions are not defined for parameters: {unsupported}. '
+                         'set compute: False for them')
+    for par, meta in param_meta.items():
+        if meta['compute'] and meta.get('write', True):
+            try:
+                _jvp_stats(meta, pvalue)
+            except ValueError as e:
+                raise ValueError(f'parameter "{par}": {e}') from None
+
+    if coef_names is None:
+        coef_names = get_coef_names(tf_coef, param_meta)
+    if tangents is None:
+        tangents = np.eye(len(coef_names))
+    tangents = np.atleast_2d(np.asarray(tangents, dtype=get_dtype('accum')))
+    nDir = tangents.shape[0]
+    if tangents.shape[1] != len(coef_names):
+        raise ValueError('number of coefficients (%d) does not match coef_names (%d)' % (tangents.shape[1], len(coef_names)))
+
+    if not CELL_DIM in attr_data.dims:
+        if spatial_dims is None:
+            spatial_dims = get_spatial_dims(attr_data)
+        if remap_op is None:
+            remap_op = comp_remap_operator(mapping_data, tuple(attr_data.sizes[dim] for dim in spatial_dims))
+        attr_data = gather_attributes(attr_data, remap_op, spatial_dims=spatial_dims)
+    elif remap_op is None:
+        raise ValueError('remap_op is required for gathered attributes')
+    if _is_grid_layer_op(layer_op):
+        layer_op = gather_cells(remap_op, layer_op)
+
+    # tangent of each coefficient [nDir], None if zero in all the directions
+    dcoef_dir = {}
+    for j, name in enumerate(coef_names):
+        if np.any(tangents[:, j] != 0):
+            dcoef_dir[name] = tangents[:, j]
+
+    graph = build_param_graph(param_meta)
+    downstream = get_downstream(graph)
+    nConsumer = {par: len(downstream[par]) for par in graph}
+
+    param_data, dparam = {}, {}
+    out_data, jvp_data = {}, {}
+    for par in topological_order(graph):
+        meta = param_meta[par]
+        coef = tf_coef.get(par) or []
+        with span(f'tf:{par}', tf=meta['tf']):
+            native = as_storage(get_transfer_function(meta['tf'], kernel=kernel)(attr_data=attr_data, param_data=param_data,
+                                                                                 param_cfg=meta, coef=coef))
+            if isinstance(native, xr.DataArray): # same order of dimensions as numpy arrays in transfer_jvp
+                native = native.transpose(..., CELL_DIM)
+        with span(f'jvp:{par}', tf=meta['tf']):
+            shape = (nDir,) + (1,)*np.ndim(native)
+            dcoef = [dcoef_dir[(par, k)].reshape(shape) if (par, k) in dcoef_dir else None for k in range(len(coef))]
+            tangent = get_transfer_jvp(meta['tf'])(attr_data=attr_data, param_data=param_data, param_cfg=meta, coef=coef,
+                                                   dparam={dep: dparam[dep] for dep in graph[par]}, dcoef=dcoef)
+            if tangent is not None:
+                tangent = np.broadcast_to(tangent, (nDir, *np.shape(native)))
+
+        if meta.get('write', True):
+            with span(f'scale:{par}'):
+                out_data[par] = scale_param(native, meta, remap_op, layer_op=layer_op, pvalue=pvalue, default=default)
+                if tangent is None: # parameter independent of coefficients
+                    missing = np.isnan(out_data[par]) | (out_data[par] == default)
+                    jvp_data[par] = np.broadcast_to(np.where(missing, out_data[par], 0.0).astype(get_dtype('accum')),
+                                                    (nDir, *np.shape(out_data[par])))
+                else:
+                    jvp_data[par] = scale_param_jvp(native, tangent, meta, remap_op, layer_op=layer_op, pvalue=pvalue,
+                                                    default=default)
+
+        param_data[par], dparam[par] = native, tangent
+
+        # release native parameter and tangent if downstream parameters are all computed
+        for dep in graph[par]:
+            nConsumer[dep] -= 1
+            if nConsumer[dep] == 0:
+                param_data.pop(dep, None)
+                dparam.pop(dep, None)
+
+    return out_data, jvp_data
+
+
+def scale_param_jvp(native, tangent, param_cfg, remap_op, layer_op=None, pvalue=1.0, default=FILL_VALUE):
+    '''
+    Vertical and horizontal scaling of tangent of gathered native parameter (see pipeline.scale_param)
+
+    input:  native,  native parameter, [(lyr), cell]
+            tangent, tangent of native parameter, numpy array [nDir, (lyr), cell]
+    return: numpy array, [nDir, (stat), (lyr), hru] in accumulation precision
+    '''
+    stat, stats = _jvp_stats(param_cfg, pvalue)
+
+    array = np.asarray(native)
+    dArray = tangent
+
+    if param_cfg['vertical_scale']:
+        if layer_op is None:
+            raise ValueError('layer weight (layer_op) is required for vertical scaling')
+        dArray = vertical_weighted_mean_jvp(layer_op, array, dArray, pvalue, default=default)
+        array = vertical_weighted_mean(layer_op, array, pvalue, default=default)
+
+    if param_cfg['horizontal_scale']:
+        dArrays = [sparse_weighted_mean_jvp(remap_op['matrix'], array, dArray, p, default=default) for _, p in stats]
+        dArray = np.stack(dArrays, axis=1) if isinstance(stat, list) else dArrays[0]
+
+    return dArray
+
+
+def _jvp_stats(param_cfg, pvalue):
+    # horizontal_stat of parameter and list of (kind, p) of its statistics (see scaling.parse_stat).
+    # raise ValueError if any statistic is not generalized mean
+    stat = param_cfg.get('horizontal_stat') if param_cfg['horizontal_scale'] else None
+    stats = [parse_stat(s, pvalue) for s in ([stat] if isinstance(stat, str) else stat or ['mean'])]
+    if any(kind != 'pmean' for kind, _ in stats):
+        raise ValueError(f'derivative of horizontal statistics {stat} is not supported, generalized means only')
+    return stat, stats
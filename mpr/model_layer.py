@@ -3,64 +3,94 @@ import numpy as np
 
 def comp_layer_weight(soil_thickness, model_thickness):
 
-    #-- Compute for depths to 1)top and 2) bottom of soil and model layer
-    
-    nMlyr = len(model_thickness)
-    
-    soil_bot = np.cumsum(soil_thickness)
-    model_bot = np.cumsum(model_thickness)
+    #-- Compute layer mapping data (padded soil layer index and weight for each model layer)
+    #   mapping_data['overlaps']   [nMlyr]           number of soil layers intersecting model layer
+    #   mapping_data['soil_index'] [nMlyr x maxSlyr] index of intersecting soil layers
+    #   mapping_data['weight']     [nMlyr x maxSlyr] weight of intersecting soil layers
 
-    model_top = shift(model_bot, 1, fill_value=0)
-    soil_top  = shift(soil_bot, 1, fill_value=0)
+    operator = comp_layer_weight_array(soil_thickness, model_thickness)
+    if operator.ndim != 2:
+        raise ValueError('comp_layer_weight supports single soil and model layer profile. use comp_layer_weight_array')
 
-    #-- Compute index of soil layer where top of model layer is located
-    idxTop = np.zeros(len(model_thickness), dtype='int32')
-    idxBot = np.zeros(len(model_thickness), dtype='int32')
+    overlap  = operator > 0
+    overlaps = overlap.sum(axis=1).astype('int32')
+    maxSlyr  = max(overlaps.max(), 1)
 
-    for ixm in range(nMlyr):
-        for ixs in range(len(soil_thickness)):
-            if model_top[ixm] < soil_bot[ixs]:
-                idxTop[ixm] = ixs
-                break
+    # soil layer index of intersecting soil layers first, in order from the top
+    order = np.argsort(~overlap, axis=1, kind='stable')[:, :maxSlyr]
+    valid = np.arange(maxSlyr) < overlaps[:, np.newaxis]
 
-    #-- Compute index of soil layer where the bottom of model layer is located
-    for ixm in range(nMlyr):
-        for ixs in range(len(soil_thickness)):
-            if model_bot[ixm] < soil_bot[ixs]:
-                idxBot[ixm] = ixs
-                break
-
-    maxSlyr = (idxBot-idxTop+1).max()
-    mapping_data = {'overlaps':   np.zeros(nMlyr, dtype='int32'),
-                    'soil_index': np.zeros((nMlyr, maxSlyr), dtype='int32'),
-                    'weight' :    np.zeros((nMlyr, maxSlyr), dtype='float32'),
+    mapping_data = {'overlaps':   overlaps,
+                    'soil_index': np.where(valid, order, 0).astype('int32'),
+                    'weight' :    np.where(valid, np.take_along_axis(operator, order, axis=1), 0).astype('float32'),
                    }
 
-    for ixm in range(len(model_thickness)):
-
-        if idxTop[ixm] == idxBot[ixm]: # if model layer is completely within soil layer
-            mapping_data['overlaps'][ixm]      = 1
-            mapping_data['soil_index'][ixm, 0] = ixs
-            mapping_data['weight'][ixm, 0]     = 1.0
-            continue
-
-        # loop frm the upper most soil layer to the lowest soil layer that intersect current model layer
-        counter = 0
-        for ixs in range(idxTop[ixm], idxBot[ixm]+1):
-            # if model layer contains multiple soil layers
-            if ixs == idxTop[ixm]:           # for the upper most soil layer that intersect model layer
-                mapping_data['weight'][ixm, counter] = (soil_bot[ixs] - model_top[ixm])/model_thickness[ixm]
-            elif ixs == idxBot[ixm]:         # for the lowest soil layer that intersect model layer
-                mapping_data['weight'][ixm, counter] = (model_bot[ixm] - soil_top[ixs])/model_thickness[ixm]
-            else:                            # for soil layers that completely in model layer
-                mapping_data['weight'][ixm, counter] = soil_thickness[ixs]/model_thickness[ixm]
-            mapping_data['soil_index'][ixm, counter] = ixs
-            counter += 1
-        mapping_data['overlaps'][ixm]      = counter
-        
     return mapping_data
 
 
+def comp_layer_weight_array(soil_thickness, model_thickness, dtype='float32'):
+    '''
+    Compute layer operator, weight of each soil layer in each model layer, from layer thickness
+
+    input:  soil_thickness,  [nSlyr], or [nSlyr, ...] for per-cell soil layer thickness (e.g., limited by depth to bedrock)
+            model_thickness, [nMlyr], or [nMlyr, ...] for per-cell model layer thickness
+    return: operator,        [nMlyr x nSlyr] if both are 1D, otherwise [nMlyr x nSlyr x ...]
+
+    weight[m, s] = thickness of soil layer s within model layer m / thickness of model layer m covered by soil layers
+    so that weights sum to 1 in model layers partially below soil layers (e.g., shallow depth to bedrock).
+    model layers below soil layers have zero weights, and get default value in vertical scaling
+    per-cell dimensions (...) should match spatial dimensions of parameter array, [lat, lon] or [cell]
+    '''
+    soil  = np.asarray(soil_thickness, dtype='float64')
+    model = np.asarray(model_thickness, dtype='float64')
+
+    spatial_shape = np.broadcast_shapes(soil.shape[1:], model.shape[1:])
+    soil  = _expand_profile(soil, spatial_shape)
+    model = _expand_profile(model, spatial_shape)
+
+    #-- depths to 1)top and 2) bottom of soil and model layer
+    soil_bot  = np.cumsum(soil, axis=0)
+    model_bot = np.cumsum(model, axis=0)
+    soil_top  = soil_bot - soil
+    model_top = model_bot - model
+
+    #-- thickness of intersection between all the pairs of model and soil layers [nMlyr x nSlyr x ...]
+    overlap = np.minimum(model_bot[:, np.newaxis], soil_bot[np.newaxis, :]) - \
+              np.maximum(model_top[:, np.newaxis], soil_top[np.newaxis, :])
+
+    # slivers from rounding error of cumulative depths (e.g., 0.1+0.2 vs 0.3) are not overlap
+    depth   = np.maximum(soil_bot[-1], model_bot[-1])
+    overlap = np.where(overlap > 1e-9*depth, overlap, 0.0)
+    covered = overlap.sum(axis=1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(overlap > 0, overlap/covered, 0.0)
+
+    return weight.astype(dtype)
+
+
+def comp_layer_operator(mapping_data, nSlyr=None):
+    '''
+    Convert layer mapping data from comp_layer_weight to dense operator [nMlyr x nSlyr]
+    operator[m, s] is weight of soil layer s in model layer m
+    '''
+    nMlyr = len(mapping_data['overlaps'])
+    if nSlyr is None:
+        nSlyr = mapping_data['soil_index'].max()+1 if mapping_data['soil_index'].size > 0 else 0
+
+    operator = np.zeros((nMlyr, nSlyr), dtype='float64')
+    for ixm in range(nMlyr):
+        n = mapping_data['overlaps'][ixm]
+        np.add.at(operator[ixm], mapping_data['soil_index'][ixm, :n], mapping_data['weight'][ixm, :n])
+
+    return operator
+
+
+def _expand_profile(a, spatial_shape):
+    # [nLyr, (per-cell dims)] -> [nLyr, 1, .., 1, (per-cell dims)] broadcastable to [nLyr, *spatial_shape]
+    return a.reshape(a.shape[0], *([1]*(len(spatial_shape)-(a.ndim-1))), *a.shape[1:])
+
+
 def shift(arr, num, fill_value=np.nan):
     result = np.empty_like(arr)
     if num > 0:
@@ -0,0 +1,367 @@
+# MPR workflow: transfer functions -> vertical scaling -> horizontal scaling
+#
+# ---- fused mode (default)
+# geophysical attributes are gathered to the source grid cells referenced in mapping data (i_index/j_index)
+# before transfer function evaluation, so that parameters are never materialized on the full native grid,
+#   attribute [..., lat, lon] -> [..., cell] -> transfer function -> vertical scaling -> horizontal scaling [..., hru]
+# domain statistics in transfer functions (e.g., domain mean in norm_prec_tf1, see transfer_function.DOMAIN_STAT)
+# are computed over the full source grid before gathering, so results are identical to full grid evaluation.
+#
+# ---- tiled mode (run_mpr_tiled)
+# target HRUs are partitioned into tiles whose source cell bounding box fits memory budget,
+# and each tile is processed in process pool. results are identical to fused mode in any storage precision
+# (precision policy is passed to worker processes, see precision.py).
+#
+# ---- multiple targets (run_mpr_multi)
+# remapping operators of several target discretizations are stacked into one operator, so that source side work
+# (gathering, transfer functions, vertical scaling) is done once, and parameters are split into targets.
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import xarray as xr
+
+from mpr.scaling import FILL_VALUE, comp_remap_operator, combine_remap_operators, subset_remap_operator, get_footprint, \
+                        gather_cells, sparse_weighted_mean, sparse_weighted_stats, vertical_weighted_mean
+from mpr.scheduler import run_transfer_functions
+from mpr.transfer_function import add_derived_attributes, add_domain_statistics
+from mpr.profiler import traced
+from mpr.precision import get_policy, precision_policy, as_storage
+
+CELL_DIM = 'cell'
+ENS_DIM  = 'ens'
+
+TEMP_FACTOR = 4
+
+
+def get_spatial_dims(attr_data):
+    '''
+    Return names of spatial dimensions (lat, lon) of geophysical attributes, the last two dimensions of data variables
+    '''
+    for var in attr_data.data_vars:
+        if attr_data[var].ndim >= 2:
+            return attr_data[var].dims[-2:]
+    raise ValueError('geophysical attributes do not have 2D variables')
+
+
+@traced()
+def gather_attributes(attr_data, remap_op, spatial_dims=None):
+    '''
+    Gather geophysical attributes at source grid cells referenced in remap_op
+
+    input:  attr_data,    xarray dataset, [..., lat, lon]
+            remap_op,     remapping operator (see scaling.comp_remap_operator)
+            spatial_dims, names of spatial dimensions. inferred from attr_data if None
+    return: xarray dataset, [..., cell] (loaded in memory, storage precision), with derived attributes (see transfer_function.DERIVED_ATTR)
+            computed if not in attr_data yet, and domain statistics (see transfer_function.DOMAIN_STAT) computed over
+            all the cells of attr_data if not in attr_data yet
+    '''
+    if spatial_dims is None:
+        spatial_dims = get_spatial_dims(attr_data)
+
+    j_index, i_index = np.unravel_index(remap_op['cell_index'], remap_op['grid_shape'])
+
+    gathered = add_domain_statistics(as_storage(attr_data)).isel({spatial_dims[0]: xr.DataArray(j_index, dims=CELL_DIM),
+                               spatial_dims[1]: xr.DataArray(i_index, dims=CELL_DIM)})
+
+    # load in C order. reductions in transfer functions (e.g., domain mean) depend on memory layout,
+    # which differs between lazily loaded and in-memory source data
+    gathered = gathered.map(lambda da: da.copy(data=np.asarray(da.values, order='C')))
+
+    return add_derived_attributes(gathered)
+
+
+def scale_param(native, param_cfg, remap_op, layer_op=None, pvalue=1.0, gathered=True, spatial_dims=None, default=FILL_VALUE):
+    '''
+    Vertical and horizontal scaling of native resolution parameter
+
+    input:  native,    native resolution parameter, [(lyr), cell] if gathered else [(lyr), lat, lon]
+            param_cfg, dictionary, parameter config (see param_meta.yml)
+            remap_op,  remapping operator (see scaling.comp_remap_operator)
+            layer_op,  layer operator or vertical mapping data (see model_layer)
+            pvalue,    parameter in generalized mean operator
+    return: numpy array, [(lyr), hru], or [ens, (lyr), hru] if native has ensemble dimension (see ensemble.py)
+
+    horizontal_stat in param_cfg (optional) selects horizontal statistics instead of generalized mean with pvalue,
+    statistic name (e.g., hmean) or list of names (e.g., [hmean, gmean, amean, std]) stacked in first dimension
+    (see scaling.sparse_weighted_stats)
+    '''
+    ensemble = False
+    if isinstance(native, xr.DataArray):
+        if gathered:
+            ensemble = ENS_DIM in native.dims
+            native = native.transpose(..., ENS_DIM, CELL_DIM) if ensemble else native.transpose(..., CELL_DIM)
+        elif spatial_dims is not None:
+            native = native.transpose(..., *spatial_dims)
+    array = np.asarray(native)
+
+    if param_cfg['vertical_scale']:
+        if layer_op is None:
+            raise ValueError('layer weight (layer_op) is required for vertical scaling')
+        array = vertical_weighted_mean(layer_op, array, pvalue, default=default)
+
+    if param_cfg['horizontal_scale']:
+        if not gathered:
+            array = gather_cells(remap_op, array)
+        stat = param_cfg.get('horizontal_stat')
+        if stat is None:
+            array = sparse_weighted_mean(remap_op['matrix'], array, pvalue, default=default)
+        else: # statistics from one gather, [stat, (lyr), hru], or [(lyr), hru] for single statistic name
+            array = sparse_weighted_stats(remap_op['matrix'], array, [stat] if isinstance(stat, str) else stat, pvalue=pvalue, default=default)
+            if isinstance(stat, str):
+                array = array[0]
+
+    if ensemble: # [(stat), (lyr), ens, hru] -> [ens, (stat), (lyr), hru]
+        array = np.moveaxis(array, -2, 0)
+
+    return array
+
+
+@traced()
+def run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=None, pvalue=1.0, workers=1,
+            fused=True, remap_op=None, spatial_dims=None, param_data=None, writer=None, kernel=False, default=FILL_VALUE):
+    '''
+    Compute model parameters at target HRUs
+
+    input:  attr_data,    xarray dataset, geophysical attributes (see IO.load_geophysical_attributes)
+            mapping_data, dictionary, mapping data (see IO.load_mapping_data)
+            param_meta,   dictionary, parameter config (['param'] in param_meta.yml)
+            tf_coef,      dictionary, transfer function coefficient (tf_coef.yml)
+            layer_op,     layer operator or vertical mapping data (see model_layer)
+            pvalue,       parameter in generalized mean operator
+            workers,      number of threads for transfer function evaluation
+            fused,        True: evaluate transfer functions only at source cells referenced in mapping data
+            remap_op,     remapping operator. built from mapping_data if None
+            param_data,   dictionary, (optional) native parameters already computed. these are not recomputed
+            writer,       (optional) IO.ParamWriter. parameters are written as soon as they are computed and not returned
+            kernel,       True: evaluate transfer functions with numpy kernels (see transfer_function.transfer_kernel)
+    return: dictionary, {parameter name: numpy array [(lyr), hru]} for parameters with write: True
+    '''
+    if spatial_dims is None:
+        spatial_dims = get_spatial_dims(attr_data)
+
+    if remap_op is None:
+        grid_shape = tuple(attr_data.sizes[dim] for dim in spatial_dims)
+        remap_op = comp_remap_operator(mapping_data, grid_shape)
+
+    if fused:
+        attr_data = gather_attributes(attr_data, remap_op, spatial_dims=spatial_dims)
+        if _is_grid_layer_op(layer_op): # per-cell layer operator [nMlyr x nSlyr x lat x lon] -> [nMlyr x nSlyr x cell]
+            layer_op = gather_cells(remap_op, layer_op)
+    else:
+        attr_data = as_storage(attr_data)
+
+    def _scale(name, native):
+        array = scale_param(native, param_meta[name], remap_op, layer_op=layer_op, pvalue=pvalue,
+                            gathered=fused, spatial_dims=spatial_dims, default=default)
+        if writer is not None:
+            writer.write(name, array)
+            return None
+        return array
+
+    out_data = run_transfer_functions(attr_data, param_meta, tf_coef, workers=workers, post=_scale, param_data=param_data,
+                                      kernel=kernel)
+
+    # scale parameters given in param_data
+    for par, native in (param_data or {}).items():
+        if param_meta[par]['compute'] and param_meta[par].get('write', True) and not par in out_data:
+            out_data[par] = _scale(par, native)
+
+    return {par: array for par, array in out_data.items() if array is not None}
+
+
+@traced()
+def run_mpr_multi(attr_data, mapping_data, param_meta, tf_coef, writers=None, tiled=False, remap_ops=None, spatial_dims=None,
+                  **kwargs):
+    '''
+    Compute model parameters at multiple target discretizations (e.g., HUC12, HUC10, grid) in one pass
+
+    input:  attr_data,    xarray dataset, geophysical attributes (see IO.load_geophysical_attributes)
+            mapping_data, dictionary, {target name: mapping data} (see IO.load_mapping_data and IO.get_map_files)
+            writers,      (optional) dictionary, {target name: IO.ParamWriter}. parameters are written and not returned
+            tiled,        True: run in tiles (run_mpr_tiled), otherwise run_mpr
+            remap_ops,    (optional) dictionary, {target name: remapping operator}. built from mapping_data if None
+            kwargs,       passed to run_mpr or run_mpr_tiled, e.g., layer_op, pvalue, workers
+    return: dictionary, {target name: {parameter name: numpy array [(lyr), hru]}}
+
+    remapping operators are stacked over union of their source grid cells (see scaling.combine_remap_operators),
+    so that attributes are gathered and transfer functions and vertical scaling are evaluated once for all the targets.
+    domain statistics (see transfer_function.DOMAIN_STAT) are computed over entire source grid, not over the union,
+    so parameters of each target are identical to those of single target run.
+    '''
+    if spatial_dims is None:
+        spatial_dims = get_spatial_dims(attr_data)
+
+    if remap_ops is None:
+        grid_shape = tuple(attr_data.sizes[dim] for dim in spatial_dims)
+        remap_ops = {target: comp_remap_operator(data, grid_shape) for target, data in mapping_data.items()}
+    targets = list(remap_ops)
+    remap_op, offsets = combine_remap_operators([remap_ops[target] for target in targets])
+
+    writer = None
+    if writers is not None:
+        writer = MultiTargetWriter([writers[target] for target in targets], offsets)
+
+    run = run_mpr_tiled if tiled else run_mpr
+    out_data = run(attr_data, None, param_meta, tf_coef, remap_op=remap_op, spatial_dims=spatial_dims, writer=writer, **kwargs)
+
+    return {target: {par: array[..., offsets[t]:offsets[t+1]] for par, array in out_data.items()}
+            for t, target in enumerate(targets)}
+
+
+class MultiTargetWriter():
+    '''
+    Split parameters of stacked remapping operator (see scaling.combine_remap_operators) into writers of each target.
+    same interface as IO.ParamWriter.write
+
+    input:  writers, list of IO.ParamWriter of targets
+            offsets, numpy array [nTarget+1], HRUs of target t are in [offsets[t]:offsets[t+1]]
+    '''
+
+    def __init__(self, writers, offsets):
+        self.writers = writers
+        self.offsets = offsets
+
+    def write(self, name, data, hru_index=None):
+        data = np.asarray(data)
+        for writer, start, stop in zip(self.writers, self.offsets[:-1], self.offsets[1:]):
+            if hru_index is None:
+                writer.write(name, data[..., start:stop])
+                continue
+            hru_index = np.asarray(hru_index)
+            use = (hru_index >= start) & (hru_index < stop)
+            if use.any():
+                writer.write(name, data[..., use], hru_index=hru_index[use]-start)
+
+
+def partition_hrus(remap_op, max_cells):
+    '''
+    Partition target HRUs into tiles whose bounding box of source grid cells has max_cells cells or less
+
+    HRUs are ordered by center of their bounding box (row-major) and grouped greedily.
+    HRU whose bounding box alone is larger than max_cells becomes single tile.
+    HRUs without overlap are added to the last tile.
+
+    return: list of numpy arrays, index of HRUs in each tile
+    '''
+    matrix   = remap_op['matrix']
+    has_data = np.diff(matrix.indptr) > 0
+    hru      = np.nonzero(has_data)[0]
+
+    if len(hru) == 0:
+        return [np.arange(matrix.shape[0])]
+
+    j_index, i_index = np.unravel_index(remap_op['cell_index'][matrix.indices], remap_op['grid_shape'])
+    starts = matrix.indptr[:-1][has_data]
+    jmin, jmax = np.minimum.reduceat(j_index, starts), np.maximum.reduceat(j_index, starts)
+    imin, imax = np.minimum.reduceat(i_index, starts), np.maximum.reduceat(i_index, starts)
+
+    tiles   = []
+    current = []
+    for k in np.lexsort(((imin+imax)//2, (jmin+jmax)//2)):
+        if current:
+            box = (min(box[0], jmin[k]), max(box[1], jmax[k]), min(box[2], imin[k]), max(box[3], imax[k]))
+            if (box[1]-box[0]+1)*(box[3]-box[2]+1) > max_cells:
+                tiles.append(current)
+                current = []
+        if not current:
+            box = (jmin[k], jmax[k], imin[k], imax[k])
+        current.append(hru[k])
+    tiles.append(current)
+
+    tiles[-1] += list(np.nonzero(~has_data)[0])
+
+    return [np.sort(np.asarray(tile, dtype='int64')) for tile in tiles]
+
+
+@traced()
+def run_mpr_tiled(attr_data, mapping_data, param_meta, tf_coef, layer_op=None, pvalue=1.0, workers=1, threads=1,
+                  memory=None, max_cells=None, remap_op=None, spatial_dims=None, writer=None, kernel=False, default=FILL_VALUE):
+    '''
+    Compute model parameters at target HRUs, tile by tile in process pool
+
+    input:  same as run_mpr, and
+            workers,   number of processes
+            threads,   number of threads for transfer function evaluation in each process
+            memory,    memory budget of each tile [byte]. used to compute max_cells if max_cells is None
+            max_cells, maximum number of source grid cells in bounding box of tile
+            writer,    (optional) IO.ParamWriter. parameters of each tile are written as soon as tile is done and not returned
+    return: dictionary, {parameter name: numpy array [(lyr), hru]} for parameters with write: True
+
+    attr_data should be lazily loaded (see IO.load_geophysical_attributes), so that each process
+    reads only bounding box of its tile. domain statistics (see transfer_function.DOMAIN_STAT) are computed
+    over entire domain first, then passed to tiles.
+    results are identical to run_mpr (fused mode).
+    '''
+    if spatial_dims is None:
+        spatial_dims = get_spatial_dims(attr_data)
+
+    if remap_op is None:
+        grid_shape = tuple(attr_data.sizes[dim] for dim in spatial_dims)
+        remap_op = comp_remap_operator(mapping_data, grid_shape)
+
+    if max_cells is None:
+        if memory is None:
+            raise ValueError('either memory or max_cells is required')
+        max_cells = max(1, int(memory // _bytes_per_cell(attr_data, spatial_dims)))
+
+    attr_data = add_domain_statistics(as_storage(attr_data))
+
+    # prepare tiles
+    tasks = []
+    for hru_index in partition_hrus(remap_op, max_cells):
+        tile_op = subset_remap_operator(remap_op, hru_index)
+        window = get_footprint(tile_op)
+        tile_op = subset_remap_operator(tile_op, np.arange(len(hru_index)), window=window)
+
+        tile_attr = attr_data.isel({spatial_dims[0]: window[0], spatial_dims[1]: window[1]})
+        tile_layer = layer_op[..., window[0], window[1]] if _is_grid_layer_op(layer_op) else layer_op
+        tasks.append((hru_index, (tile_attr, tile_op, param_meta, tf_coef, tile_layer, pvalue, threads,
+                                  spatial_dims, kernel, get_policy(), default)))
+
+    nHRU = remap_op['matrix'].shape[0]
+    out_data = {}
+
+    def _collect(hru_index, result):
+        for par, array in result.items():
+            if writer is not None:
+                writer.write(par, array, hru_index=hru_index)
+                continue
+            if not par in out_data:
+                out_data[par] = np.full((*array.shape[:-1], nHRU), default, dtype=array.dtype)
+            out_data[par][..., hru_index] = array
+
+    if workers == 1:
+        for hru_index, args in tasks:
+            _collect(hru_index, _run_tile(*args))
+    else:
+        # spawn rather than fork: forked workers deadlock on dask/HDF5 state of lazily loaded attributes
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(_run_tile, *args): hru_index for hru_index, args in tasks}
+            for future in as_completed(futures):
+                _collect(futures.pop(future), future.result())
+
+    return out_data
+
+
+def _run_tile(attr_data, tile_op, param_meta, tf_coef, layer_op, pvalue, threads, spatial_dims, kernel, policy, default):
+    # precision policy is passed explicitly, spawned worker process does not inherit it
+    with precision_policy(**policy):
+        return run_mpr(attr_data, None, param_meta, tf_coef, layer_op=layer_op, pvalue=pvalue, workers=threads,
+                       remap_op=tile_op, spatial_dims=spatial_dims, kernel=kernel, default=default)
+
+
+def _is_grid_layer_op(layer_op):
+    # True if layer_op is per-cell layer operator on source grid [nMlyr x nSlyr x lat x lon]
+    return layer_op is not None and not isinstance(layer_op, dict) and np.ndim(layer_op) == 4
+
+
+def _bytes_per_cell(attr_data, spatial_dims):
+    # rough memory use per source grid cell: attributes and TEMP_FACTOR times for parameters and temporaries
+    nbytes = 0
+    for var in attr_data.data_vars:
+        da = attr_data[var]
+        if all(dim in da.dims for dim in spatial_dims):
+            nbytes += da.dtype.itemsize * da.size // (da.sizes[spatial_dims[0]] * da.sizes[spatial_dims[1]])
+    return max(nbytes, 1) * TEMP_FACTOR
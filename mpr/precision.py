@@ -0,0 +1,118 @@
+# Floating point precision policy
+#
+# storage: dtype of geophysical attributes, native and scaled parameters and output file (default float32)
+# accum:   dtype of weighted sums in vertical and horizontal scaling, and of remapping weight (default float64)
+#
+# e.g.,
+#   from mpr import precision
+#   precision.set_precision(storage='float64')        # whole session
+#   with precision.precision_policy(storage='float64'):
+#       param_data = run_mpr(...)                     # temporarily
+#   report = precision.validate_precision(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+#
+# IO.yml PRECISION section (STORAGE, ACCUM) is applied by command line driver (see cli.py).
+#
+# policy is held in context variable, so precision_policy in one thread does not change the policy of others.
+# threads started in mpr (scheduler, server) run in copy of context of submitting thread, other threads
+# start with default policy (copy context with contextvars.copy_context().run to pass the policy).
+
+import contextvars
+from contextlib import contextmanager
+
+import numpy as np
+import xarray as xr
+
+DEFAULT_POLICY = {'storage': 'float32', 'accum': 'float64'}
+
+# policy dictionary is replaced, never modified in place, since it is shared by copies of context
+_policy = contextvars.ContextVar('precision_policy', default=DEFAULT_POLICY)
+
+
+def set_precision(storage=None, accum=None):
+    '''
+    Set dtype of storage and accumulation ('float32' or 'float64') in current context. not changed if None
+    '''
+    _policy.set(_new_policy(storage=storage, accum=accum))
+
+
+def get_policy():
+    return dict(_policy.get())
+
+
+def get_dtype(kind='storage'):
+    '''
+    Return numpy dtype of kind, "storage" or "accum"
+    '''
+    return np.dtype(_policy.get()[kind])
+
+
+@contextmanager
+def precision_policy(storage=None, accum=None):
+    '''
+    Set precision policy within with-block (see set_precision)
+    '''
+    token = _policy.set(_new_policy(storage=storage, accum=accum))
+    try:
+        yield get_policy()
+    finally:
+        _policy.reset(token)
+
+
+def as_storage(data):
+    '''
+    Cast floating point data (numpy array, xarray DataArray or Dataset) to storage dtype. other data are returned as is
+    '''
+    dtype = get_dtype('storage')
+    if isinstance(data, xr.Dataset):
+        cast = {var: data[var].astype(dtype) for var in data.data_vars
+                if data[var].dtype.kind == 'f' and data[var].dtype != dtype}
+        return data.assign(cast) if cast else data
+    if getattr(data, 'dtype', None) is not None and data.dtype.kind == 'f' and data.dtype != dtype:
+        return data.astype(dtype)
+    return data
+
+
+def validate_precision(attr_data, mapping_data, param_meta, tf_coef, storage='float32', reference='float64', **kwargs):
+    '''
+    Compare parameters computed with storage precision against float64 reference run
+
+    input:  storage,   dtype of run to be validated
+            reference, dtype of reference run
+            others,    see pipeline.run_mpr (attr_data is upcast in reference run)
+    return: dictionary, {parameter name: {'max_abs': max absolute deviation, 'max_rel': max relative deviation,
+                                          'nan_mismatch': number of HRUs with missing value in only one of runs}}
+    report is printed by caller, e.g., benchmarks/bench_mpr.py --validate-precision
+    '''
+    from mpr.pipeline import run_mpr
+
+    with precision_policy(storage=reference, accum='float64'):
+        ref_data = run_mpr(attr_data, mapping_data, param_meta, tf_coef, **kwargs)
+    with precision_policy(storage=storage):
+        test_data = run_mpr(attr_data, mapping_data, param_meta, tf_coef, **kwargs)
+
+    report = {}
+    for par, ref in ref_data.items():
+        ref  = np.asarray(ref, dtype='float64')
+        test = np.asarray(test_data[par], dtype='float64')
+        both = ~np.isnan(ref) & ~np.isnan(test)
+        diff = np.abs(test - ref)[both]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel = (diff/np.abs(ref[both]))[ref[both] != 0]
+        report[par] = {'max_abs': float(diff.max()) if diff.size else 0.0,
+                       'max_rel': float(rel.max()) if rel.size else 0.0,
+                       'nan_mismatch': int(np.sum(np.isnan(ref) != np.isnan(test)))}
+
+    return report
+
+
+def _new_policy(storage=None, accum=None):
+    # copy of current policy with storage and accum replaced (not None)
+    policy = get_policy()
+    for key, dtype in [('storage', storage), ('accum', accum)]:
+        if dtype is None:
+            continue
+        dtype = np.dtype(dtype)
+        if dtype.kind != 'f':
+            raise ValueError(f'{key} precision must be floating point dtype: {dtype}')
+        policy[key] = dtype.name
+    return policy
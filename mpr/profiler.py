@@ -0,0 +1,227 @@
+# Per-stage timing and memory instrumentation of MPR runs
+#
+# stages (loading, transfer functions, vertical/horizontal scaling, writing) are wrapped in span(),
+# which records nothing unless profiling is enabled.
+#
+# e.g.,
+#   from mpr import profiler
+#   profiler.enable(trace_memory=True)
+#   param_data = run_mpr(...)
+#   profiler.write_report('profile.json')   # or profile.csv
+#
+# ---- record of each span
+# name:     stage name, e.g., "load_geophysical_attributes", "tf:k_soil", "vertical_weighted_mean", "write:k_soil"
+# path:     names of enclosing spans in same thread joined with "/", e.g., "scale:k_soil/vertical_weighted_mean"
+# thread:   name of thread where span ran (transfer functions run in worker threads, see scheduler.py)
+# start:    start time relative to enable() [s]
+# wall:     wall time [s]
+# cpu:      cpu time of process [s]. includes other threads running concurrently
+# alloc:    net memory allocated within span [byte] (trace_memory=True only)
+# peak:     peak memory allocated within span above its start [byte] (trace_memory=True only)
+# others:   attributes given to span() or set in yielded record, e.g., shape, nbytes of arrays
+#
+# memory is traced with tracemalloc, which slows down python allocations. peak of concurrent spans in
+# different threads is shared. spans in worker processes of pipeline.run_mpr_tiled (workers > 1) are not recorded.
+
+import os
+import csv
+import json
+import time
+import threading
+import functools
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+_state = {'enabled': False, 'trace_memory': False, 'origin': 0.0}
+_records = []
+_lock  = threading.Lock()
+_local = threading.local()
+
+
+def enable(trace_memory=False, reset=True):
+    '''
+    Start recording spans
+    trace_memory: True to record allocated memory with tracemalloc
+    '''
+    if reset:
+        clear()
+    _state['enabled'] = True
+    _state['trace_memory'] = trace_memory
+    _state['origin'] = time.perf_counter()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state['tracemalloc_started'] = True
+
+
+def disable():
+    '''
+    Stop recording spans. records are kept until clear() or enable()
+    '''
+    _state['enabled'] = False
+    if _state.pop('tracemalloc_started', False):
+        tracemalloc.stop()
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def clear():
+    with _lock:
+        _records.clear()
+
+
+def get_records():
+    '''
+    Return list of span records (dictionaries) in order of completion
+    '''
+    with _lock:
+        return [dict(rec) for rec in _records]
+
+
+@contextmanager
+def span(name, **info):
+    '''
+    Record wall time, cpu time and memory of code block
+
+    input:  name, stage name
+            info, additional attributes to be recorded, e.g., shape=array.shape
+    yield:  dictionary, record of span (None if profiling is disabled). keys can be added in code block
+
+    e.g.,
+      with span('vertical_weighted_mean', param='k_soil') as rec:
+          ...
+          if rec is not None:
+              rec.update(array_info(result))
+    '''
+    if not _state['enabled']:
+        yield None
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    trace = _state['trace_memory'] and tracemalloc.is_tracing()
+    rec = {'name': name, 'path': '/'.join([parent['name'] for parent in stack] + [name]),
+           'thread': threading.current_thread().name}
+    rec.update(info)
+
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:  # keep peak of enclosing span before resetting
+            stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+        tracemalloc.reset_peak()
+        rec['_mem0'] = current
+        rec['_peak'] = current
+
+    stack.append(rec)
+    start_wall = time.perf_counter()
+    start_cpu  = time.process_time()
+    try:
+        yield rec
+    finally:
+        rec['wall']  = time.perf_counter() - start_wall
+        rec['cpu']   = time.process_time() - start_cpu
+        rec['start'] = start_wall - _state['origin']
+        stack.pop()
+
+        if trace:
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(rec.pop('_peak'), peak)
+            mem0 = rec.pop('_mem0')
+            rec['alloc'] = current - mem0
+            rec['peak']  = peak - mem0
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], peak)
+
+        with _lock:
+            _records.append(rec)
+
+
+def traced(name=None, array_arg=None):
+    '''
+    Decorator wrapping function in span. shape, dtype and nbytes of returned array are recorded
+
+    input:  name,      span name. function name if None
+            array_arg, (optional) position of argument whose array info is recorded with prefix "in_"
+    '''
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+            with span(span_name) as rec:
+                if array_arg is not None and len(args) > array_arg:
+                    rec.update(array_info(args[array_arg], prefix='in_'))
+                result = func(*args, **kwargs)
+                if hasattr(result, 'shape'):
+                    rec.update(array_info(result))
+            return result
+
+        return wrapper
+    return decorator
+
+
+def array_info(array, prefix=''):
+    '''
+    Return dictionary of shape, dtype and nbytes of array (numpy array or xarray DataArray)
+    '''
+    if array is None:
+        return {}
+    return {prefix+'shape': list(np.shape(array)),
+            prefix+'dtype': str(getattr(array, 'dtype', '')),
+            prefix+'nbytes': int(getattr(array, 'nbytes', 0))}
+
+
+def summarize(records=None):
+    '''
+    Return dictionary {span name: {'count', 'wall', 'cpu', 'peak'}}, total over spans of same name
+    '''
+    if records is None:
+        records = get_records()
+    summary = {}
+    for rec in records:
+        total = summary.setdefault(rec['name'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': None})
+        total['count'] += 1
+        total['wall']  += rec['wall']
+        total['cpu']   += rec['cpu']
+        if 'peak' in rec:
+            total['peak'] = max(total['peak'] or 0, rec['peak'])
+    return summary
+
+
+def write_report(fname, records=None):
+    '''
+    Write span records in json (with summary) or csv, depending on file extension
+    '''
+    if records is None:
+        records = get_records()
+    records = sorted(records, key=lambda rec: rec['start'])
+
+    if os.path.splitext(fname)[1].lower() == '.csv':
+        keys = ['name', 'path', 'thread', 'start', 'wall', 'cpu', 'alloc', 'peak']
+        keys += sorted(set(key for rec in records for key in rec) - set(keys))
+        with open(fname, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=keys)
+            writer.writeheader()
+            for rec in records:
+                writer.writerow({key: (json.dumps(val) if isinstance(val, (list, tuple)) else val) for key, val in rec.items()})
+    else:
+        with open(fname, 'w') as f:
+            json.dump({'summary': summarize(records), 'records': records}, f, indent=2, default=str)
+
+
+def print_summary(records=None):
+    '''
+    Print total wall time, cpu time and peak memory of each span name, in descending order of wall time
+    '''
+    summary = summarize(records)
+    print(f'\n {"stage":40s} {"count":>6s} {"wall [s]":>10s} {"cpu [s]":>10s} {"peak [MB]":>10s}', flush=True)
+    for name, total in sorted(summary.items(), key=lambda item: -item[1]['wall']):
+        peak = '' if total['peak'] is None else f'{total["peak"]/1024**2:10.1f}'
+        print(f' {name:40s} {total["count"]:6d} {total["wall"]:10.4f} {total["cpu"]:10.4f} {peak:>10s}', flush=True)
@@ -1,19 +1,357 @@
+# Horizontal and vertical scaling of native resolution parameters
+#
+# ---- horizontal scaling
+# mapping weight is compiled once into sparse remapping operator [nHRU x nCell] over source grid cells referenced
+# in mapping data (comp_remap_operator), and weighted generalized mean of every HRU is one sparse matrix product
+# of gathered cell values (gather_cells -> sparse_weighted_mean). horizontal_weighted_mean keeps the original
+# interface with mapping data.
+#
+# ---- vertical scaling
+# weighted generalized mean over soil layers with layer operator (see model_layer), vertical_weighted_mean
+
 
 import os
 import warnings
 import numpy as np
+from scipy import sparse
 
-# TODO:
+from mpr.model_layer import comp_layer_operator
+from mpr.profiler import traced
+from mpr.precision import get_dtype
 
 FILL_VALUE = -9999.0
+VERTICAL_BLOCK_SIZE = 1048576
+HORIZONTAL_BLOCK_SIZE = 16777216
+STAT_PVALUE = {'mean': None, 'amean': 1.0, 'gmean': 0.0, 'hmean': -1.0}
+
+def comp_remap_operator(mapping_data, grid_shape):
+    """ Brief: Build sparse remapping operator from source grid cells to target HRUs
+
+        Details:
+        input:  mapping_data, reformated mapping data,  dictionary {mapping variable name: numpy array}
+                                                        padded or compact (see IO.process_mapping_data)
+                grid_shape,   shape of source grid,     tuple (lat, lon)
+        return: remap_op,     remapping operator,       dictionary (see below)
+
+        remap_op['matrix']:     scipy csr matrix [nHRU x nCell] of mapping weight
+        remap_op['cell_index']: flat index of source grid cells referenced in mapping [nCell]
+        remap_op['grid_shape']: shape of source grid (lat, lon)
+
+        Only grid cells referenced by mapping are kept (column of matrix), so that the operator is
+        independent of domain size. Build once and reuse for all parameters.
+    """
+    overlaps = np.asarray(mapping_data['overlaps'])
+    nOutHRUs = len(overlaps)
+
+    if 'offsets' in mapping_data: # compact mapping data (flat data dimension)
+        rows = np.repeat(np.arange(nOutHRUs), overlaps)
+        j_index = mapping_data['j_index']
+        i_index = mapping_data['i_index']
+        weight  = mapping_data['weight']
+    else: # expand padded [nHRU x maxOverlaps] matrices to 1D data dimension
+        mask = np.arange(mapping_data['weight'].shape[1]) < overlaps[:, np.newaxis]
+        rows = np.nonzero(mask)[0]
+        j_index = mapping_data['j_index'][mask]
+        i_index = mapping_data['i_index'][mask]
+        weight  = mapping_data['weight'][mask]
+
+    flat_index = np.ravel_multi_index((j_index, i_index), grid_shape)
+    cell_index, cols = np.unique(flat_index, return_inverse=True)
+
+    matrix = sparse.csr_matrix((weight.astype(get_dtype('accum')), (rows, cols.ravel())), shape=(nOutHRUs, len(cell_index)))
+
+    return {'matrix': matrix, 'cell_index': cell_index, 'grid_shape': tuple(grid_shape)}
+
+
+def subset_remap_operator(remap_op, hru_index, window=None):
+    """ Brief: Extract remapping operator for subset of target HRUs
+
+        Details:
+        input:  remap_op,  remapping operator from comp_remap_operator
+                hru_index, index of target HRUs in remap_op, numpy array [nSubHRU]
+                window,    (optional) (j_slice, i_slice) of source grid. cell index of returned operator
+                           is relative to window, i.e., operator is applied to origArrays[..., j_slice, i_slice]
+        return: remap_op,  remapping operator for [nSubHRU x nSubCell]
+
+        order of weights in each row is preserved, so that remapped values are identical to full operator
+    """
+    matrix = remap_op['matrix'][np.asarray(hru_index)]
+    used   = np.unique(matrix.indices)
+    matrix = sparse.csr_matrix((matrix.data, np.searchsorted(used, matrix.indices), matrix.indptr),
+                               shape=(matrix.shape[0], len(used)))
+    cell_index = remap_op['cell_index'][used]
+    grid_shape = remap_op['grid_shape']
+
+    if window is not None:
+        j_index, i_index = np.unravel_index(cell_index, grid_shape)
+        grid_shape = (window[0].stop - window[0].start, window[1].stop - window[1].start)
+        cell_index = np.ravel_multi_index((j_index - window[0].start, i_index - window[1].start), grid_shape)
+
+    return {'matrix': matrix, 'cell_index': cell_index, 'grid_shape': tuple(grid_shape)}
+
+
+def combine_remap_operators(remap_ops):
+    """ Brief: Stack remapping operators of multiple targets on the same source grid into one operator
+
+        Details:
+        input:  remap_ops, list of remapping operators from comp_remap_operator
+        return: remap_op,  remapping operator [sum(nHRU) x nCell] over union of source grid cells of all the operators
+                offsets,   numpy array [nTarget+1], HRUs of target t are in rows [offsets[t]:offsets[t+1]]
+
+        order of weights in each row is preserved, so that remapped values are identical to each operator
+    """
+    grid_shape = remap_ops[0]['grid_shape']
+    if any(op['grid_shape'] != grid_shape for op in remap_ops):
+        raise ValueError('remapping operators have different source grids: %s' % [op['grid_shape'] for op in remap_ops])
+
+    cell_index = np.unique(np.concatenate([op['cell_index'] for op in remap_ops]))
+    matrices = []
+    for op in remap_ops:
+        matrix = op['matrix']
+        cols = np.searchsorted(cell_index, op['cell_index'])
+        matrices.append(sparse.csr_matrix((matrix.data, cols[matrix.indices], matrix.indptr), shape=(matrix.shape[0], len(cell_index))))
+
+    offsets = np.concatenate(([0], np.cumsum([op['matrix'].shape[0] for op in remap_ops])))
+    return {'matrix': sparse.vstack(matrices, format='csr'), 'cell_index': cell_index, 'grid_shape': grid_shape}, offsets
+
+
+def get_footprint(remap_op, hru_index=None):
+    """ Return bounding box (j_slice, i_slice) of source grid cells referenced by target HRUs (all HRUs if hru_index is None)
+    """
+    matrix = remap_op['matrix'] if hru_index is None else remap_op['matrix'][np.asarray(hru_index)]
+    if matrix.nnz == 0:
+        return (slice(0, 0), slice(0, 0))
+    j_index, i_index = np.unravel_index(remap_op['cell_index'][np.unique(matrix.indices)], remap_op['grid_shape'])
+    return (slice(j_index.min(), j_index.max()+1), slice(i_index.min(), i_index.max()+1))
+
+
+@traced(array_arg=1)
+def gather_cells(remap_op, origArrays):
+    """ Gather source grid cells referenced in remap_op
+
+        ogirArray: 2D [lat, lon]         -> 1D [cell]
+                   3D [lyr, lat, lon]    -> 2D [lyr, cell]
+    """
+    origArrays = np.asarray(origArrays)
+    if origArrays.ndim < 2 or origArrays.shape[-2:] != remap_op['grid_shape']:
+        raise ValueError('array shape %s does not match grid shape %s of remapping operator'
+                         % (origArrays.shape, remap_op['grid_shape']))
+
+    flat = origArrays.reshape(*origArrays.shape[:-2], -1)
+    return flat[..., remap_op['cell_index']]
+
+
+@traced('horizontal_weighted_mean', array_arg=1)
+def sparse_weighted_mean(matrix, cellArrays, pvalue, default=FILL_VALUE, block_size=HORIZONTAL_BLOCK_SIZE):
+    """ Brief: Compute weighted generalized mean with sparse weight matrix
+
+        Details:
+        input:  matrix,     sparse weight matrix,            scipy sparse matrix [nHRU x nCell]
+                cellArrays, gathered source cell values,     numpy array [..., nCell]
+                pvalue,     parameter in generalized mean operator
+                block_size, number of values (cells x leading elements) accumulated at once
+        return: wgtedVal,   remapped parameter array,        numpy array [..., nHRU] in storage precision
+
+        Weight is set to zero where value is nan (or undefined after raising to pvalue) and re-scaled,
+        HRUs without any valid source cell get default value.
+        Weighted sums are accumulated in accumulation precision (see precision.py), block of leading elements
+        (e.g., layers) at a time to limit temporary arrays to block_size.
+    """
+    accum = get_dtype('accum')
+    matrix = matrix.astype(accum, copy=False)
+
+    cellArrays = np.asarray(cellArrays)
+    lead_shape = cellArrays.shape[:-1]
+    vals_all = cellArrays.reshape(-1, cellArrays.shape[-1]).T  # [nCell, k]
+    nCell, nLead = vals_all.shape
+
+    wgtedVals = np.empty((matrix.shape[0], nLead), dtype=get_dtype('storage'))
+    step = max(1, block_size // max(nCell, 1))
+
+    for start in range(0, nLead, step):
+        vals = vals_all[:, start:start+step].astype(accum)
 
-def horizontal_weighted_mean(mapping_data, origArrays, pvalue, default=FILL_VALUE):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if abs(pvalue) < 0.00001: # geometric mean
+                terms = np.log(vals)
+            else:
+                terms = vals**pvalue
+            valid = ~np.isnan(terms)
+            terms[~valid] = 0.0
+
+            sum_weight = matrix @ valid.astype(accum)
+            block      = (matrix @ terms)/sum_weight
+
+            if abs(pvalue) < 0.00001:
+                block = np.exp(block)
+            else:
+                block = block**(1.0/pvalue)
+
+        block[sum_weight == 0] = default
+        wgtedVals[:, start:start+step] = block
+
+    return wgtedVals.T.reshape(*lead_shape, matrix.shape[0])
+
+
+def parse_stat(stat, pvalue=1.0):
+    """ Return (kind, parameter) of statistic name
+
+        mean:           generalized mean with pvalue      -> ('pmean', pvalue)
+        amean/gmean/hmean: arithmetic/geometric/harmonic  -> ('pmean', 1.0/0.0/-1.0)
+        pmean:<p>:      generalized mean with p, e.g., pmean:0.5
+        min/max/std:    weighted minimum, maximum, standard deviation (population)
+        median, quantile:<q>: weighted quantile (0 <= q <= 1), e.g., quantile:0.9
+    """
+    name = str(stat).strip()
+    kind, _, arg = name.partition(':')
+    try:
+        if kind in STAT_PVALUE and not arg:
+            return ('pmean', pvalue if kind == 'mean' else STAT_PVALUE[kind])
+        if kind == 'pmean' and arg:
+            return ('pmean', float(arg))
+        if kind in ['min', 'max', 'std'] and not arg:
+            return (kind, None)
+        if kind == 'median' and not arg:
+            return ('quantile', 0.5)
+        if kind == 'quantile' and arg and 0.0 <= float(arg) <= 1.0:
+            return ('quantile', float(arg))
+    except ValueError:
+        pass
+    raise ValueError(f'invalid statistic: "{name}"')
+
+
+@traced('horizontal_weighted_stats', array_arg=1)
+def sparse_weighted_stats(matrix, cellArrays, stats, pvalue=1.0, default=FILL_VALUE, block_size=HORIZONTAL_BLOCK_SIZE):
+    """ Brief: Compute multiple weighted statistics from one gather of source cells of each HRU
+
+        Details:
+        input:  matrix,     sparse weight matrix,            scipy sparse matrix [nHRU x nCell]
+                cellArrays, gathered source cell values,     numpy array [..., nCell]
+                stats,      list of statistic names (see parse_stat), e.g., ['hmean', 'gmean', 'amean', 'std']
+                pvalue,     parameter of "mean"
+                block_size, number of values (mapping entries x leading elements) gathered at once
+        return: wgtedVal,   statistics,                      numpy array [nStat, ..., nHRU] in storage precision
+
+        Values of source cells are gathered once into mapping entries (nonzeros of matrix) and all the
+        statistics are computed from them. generalized means are identical to sparse_weighted_mean.
+        Weight is set to zero where value is nan, HRUs without any valid source cell get default value.
+    """
+    stats  = [parse_stat(stat, pvalue) for stat in stats]
+    accum  = get_dtype('accum')
+    matrix = sparse.csr_matrix(matrix).astype(accum, copy=False)
+    nHRU   = matrix.shape[0]
+
+    cellArrays = np.asarray(cellArrays)
+    lead_shape = cellArrays.shape[:-1]
+    vals_all = cellArrays.reshape(-1, cellArrays.shape[-1]).T  # [nCell, k]
+    nLead = vals_all.shape[1]
+
+    # operator summing weighted mapping entries of each HRU [nHRU x nEntry], same order of sum as matrix
+    nEntry = matrix.nnz
+    entry_op = sparse.csr_matrix((matrix.data, np.arange(nEntry), matrix.indptr), shape=(nHRU, nEntry))
+    entry_hru = np.repeat(np.arange(nHRU), np.diff(matrix.indptr))
+    first = matrix.indptr[:-1][np.diff(matrix.indptr) > 0]  # first entry of HRUs with entries
+
+    wgtedVals = np.empty((len(stats), nHRU, nLead), dtype=get_dtype('storage'))
+    step = max(1, block_size // max(nEntry, 1))
+
+    for start in range(0, nLead, step):
+        vals  = vals_all[matrix.indices, start:start+step].astype(accum)  # [nEntry, k]
+        valid = ~np.isnan(vals) & (matrix.data > 0)[:, np.newaxis]
+        sum_weight = entry_op @ valid.astype(accum)
+        mean = None
+
+        for n, (kind, param) in enumerate(stats):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if kind == 'pmean':
+                    block = _entry_pmean(entry_op, vals, param)
+                elif kind == 'std':
+                    if mean is None:
+                        mean = _entry_pmean(entry_op, vals, 1.0)
+                        mean[sum_weight == 0] = 0.0
+                    dev = np.where(valid, vals - mean[entry_hru], 0.0)
+                    block = np.sqrt((entry_op @ dev**2)/sum_weight)
+                elif kind in ['min', 'max']:
+                    ufunc, fill = (np.minimum, np.inf) if kind == 'min' else (np.maximum, -np.inf)
+                    block = np.full((nHRU, vals.shape[1]), fill, dtype=accum)
+                    if len(first) > 0:
+                        block[np.diff(matrix.indptr) > 0] = ufunc.reduceat(np.where(valid, vals, fill), first, axis=0)
+                else:
+                    block = _entry_quantile(matrix, vals, valid, param)
+
+            block[sum_weight == 0] = default
+            wgtedVals[n, :, start:start+step] = block
+
+    return np.moveaxis(wgtedVals, 1, 2).reshape(len(stats), *lead_shape, nHRU)
+
+
+def _entry_pmean(entry_op, vals, pvalue):
+    # weighted generalized mean of mapping entries [nEntry, k] -> [nHRU, k] (same as sparse_weighted_mean)
+    if abs(pvalue) < 0.00001: # geometric mean
+        terms = np.log(vals)
+    else:
+        terms = vals**pvalue
+    valid = ~np.isnan(terms)
+    terms[~valid] = 0.0
+
+    block = (entry_op @ terms)/(entry_op @ valid.astype(terms.dtype))
+    if abs(pvalue) < 0.00001:
+        return np.exp(block)
+    return block**(1.0/pvalue)
+
+
+def _entry_quantile(matrix, vals, valid, q):
+    # weighted quantile (smallest value whose cumulative weight fraction >= q) of mapping entries [nEntry, k] -> [nHRU, k]
+    nHRU = matrix.shape[0]
+    hru_all = np.repeat(np.arange(nHRU), np.diff(matrix.indptr))
+    block = np.full((nHRU, vals.shape[1]), np.nan, dtype=vals.dtype)
+
+    for k in range(vals.shape[1]):
+        use    = valid[:, k]
+        hru    = hru_all[use]
+        order  = np.lexsort((vals[use, k], hru))
+        hru    = hru[order]
+        value  = vals[use, k][order]
+        weight = matrix.data[use][order]
+        if len(value) == 0:
+            continue
+
+        # cumulative weight fraction within each HRU. hru + fraction increases monotonically over all the entries
+        hru_used, first, count = np.unique(hru, return_index=True, return_counts=True)
+        last = first + count - 1
+        cum_weight = np.cumsum(weight)
+        before = np.repeat(cum_weight[first] - weight[first], count)
+        total  = np.repeat(cum_weight[last], count)
+        fraction = (cum_weight - before)/(total - before)
+
+        pos = np.searchsorted(hru + fraction, hru_used + q, side='left')
+        block[hru_used, k] = value[np.clip(pos, first, last)]
+
+    return block
+
+
+def horizontal_weighted_stats(mapping_data, origArrays, stats, pvalue=1.0, default=FILL_VALUE, remap_op=None):
+    """ Brief: Compute areal weighted statistics (see sparse_weighted_stats) for all target HRUs
+
+        ogirArray: 2D [lat, lon]         -> wgtedVal: 2D [stat, hru]
+                   3D [lyr, lat, lon]    -> wgtedVal: 3D [stat, lyr, hru]
+    """
+    origArrays = np.asarray(origArrays)
+
+    if remap_op is None:
+        remap_op = comp_remap_operator(mapping_data, origArrays.shape[-2:])
+
+    return sparse_weighted_stats(remap_op['matrix'], gather_cells(remap_op, origArrays), stats, pvalue=pvalue, default=default)
+
+
+def horizontal_weighted_mean(mapping_data, origArrays, pvalue, default=FILL_VALUE, remap_op=None):
     """ Brief: Compute areal weighted generalized mean value of for all target HRUs, given pvalue
 
         Details:
         input:  mapping_data, reformated mapping data,        dictionary {mapping variable name: numpy array}
                 ogirArray,    fine resolution parameter grid, numpy array (2D or 3D see below)
                 pvalue,       parameter in generalized mean operator
+                remap_op,     (optional) operator from comp_remap_operator. built from mapping_data if not provided
         return: wgtedVal,     remapped parameter array,
 
         ogirArray: 2D [lat, lon] -      -> wgtedVal: 1D [hru]
@@ -21,108 +359,198 @@ def horizontal_weighted_mean(mapping_data, origArrays, pvalue, default=FILL_VALU
                       [lyr, lat, lon]   -> wgtedVal: 2D [lyr, hru]
 
     """
-    # numpy broadcasting rule
-    # https://numpy.org/doc/stable/user/basics.broadcasting.html
-
-    array_shape = origArrays.shape
-    nDims       = len(array_shape)
-
-    # TODO
-    # move these out of function
-    nOutHRUs    = len(mapping_data['overlaps'])
-    maxOverlaps = mapping_data['overlaps'].max()
-
-    if nDims == 2:
-        wgtedVals   = np.zeros((nOutHRUs), dtype='float32')
-        matDataVals = np.zeros((nOutHRUs, maxOverlaps), dtype='float32')
-    elif nDims == 3:
-        wgtedVals   = np.zeros((array_shape[0], nOutHRUs), dtype='float32')
-        matDataVals = np.zeros((array_shape[0], nOutHRUs, maxOverlaps), dtype='float32')
-    else:
-        pass # add error check - array with 4 or larger dimension is not supported.
-
-    # reformat var data into regular matrix matching weights format (nOutPolygons, maxOverlaps)
-    #   used advanced indexing to extract matching input grid indices
-    for iHru in range(0, nOutHRUs):
-        if mapping_data['overlaps'][iHru]>0:
-            if nDims == 2:
-                matDataVals[iHru, 0:mapping_data['overlaps'][iHru]] = \
-                    origArrays[mapping_data['j_index'][iHru, 0:mapping_data['overlaps'][iHru]], mapping_data['i_index'][iHru, 0:mapping_data['overlaps'][iHru]] ]
-            elif nDims == 3:
-                matDataVals[:, iHru, 0:mapping_data['overlaps'][iHru]] = \
-                    origArrays[:, mapping_data['j_index'][iHru, 0:mapping_data['overlaps'][iHru]], mapping_data['i_index'][iHru, 0:mapping_data['overlaps'][iHru]] ]
-        else:
-            if nDims == 2:
-                matDataVals[iHru, 0] = default
-            elif nDims == 3:
-                matDataVals[:, iHru, 0] = default
-
-    # adjust weight matrix again (put zero where parameter is nan and re-scale weight)
-    if nDims == 2:
-        idx = np.where(np.isnan(matDataVals[:,:]))
-    elif nDims == 3:
-        idx = np.where(np.isnan(matDataVals[0,:,:]))
-    mapping_data['weight'][idx] = 0
-    sum_weight = np.tile(1.0/np.sum(mapping_data['weight'], axis=1), (mapping_data['weight'].shape[1],1)).T
-    weight = sum_weight * mapping_data['weight']
-
-    # Compute mean at all the target hrus
-    if abs(pvalue) < 0.00001: # geometric mean
-        wgtedVals = exp(np.nansum(log(matDataVals)* weight, axis=nDims-1))
-    else:
-        wgtedVals = np.nansum((matDataVals**pvalue) * weight, axis=nDims-1) **(1.0/pvalue)   # produces vector of weighted values
+    origArrays = np.asarray(origArrays)
+
+    if remap_op is None:
+        remap_op = comp_remap_operator(mapping_data, origArrays.shape[-2:])
 
-    return wgtedVals
+    return sparse_weighted_mean(remap_op['matrix'], gather_cells(remap_op, origArrays), pvalue, default=default)
 
 
-def vertical_weighted_mean(mapping_data, origArrays, pvalue, default=FILL_VALUE):
-    """Compute areal weighted generalized mean value of for vertical layer
-       """
-    # numpy broadcasting rule
-    # https://numpy.org/doc/stable/user/basics.broadcasting.html
+@traced(array_arg=1)
+def vertical_weighted_mean(mapping_data, origArrays, pvalue, default=FILL_VALUE, block_size=VERTICAL_BLOCK_SIZE):
+    """ Brief: Compute thickness weighted generalized mean value of model layers, given pvalue
 
-    # ogirinal grid: 3D [lat, lon, soil_lyr] -> target grid: 3D [lat, lon, model_lyr]
+        Details:
+        input:  mapping_data, layer operator [nMlyr x nSlyr] or per-cell layer operator [nMlyr x nSlyr x ...]
+                              (see model_layer.comp_layer_weight_array)
+                              or layer mapping data, dictionary (see model_layer.comp_layer_weight)
+                ogirArray,    soil layer parameter, numpy array [soil_lyr, ...]
+                pvalue,       parameter in generalized mean operator
+                block_size,   number of grid cells processed at once
+        return: wgtedVal,     model layer parameter, numpy array [model_lyr, ...] in storage precision
 
-    orgArrays_reshaped = np.moveaxis(origArrays, 0, -1)
-    array_shape        = orgArrays_reshaped.shape  # original array [soil_lyr, lat, lon] -> [lat, lon, soil_lyr]
-    nDims              = len(array_shape)
+        ogirArray: 3D [soil_lyr, lat, lon] -> wgtedVal: 3D [model_lyr, lat, lon]
+                   2D [soil_lyr, cell]     -> wgtedVal: 2D [model_lyr, cell]
+        per-cell operator dimensions (...) match trailing dimensions of ogirArray, e.g., [lat, lon] or [cell]
 
-    # TODO
-    # move these out of function
-    nMlyr       = len(mapping_data['overlaps'])
-    maxOverlaps = mapping_data['overlaps'].max()
+        Soil layers with nan are skipped (weight is not re-scaled). nan if all the soil layers in model layer are nan.
+        Model layers without any soil layer get default value.
+        Weighted sums are accumulated in accumulation precision (see precision.py).
+    """
+    if isinstance(mapping_data, dict):
+        mapping_data = comp_layer_operator(mapping_data)
+    operator = np.asarray(mapping_data)
+
+    origArrays = np.asarray(origArrays)
+    nMlyr, nSlyr = operator.shape[:2]
+    op_shape = operator.shape[2:]
+    if origArrays.ndim < 2 or origArrays.shape[0] < nSlyr:
+        raise ValueError('array must have soil layer (>= %d) and spatial dimension(s): %s' % (nSlyr, origArrays.shape))
+    if op_shape and origArrays.shape[-len(op_shape):] != op_shape:
+        raise ValueError('per-cell layer operator %s does not match array %s' % (op_shape, origArrays.shape))
+
+    # [nSlyr x nLead x nCell], cells of per-cell operator are in last dimension
+    spatial_shape = origArrays.shape[1:]
+    nCell = int(np.prod(op_shape)) if op_shape else int(np.prod(spatial_shape))
+    vals_all = origArrays[:nSlyr].reshape(nSlyr, -1, nCell)
+    if op_shape:
+        operator = operator.reshape(nMlyr, nSlyr, nCell)
+
+    accum = get_dtype('accum')
+    wgtedVals = np.empty((nMlyr, vals_all.shape[1], nCell), dtype=get_dtype('storage'))
+
+    # process block of cells to limit temporary arrays to [nSlyr x nLead x block_size]
+    for start in range(0, max(nCell, 1), block_size):
+        vals = vals_all[..., start:start+block_size].astype(accum)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if abs(pvalue) < 0.00001: # geometric mean
+                terms = np.log(vals)
+            else:
+                terms = vals**pvalue
+            valid = ~np.isnan(terms)
+            terms[~valid] = 0.0
+
+            if op_shape:
+                weight  = operator[..., start:start+block_size].astype(accum)
+                block   = np.einsum('msc,slc->mlc', weight, terms)
+                nValid  = np.einsum('msc,slc->mlc', (weight > 0).astype(accum), valid.astype(accum))
+                no_layer = ((weight > 0).sum(axis=1) == 0)[:, np.newaxis, :]
+            else:
+                # einsum rather than tensordot: BLAS result of a cell may depend on number of cells (e.g., tiles)
+                weight  = operator.astype(accum)
+                block   = np.einsum('ms,slc->mlc', weight, terms)
+                nValid  = np.einsum('ms,slc->mlc', (weight > 0).astype(accum), valid.astype(accum))
+                no_layer = ((weight > 0).sum(axis=1) == 0)[:, np.newaxis, np.newaxis]
+
+            if abs(pvalue) < 0.00001:
+                block = np.exp(block)
+            else:
+                block = block**(1.0/pvalue)
+
+        block[nValid == 0] = np.nan
+        block = np.where(no_layer, default, block)
+        wgtedVals[..., start:start+block_size] = block
+
+    return wgtedVals.reshape(nMlyr, *spatial_shape)
+
+
+@traced(array_arg=1)
+def vertical_weighted_mean_jvp(mapping_data, origArrays, tangents, pvalue, default=FILL_VALUE):
+    """ Brief: Compute tangent of vertical_weighted_mean (Jacobian-vector product) given tangents of soil layer parameter
 
-    if nDims == 3:
-        wgtedVals   = np.zeros((array_shape[0], array_shape[1], nMlyr), dtype='float32')
-        matDataVals = np.full((array_shape[0], array_shape[1], nMlyr, maxOverlaps), np.nan, dtype='float32')
-    else:
-        pass # add error check - array with other dimension is not supported.
-
-    # reformat var data into regular matrix matching weights format (nOutPolygons, maxOverlaps)
-    #   used advanced indexing to extract matching input grid indices
-    for ixm in range(0, nMlyr):
-        if mapping_data['overlaps'][ixm]>0:
-            if nDims == 3:
-                matDataVals[:, :, ixm, 0:mapping_data['overlaps'][ixm]] = \
-                    orgArrays_reshaped[:, :, mapping_data['soil_index'][ixm,0:mapping_data['overlaps'][ixm]]]
+        Details:
+        input:  mapping_data, layer operator (see vertical_weighted_mean)
+                ogirArray,    soil layer parameter, numpy array [soil_lyr, ...]
+                tangents,     tangent of ogirArray, numpy array [nDir, soil_lyr, ...]
+                pvalue,       parameter in generalized mean operator
+        return: tangent of model layer parameter, numpy array [nDir, model_lyr, ...] in accumulation precision
+
+        d(sum(w*x**p))**(1/p) = (sum(w*x**p))**(1/p-1)*sum(w*x**(p-1)*dx), geometric mean: exp(sum(w*log(x)))*sum(w*dx/x)
+        tangent is nan or default where model layer parameter is nan or default
+    """
+    if isinstance(mapping_data, dict):
+        mapping_data = comp_layer_operator(mapping_data)
+    accum = get_dtype('accum')
+    operator = np.asarray(mapping_data).astype(accum)
+
+    origArrays = np.asarray(origArrays)
+    nMlyr, nSlyr = operator.shape[:2]
+    op_shape = operator.shape[2:]
+    spatial_shape = origArrays.shape[1:]
+    nCell = int(np.prod(op_shape)) if op_shape else int(np.prod(spatial_shape))
+    vals = origArrays[:nSlyr].reshape(nSlyr, -1, nCell).astype(accum)
+    tangents = np.asarray(tangents)[:, :nSlyr].reshape(len(tangents), nSlyr, -1, nCell)
+    if op_shape:
+        operator = operator.reshape(nMlyr, nSlyr, nCell)
+    subscripts = 'msc,slc->mlc' if op_shape else 'ms,slc->mlc'
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if abs(pvalue) < 0.00001: # geometric mean
+            terms = np.log(vals)
+            dterms = 1.0/vals
+        else:
+            terms = vals**pvalue
+            dterms = vals**(pvalue-1.0)
+        valid = ~np.isnan(terms)
+        terms[~valid] = 0.0
+        dterms[~valid] = 0.0
+
+        block = np.einsum(subscripts, operator, terms)
+        if abs(pvalue) < 0.00001:
+            scale = np.exp(block)
         else:
-            if nDims == 3:
-                matDataVals[:, :, ixm, 0] = default
+            scale = block**(1.0/pvalue-1.0)
+        nValid = np.einsum(subscripts, (operator > 0).astype(accum), valid.astype(accum))
+        no_layer = ((operator > 0).sum(axis=1) == 0)[:, np.newaxis, :] if op_shape else \
+                   ((operator > 0).sum(axis=1) == 0)[:, np.newaxis, np.newaxis]
 
-    weight = np.broadcast_to(mapping_data['weight'], (array_shape[0], array_shape[1], *mapping_data['weight'].shape ))
-    if abs(pvalue) < 0.00001: # geometric mean
-        wgtedVals = exp(_nansum(log(matDataVals)* weight, axis=nDims))
-    else:
-        wgtedVals = _nansum(matDataVals**pvalue * weight, axis=nDims) **(1.0/pvalue)   # produces vector of weighted values
+        wgtedTangents = np.empty((len(tangents), nMlyr, *vals.shape[1:]), dtype=accum)
+        for d, tangent in enumerate(tangents):
+            dblock = scale*np.einsum(subscripts, operator, dterms*np.where(valid, tangent, 0.0))
+            dblock[nValid == 0] = np.nan
+            wgtedTangents[d] = np.where(no_layer, default, dblock)
+
+    return wgtedTangents.reshape(len(tangents), nMlyr, *spatial_shape)
+
+
+@traced('horizontal_weighted_mean_jvp', array_arg=1)
+def sparse_weighted_mean_jvp(matrix, cellArrays, tangents, pvalue, default=FILL_VALUE):
+    """ Brief: Compute tangent of sparse_weighted_mean (Jacobian-vector product) given tangents of gathered source cell values
 
-    return np.moveaxis(wgtedVals, -1, 0)
+        Details:
+        input:  matrix,     sparse weight matrix,            scipy sparse matrix [nHRU x nCell]
+                cellArrays, gathered source cell values,     numpy array [..., nCell]
+                tangents,   tangent of cellArrays,           numpy array [nDir, ..., nCell]
+                pvalue,     parameter in generalized mean operator
+        return: tangent of remapped parameter, numpy array [nDir, ..., nHRU] in accumulation precision
+
+        weights are re-scaled with valid cells as in sparse_weighted_mean. HRUs without any valid source cell get default value
+    """
+    accum = get_dtype('accum')
+    matrix = matrix.astype(accum, copy=False)
+
+    cellArrays = np.asarray(cellArrays)
+    lead_shape = cellArrays.shape[:-1]
+    vals = cellArrays.reshape(-1, cellArrays.shape[-1]).T.astype(accum)  # [nCell, k]
+    tangents = np.asarray(tangents).reshape(len(tangents), -1, cellArrays.shape[-1])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if abs(pvalue) < 0.00001: # geometric mean
+            terms = np.log(vals)
+            dterms = 1.0/vals
+        else:
+            terms = vals**pvalue
+            dterms = vals**(pvalue-1.0)
+        valid = ~np.isnan(terms)
+        terms[~valid] = 0.0
+        dterms[~valid] = 0.0
+
+        sum_weight = matrix @ valid.astype(accum)
+        block = (matrix @ terms)/sum_weight
+        if abs(pvalue) < 0.00001:
+            scale = np.exp(block)
+        else:
+            scale = block**(1.0/pvalue-1.0)
 
+        wgtedTangents = np.empty((len(tangents), matrix.shape[0], vals.shape[1]), dtype=accum)
+        for d, tangent in enumerate(tangents):
+            dblock = scale*(matrix @ (dterms*np.where(valid, tangent.T, 0.0)))/sum_weight
+            dblock[sum_weight == 0] = default
+            wgtedTangents[d] = dblock
 
-def _nansum(a, **kwargs):
-    mx = np.isnan(a).all(**kwargs)
-    res = np.nansum(a, **kwargs)
-    res[mx] = np.nan
-    return res
+    return np.moveaxis(wgtedTangents, 1, 2).reshape(len(tangents), *lead_shape, matrix.shape[0])
 
 
 def get_index_array(a_array, b_array):
@@ -0,0 +1,158 @@
+# Dependency graph scheduler for transfer function evaluation
+#
+# parameter dependency is declared with transfer functions (see transfer_function.TF_INPUTS), e.g.,
+#   fieldCapacity      <- theta_sat, matric_potential, retention_slope
+#   heightCanopyBottom <- heightCanopyTop
+# parameters whose upstream parameters are computed run concurrently in thread pool (numpy releases GIL),
+# and native resolution parameters are released as soon as the last downstream parameter is computed.
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from mpr.transfer_function import get_transfer_function, get_tf_inputs
+from mpr.profiler import span, array_info
+from mpr.precision import as_storage
+
+
+def build_param_graph(param_meta):
+    '''
+    Build parameter dependency graph for parameters with compute: True
+
+    return: dictionary, {parameter name: [upstream parameter names]}
+    '''
+    graph = {}
+    for par, meta in param_meta.items():
+        if not meta['compute']:
+            continue
+        deps = get_tf_inputs(meta['tf'])['param']
+        for dep in deps:
+            if not dep in param_meta or not param_meta[dep]['compute']:
+                raise ValueError(f'parameter "{par}" requires "{dep}", but "{dep}" is not computed')
+        graph[par] = deps
+
+    topological_order(graph)  # check circular dependency
+
+    return graph
+
+
+def topological_order(graph):
+    '''
+    Return list of parameters in which each parameter comes after its upstream parameters
+    '''
+    nDeps = {par: len(deps) for par, deps in graph.items()}
+    downstream = get_downstream(graph)
+
+    order = []
+    ready = [par for par, n in nDeps.items() if n == 0]
+    while ready:
+        par = ready.pop(0)
+        order.append(par)
+        for down in downstream[par]:
+            nDeps[down] -= 1
+            if nDeps[down] == 0:
+                ready.append(down)
+
+    if len(order) != len(graph):
+        raise ValueError('circular dependency in parameters: %s' % [par for par in graph if not par in order])
+
+    return order
+
+
+def get_downstream(graph):
+    '''
+    Return dictionary, {parameter name: [downstream parameter names]}
+    '''
+    downstream = {par: [] for par in graph}
+    for par, deps in graph.items():
+        for dep in deps:
+            downstream[dep].append(par)
+    return downstream
+
+
+def run_transfer_functions(attr_data, param_meta, tf_coef, workers=1, post=None, param_data=None, kernel=False):
+    '''
+    Evaluate transfer functions of parameters with compute: True following dependency graph
+
+    input:  attr_data,  geophysical data (native resolution)
+            param_meta, dictionary, parameter config (['param'] in param_meta.yml)
+            tf_coef,    dictionary, transfer function coefficient (tf_coef.yml)
+            workers,    number of threads
+            post,       function post(name, native parameter) applied to parameters with write: True in
+                        worker thread, e.g., vertical and horizontal scaling
+            param_data, dictionary, (optional) parameters already computed. these are not recomputed
+            kernel,     True: use numpy kernels of transfer functions (see transfer_function.transfer_kernel),
+                        except for parameters whose coefficients are arrays (e.g., ensemble coefficients)
+    return: dictionary, {parameter name: post(name, native parameter)} for parameters with write: True
+
+    Native parameters are cast to storage precision (see precision.py).
+    Native parameters with write: False (e.g., norm_prec) are released once all the downstream parameters are computed.
+    parameters in param_data are released in the same way (consumers are counted over parameters to compute only)
+    '''
+    graph = build_param_graph(param_meta)
+    downstream = get_downstream(graph)
+
+    param_data = {} if param_data is None else dict(param_data)
+    todo       = [par for par in graph if not par in param_data]
+    nConsumer  = {par: sum(1 for down in downstream[par] if down in todo) for par in graph}
+    nDeps      = {par: sum(1 for dep in deps if not dep in param_data) for par, deps in graph.items()}
+
+    # parameters already computed and not read by parameters to compute are released now
+    for par in graph:
+        if par in param_data and nConsumer[par] == 0:
+            param_data.pop(par)
+
+    out_data = {}
+
+    def _task(par):
+        meta = param_meta[par]
+        coef = tf_coef.get(par)
+        tf = get_transfer_function(meta['tf'], kernel=kernel and all(np.ndim(c) == 0 for c in coef or []))
+        with span(f'tf:{par}', tf=meta['tf']) as rec:
+            native = as_storage(tf(attr_data=attr_data, param_data=param_data, param_cfg=meta, coef=coef))
+            if rec is not None:
+                rec.update(array_info(native))
+        result = None
+        if meta.get('write', True):
+            if post is None:
+                result = native
+            else:
+                with span(f'scale:{par}'):
+                    result = post(par, native)
+        return native, result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+
+        def _submit_ready():
+            for par in [par for par in todo if nDeps[par] == 0]:
+                todo.remove(par)
+                # worker thread runs in copy of context, with precision policy of caller (see precision.py)
+                running[executor.submit(contextvars.copy_context().run, _task, par)] = par
+
+        _submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                par = running.pop(future)
+                native, result = future.result()  # re-raise exception in transfer function
+
+                if param_meta[par].get('write', True):
+                    out_data[par] = result
+
+                param_data[par] = native
+                for down in downstream[par]:
+                    nDeps[down] -= 1
+
+                # release native parameter if downstream parameters are all computed
+                for dep in graph[par]:
+                    nConsumer[dep] -= 1
+                    if nConsumer[dep] == 0:
+                        param_data.pop(dep, None)
+                if nConsumer[par] == 0:
+                    param_data.pop(par, None)
+
+            _submit_ready()
+
+    return out_data
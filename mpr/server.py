@@ -0,0 +1,232 @@
+# Resident MPR server keeping geophysical attributes and mapping operators warm in memory
+#
+# ---- protocol (local TCP socket or unix domain socket)
+# each message is 8 byte big-endian length followed by payload
+#   request:  message of json, e.g.,
+#               {"cmd": "run", "coef": {"k_soil": [1.2, -1.0]}, "params": ["k_soil"], "output": "param_k_soil.nc"}
+#             cmd:    "run" (default), "ping" or "shutdown"
+#             coef:   transfer function coefficients replacing default tf_coef of the session
+#             params: (optional) list of parameters returned or written. all parameters with write: True if not given
+#             output: (optional) netcdf written by IO.write_param, path relative to OUTPUT DIRE of io_cfg given to server.
+#                     paths outside OUTPUT DIRE are refused, and output is refused if server has no io_cfg.
+#                     parameters are returned in response if not given
+#   response: message of json header, {"status": "ok" or "error", ...}, and
+#             message of parameters in npz format (empty if written in output).
+#             invalid request (e.g., not json object) gets error response, and connection is kept
+#
+# requests from multiple clients are processed one at a time with shared session (see session.py),
+# so parameters unchanged between requests are not recomputed.
+
+import io
+import os
+import json
+import functools
+import contextvars
+import struct
+import socket
+import asyncio
+import ipaddress
+
+import numpy as np
+
+from mpr.IO import write_param
+
+LOCAL_HOST = '127.0.0.1'
+
+
+class MPRServer():
+    '''
+    input:  session,  MPRSession (see session.py)
+            hru_data, hru_meta, io_cfg: passed to IO.write_param when request has "output". output of request
+                      is written in io_cfg['OUTPUT']['DIRE'] only, and refused if io_cfg is None
+    '''
+
+    def __init__(self, session, hru_data=None, hru_meta=None, io_cfg=None):
+        self.session  = session
+        self.hru_data = hru_data
+        self.hru_meta = hru_meta
+        self.io_cfg   = io_cfg
+        self._server  = None
+        self._lock    = None
+
+    def serve(self, host=LOCAL_HOST, port=0, path=None, ready=None):
+        '''
+        Run server until "shutdown" request. listen to unix domain socket if path is given, otherwise host:port
+        host must be loopback address. ready(address) is called once server is listening
+        '''
+        asyncio.run(self.start(host=host, port=port, path=path, ready=ready))
+
+    async def start(self, host=LOCAL_HOST, port=0, path=None, ready=None):
+        self._lock = asyncio.Lock()
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+            address = path
+        else:
+            _check_local(host)
+            self._server = await asyncio.start_server(self._handle, host, port)
+            address = self._server.sockets[0].getsockname()[:2]
+
+        print(f'\n MPR server listening on {address}', flush=True)
+        if ready is not None:
+            ready(address)
+
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    msg = await _read_msg(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                request = None
+                try:
+                    request = _parse_request(msg)
+                    async with self._lock:
+                        # executor thread runs in copy of context, with precision policy of server (see precision.py)
+                        header, blob = await loop.run_in_executor(None, functools.partial(contextvars.copy_context().run,
+                                                                                          self._process, request))
+                except Exception as e:
+                    header, blob = {'status': 'error', 'message': f'{type(e).__name__}: {e}'}, b''
+
+                writer.write(_pack(json.dumps(header).encode()) + _pack(blob))
+                await writer.drain()
+
+                if request is not None and request.get('cmd') == 'shutdown':
+                    self._server.close()
+                    break
+        finally:
+            writer.close()
+
+    def _process(self, request):
+        cmd = request.get('cmd', 'run')
+        if cmd in ['ping', 'shutdown']:
+            return {'status': 'ok'}, b''
+        elif cmd != 'run':
+            raise ValueError(f'unknown command: {cmd}')
+
+        tf_coef = dict(self.session.tf_coef)
+        tf_coef.update(request.get('coef') or {})
+        param_data = self.session.run(tf_coef)
+
+        par_list = request.get('params') or list(param_data.keys())
+        for par in par_list:
+            if not par in param_data:
+                raise KeyError(f'parameter "{par}" is not computed')
+
+        if request.get('output'):
+            output = self._output_path(request['output'])
+            write_param(param_data, self.session.param_meta, self.hru_data, self.hru_meta, self.io_cfg,
+                        par_list=par_list, output=output)
+            return {'status': 'ok', 'output': output}, b''
+
+        buf = io.BytesIO()
+        np.savez(buf, **{par: param_data[par] for par in par_list})
+        return {'status': 'ok', 'params': par_list}, buf.getvalue()
+
+    def _output_path(self, output):
+        # output path of request resolved in OUTPUT DIRE. raise ValueError if it is outside
+        if self.io_cfg is None:
+            raise ValueError('output is not allowed: server has no io_cfg')
+        root = os.path.realpath(self.io_cfg['OUTPUT']['DIRE'])
+        path = os.path.realpath(os.path.join(root, output))
+        if os.path.commonpath([root, path]) != root or path == root:
+            raise ValueError(f'output must be in OUTPUT DIRE ({root}): {output}')
+        return path
+
+
+class MPRClient():
+    '''
+    Client of MPRServer
+
+    e.g.,
+      with MPRClient(port=port) as client:
+          param_data = client.run({'k_soil': [1.2, -1.0]})
+    '''
+
+    def __init__(self, host=LOCAL_HOST, port=None, path=None, timeout=None):
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        else:
+            _check_local(host)
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+
+    def run(self, tf_coef=None, params=None, output=None):
+        '''
+        Return dictionary {parameter name: numpy array}, or output file name if output is given
+        '''
+        header, blob = self.request({'cmd': 'run', 'coef': tf_coef or {}, 'params': params, 'output': output})
+        if output:
+            return header['output']
+        with np.load(io.BytesIO(blob)) as npz:
+            return {par: npz[par] for par in header['params']}
+
+    def ping(self):
+        return self.request({'cmd': 'ping'})[0]['status'] == 'ok'
+
+    def shutdown(self):
+        self.request({'cmd': 'shutdown'})
+
+    def request(self, request):
+        self.sock.sendall(_pack(json.dumps(request).encode()))
+        header = json.loads(self._recv_msg())
+        blob = self._recv_msg()
+        if header['status'] != 'ok':
+            raise RuntimeError(header.get('message'))
+        return header, blob
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _recv_msg(self):
+        size = struct.unpack('!Q', self._recv_exact(8))[0]
+        return self._recv_exact(size)
+
+    def _recv_exact(self, size):
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.sock.recv(min(size - len(buf), 1 << 20))
+            if not chunk:
+                raise ConnectionError('connection closed by MPR server')
+            buf += chunk
+        return bytes(buf)
+
+
+def _parse_request(msg):
+    # json object of request. raise ValueError if request is not valid (see protocol)
+    request = json.loads(msg)
+    if not isinstance(request, dict):
+        raise ValueError(f'request must be json object: {type(request).__name__}')
+    for key, types in [('cmd', str), ('coef', dict), ('params', list), ('output', str)]:
+        if request.get(key) is not None and not isinstance(request[key], types):
+            raise ValueError(f'"{key}" of request must be {types.__name__}')
+    return request
+
+
+def _pack(payload):
+    return struct.pack('!Q', len(payload)) + payload
+
+
+async def _read_msg(reader):
+    size = struct.unpack('!Q', await reader.readexactly(8))[0]
+    return await reader.readexactly(size)
+
+
+def _check_local(host):
+    # refuse non loopback address, MPR server is not meant to be exposed to network
+    if not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback:
+        raise ValueError(f'MPR server accepts loopback address only: {host}')
@@ -0,0 +1,153 @@
+# Memoizing MPR session for repeated evaluation with different transfer function coefficients (e.g., calibration)
+#
+# native (gathered) and scaled parameters are cached with key of
+#   (parameter name, its coefficients, keys of upstream parameters)
+# so that changing coefficients of one parameter recomputes only the parameter and its downstream parameters,
+#   e.g., k_soil -> k_soil, aquiferBaseflowRate
+# key also includes precision policy and attributes of the session (attr_data set to session gets new token),
+# so that cached parameters are not returned for other precision or attributes.
+# cached parameters are evicted in least recently used order when total size exceeds max_bytes.
+# returned parameters are read-only, since they are shared with the cache.
+
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+import xarray as xr
+
+from mpr.scaling import FILL_VALUE, comp_remap_operator
+from mpr.scheduler import build_param_graph, topological_order
+from mpr.transfer_function import get_transfer_function
+from mpr.precision import as_storage, get_policy
+from mpr.pipeline import get_spatial_dims, gather_attributes, scale_param
+
+_attr_token = itertools.count()
+
+
+class MPRSession():
+    '''
+    input:  attr_data,    xarray dataset, geophysical attributes (see IO.load_geophysical_attributes)
+            mapping_data, dictionary, mapping data (see IO.load_mapping_data)
+            param_meta,   dictionary, parameter config (['param'] in param_meta.yml)
+            tf_coef,      dictionary, default transfer function coefficient (tf_coef.yml)
+            max_bytes,    maximum size of cached parameters [byte]. no limit if None
+            others,       see pipeline.run_mpr
+
+    e.g.,
+      session = MPRSession(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+      param_data = session.run()              # compute all
+      tf_coef['k_soil'] = [1.2, -1.0]
+      param_data = session.run(tf_coef)       # recompute k_soil and aquiferBaseflowRate only
+      session.attr_data = gathered            # new attributes (gathered at cells of remap_op), all recomputed
+    '''
+
+    def __init__(self, attr_data, mapping_data, param_meta, tf_coef, layer_op=None, pvalue=1.0,
+                 remap_op=None, spatial_dims=None, max_bytes=None, kernel=False, default=FILL_VALUE):
+
+        if spatial_dims is None:
+            spatial_dims = get_spatial_dims(attr_data)
+        if remap_op is None:
+            remap_op = comp_remap_operator(mapping_data, tuple(attr_data.sizes[dim] for dim in spatial_dims))
+
+        self.attr_data  = gather_attributes(attr_data, remap_op, spatial_dims=spatial_dims).load()
+        self.remap_op   = remap_op
+        self.layer_op   = layer_op
+        self.param_meta = param_meta
+        self.tf_coef    = tf_coef
+        self.pvalue     = pvalue
+        self.default    = default
+        self.max_bytes  = max_bytes
+        self.kernel     = kernel
+
+        self.graph = build_param_graph(param_meta)
+        self.order = topological_order(self.graph)
+
+        self.cache  = OrderedDict()  # key: {'native': , 'scaled': , 'nbytes': }
+        self.nbytes = 0
+        self.stats  = {'hit': 0, 'miss': 0, 'evict': 0}
+
+    @property
+    def attr_data(self):
+        return self._attr_data
+
+    @attr_data.setter
+    def attr_data(self, attr_data):
+        self._attr_data = attr_data
+        self.attr_token = next(_attr_token)
+
+    def run(self, tf_coef=None):
+        '''
+        Return dictionary, {parameter name: read-only numpy array [(lyr), hru]} for parameters with write: True
+        tf_coef: transfer function coefficients. coefficients given at initialization if None
+        '''
+        if tf_coef is None:
+            tf_coef = self.tf_coef
+
+        keys = self.get_keys(tf_coef)
+
+        out_data = {}
+        for par in self.order:
+            if self.param_meta[par].get('write', True):
+                out_data[par] = self._get(par, keys, tf_coef)['scaled']
+
+        return out_data
+
+    def get_keys(self, tf_coef):
+        '''
+        Return dictionary, {parameter name: cache key}
+        '''
+        state = (self.attr_token, tuple(sorted(get_policy().items())))
+        keys = {}
+        for par in self.order:
+            coef = tf_coef.get(par)
+            coef = tuple(float(c) for c in coef) if coef else ()
+            keys[par] = (par, coef, state, tuple(keys[dep] for dep in self.graph[par]))
+        return keys
+
+    def clear(self):
+        self.cache.clear()
+        self.nbytes = 0
+
+    def _get(self, par, keys, tf_coef):
+        key = keys[par]
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache.move_to_end(key)
+            self.stats['hit'] += 1
+            return entry
+
+        self.stats['miss'] += 1
+        meta = self.param_meta[par]
+        param_data = {dep: self._get(dep, keys, tf_coef)['native'] for dep in self.graph[par]}
+
+        tf = get_transfer_function(meta['tf'], kernel=self.kernel)
+        native = as_storage(tf(attr_data=self.attr_data, param_data=param_data, param_cfg=meta, coef=tf_coef.get(par)))
+        if isinstance(native, xr.DataArray):
+            native = native.load()
+
+        scaled = None
+        if meta.get('write', True):
+            scaled = scale_param(native, meta, self.remap_op, layer_op=self.layer_op, pvalue=self.pvalue, default=self.default)
+            scaled.setflags(write=False)
+
+        entry = {'native': native, 'scaled': scaled, 'nbytes': _nbytes(native) + _nbytes(scaled)}
+        self.cache[key] = entry
+        self.nbytes += entry['nbytes']
+        self._evict()
+
+        return entry
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        # keep the most recently used entry at least
+        while self.nbytes > self.max_bytes and len(self.cache) > 1:
+            key, entry = self.cache.popitem(last=False)
+            self.nbytes -= entry['nbytes']
+            self.stats['evict'] += 1
+
+
+def _nbytes(array):
+    if array is None:
+        return 0
+    return int(getattr(array, 'nbytes', np.asarray(array).nbytes))
@@ -0,0 +1,268 @@
+# Shared memory and memory-mapped file output of parameters (zero-copy handoff to coupled model)
+#
+# parameters are written by IO.ParamWriter (backend "shared") and read by open_shared_params without copy.
+#
+# ---- source
+# "shm://<name>":  POSIX shared memory (/dev/shm/<name> on linux). kept until unlink_shared_params(source)
+# others:          memory-mapped file, e.g., param.mpr (/dev/shm/param.mpr to keep it in memory)
+#
+# ---- layout (version 1, little endian)
+# [0:8]    magic, b'MPRPARAM'
+# [8:12]   layout version, uint32
+# [12:16]  reserved, uint32
+# [16:24]  header size [byte], uint64
+# [24:32]  sequence, uint64. odd while writer is open, even once parameters are published (writer closed)
+# [32:]    header, json (utf-8)
+# [offset] arrays in C order, each aligned to ALIGNMENT bytes from start of buffer
+#
+# header:
+#   {'version': 1, 'attrs': {global attributes}, 'fill_value': -9999.0,
+#    'hru':       {'name': 'hruId', 'dims': ['hru'], 'shape': [nHRU], 'dtype': '<i8', 'offset': byte, 'attrs': {}},
+#    'variables': {name: {'dims': ['lyr', 'hru'], 'shape': [nLyr, nHRU], 'dtype': '<f4', 'offset': byte,
+#                         'attrs': {'long_name': , 'units': }}}}
+#
+# e.g., consumer (coupled model side)
+#   with open_shared_params('shm://mpr_param') as params:
+#       seq = params.sequence
+#       k_soil = params['k_soil']     # numpy array [lyr, hru], view of shared memory
+#       hru_id = params.hru
+#       ...
+#       assert params.sequence == seq  # parameters were not re-published while reading
+
+import os
+import json
+import mmap
+import struct
+
+import numpy as np
+
+MAGIC = b'MPRPARAM'
+LAYOUT_VERSION = 1
+ALIGNMENT = 64
+PREFIX = struct.Struct('<8sIIQQ')  # magic, version, reserved, header size, sequence
+SEQUENCE_OFFSET = 24
+SHM_PREFIX = 'shm://'
+
+
+def is_shared_output(output):
+    '''
+    True if output is shared memory ("shm://<name>") or memory-mapped parameter file (".mpr")
+    '''
+    output = str(output)
+    return output.startswith(SHM_PREFIX) or output.endswith('.mpr')
+
+
+def build_header(hru_data, hru_name, hru_dim, variables, dtype, attrs=None, fill_value=-9999.0):
+    '''
+    Build header of layout and return (header, buffer size)
+
+    input:  hru_data,  numpy array, HRU ID
+            hru_name,  name of HRU ID variable, e.g., hruId
+            hru_dim,   name of HRU dimension, e.g., hru
+            variables, dictionary, {name: {'dims': , 'shape': , 'attrs': }} (see IO.ParamWriter)
+            dtype,     dtype of parameter variables
+    '''
+    hru_data = np.asarray(hru_data)
+    header = {'version': LAYOUT_VERSION, 'attrs': dict(attrs or {}), 'fill_value': fill_value,
+              'hru': {'name': hru_name, 'dims': [hru_dim], 'shape': [len(hru_data)],
+                      'dtype': hru_data.dtype.newbyteorder('<').str, 'attrs': {}},
+              'variables': {}}
+    for name, var in variables.items():
+        header['variables'][name] = {'dims': list(var['dims']), 'shape': [int(n) for n in var['shape']],
+                                     'dtype': np.dtype(dtype).newbyteorder('<').str, 'attrs': dict(var['attrs'])}
+    entries = [header['hru']] + list(header['variables'].values())
+
+    # header size with placeholder offsets is upper bound of header size with actual offsets
+    for entry in entries:
+        entry['offset'] = 10**15
+    offset = _align(PREFIX.size + len(_encode(header)))
+    for entry in entries:
+        entry['offset'] = offset
+        offset = _align(offset + int(np.prod(entry['shape'])) * np.dtype(entry['dtype']).itemsize)
+
+    return header, offset
+
+
+def create_buffer(source, size):
+    '''
+    Create shared memory or memory-mapped file of size bytes (existing one is replaced). return (buffer, handle)
+    '''
+    if str(source).startswith(SHM_PREFIX):
+        name = _shm_name(source)
+        try:
+            _unlink_shm(_attach_shm(name))
+        except FileNotFoundError:
+            pass
+        shm = _attach_shm(name, create=True, size=size)
+        return shm.buf, shm
+
+    with open(source, 'w+b') as f:
+        f.truncate(size)
+        mm = mmap.mmap(f.fileno(), size)
+    return memoryview(mm), mm
+
+
+def attach_buffer(source, readonly=True):
+    '''
+    Attach to existing shared memory or memory-mapped file. return (buffer, handle)
+    '''
+    if str(source).startswith(SHM_PREFIX):
+        shm = _attach_shm(_shm_name(source))
+        return (shm.buf.toreadonly() if readonly else shm.buf), shm
+
+    with open(source, 'rb' if readonly else 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+    return memoryview(mm), mm
+
+
+def handle_buffer(handle, readonly=True):
+    '''
+    Return buffer of open handle of attach_buffer (shared memory or memory-mapped file)
+    '''
+    buf = memoryview(getattr(handle, '_mmap', handle))  # SharedMemory keeps its mmap after failed close()
+    return buf.toreadonly() if readonly else buf
+
+
+def write_header(buf, header, sequence=1):
+    '''
+    Write prefix and header to buffer
+    '''
+    data = _encode(header)
+    PREFIX.pack_into(buf, 0, MAGIC, LAYOUT_VERSION, 0, len(data), sequence)
+    buf[PREFIX.size:PREFIX.size+len(data)] = data
+
+
+def read_header(buf):
+    '''
+    Read header from buffer. raise ValueError if buffer is not parameter layout or layout version is not supported
+    '''
+    magic, version, _, size, _ = PREFIX.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError('not MPR parameter buffer (magic: %s)' % magic)
+    if version != LAYOUT_VERSION:
+        raise ValueError(f'unsupported layout version {version} (supported: {LAYOUT_VERSION})')
+    return json.loads(bytes(buf[PREFIX.size:PREFIX.size+size]).decode('utf-8'))
+
+
+def get_sequence(buf):
+    return struct.unpack_from('<Q', buf, SEQUENCE_OFFSET)[0]
+
+
+def set_sequence(buf, sequence):
+    struct.pack_into('<Q', buf, SEQUENCE_OFFSET, sequence)
+
+
+def array_view(buf, entry):
+    '''
+    Return numpy array of header entry (hru or variable), view of buffer
+
+    array holds buffer export of shared memory or memory-mapped file, so closing it raises BufferError
+    while the array is alive, instead of leaving array pointing to unmapped memory
+    '''
+    shape = tuple(entry['shape'])
+    count = int(np.prod(shape))
+    return np.frombuffer(buf, dtype=np.dtype(entry['dtype']), count=count, offset=entry['offset']).reshape(shape)
+
+
+class SharedParams():
+    '''
+    Zero-copy reader of parameters in shared memory or memory-mapped file (see open_shared_params)
+
+    params[name]:    numpy array of parameter (read-only view)
+    params.hru:      numpy array of HRU ID
+    params.header:   dictionary, header of layout (dims, units etc. of variables in header['variables'])
+    params.sequence: sequence number, odd while writer is open (see layout)
+
+    arrays still referenced prevent closing shared memory (close() raises BufferError and params stay open),
+    copy arrays to keep them after close()
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        self._buf, self._handle = attach_buffer(source, readonly=True)
+        self.header = read_header(self._buf)
+        self._attach_arrays()
+
+    def _attach_arrays(self):
+        self.hru = array_view(self._buf, self.header['hru'])
+        self._data = {name: array_view(self._buf, entry) for name, entry in self.header['variables'].items()}
+
+    @property
+    def sequence(self):
+        return get_sequence(self._buf)
+
+    def keys(self):
+        return self._data.keys()
+
+    def __getitem__(self, name):
+        return self._data[name]
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def close(self):
+        if self._handle is None:
+            return
+        self.hru, self._data = None, {}
+        self._buf.release()
+        try:
+            self._handle.close()
+        except BufferError: # arrays still referenced, keep open
+            self._buf = handle_buffer(self._handle, readonly=True)
+            self._attach_arrays()
+            raise
+        self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_shared_params(source):
+    '''
+    Attach to parameters published by IO.ParamWriter with shared output ("shm://<name>" or "<file>.mpr")
+    '''
+    return SharedParams(source)
+
+
+def unlink_shared_params(source):
+    '''
+    Remove shared memory or memory-mapped file
+    '''
+    if str(source).startswith(SHM_PREFIX):
+        _unlink_shm(_attach_shm(_shm_name(source)))
+    else:
+        os.remove(source)
+
+
+def _attach_shm(name, create=False, size=0):
+    # shared memory is not tracked by resource tracker, which would remove it when this process exits
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError: # python < 3.13
+        shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _unlink_shm(shm):
+    from multiprocessing import shared_memory, resource_tracker
+    shm.close()
+    if not 'track' in shared_memory.SharedMemory.__init__.__code__.co_varnames: # python < 3.13, unlink() unregisters
+        resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def _shm_name(source):
+    return str(source)[len(SHM_PREFIX):]
+
+
+def _encode(header):
+    return json.dumps(header, default=str).encode('utf-8')
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
@@ -14,14 +14,67 @@
 
 import numpy as np
 import mpr.constant as const
+from mpr.precision import get_dtype
+
+# inputs of transfer functions, geophysical attributes (including derived attributes and domain statistics,
+# see DERIVED_ATTR and DOMAIN_STAT) and
+# upstream parameters read by each transfer function. attributes to be loaded (see IO.load_geophysical_attributes)
+# and parameter dependency (see scheduler.py) are determined from this table, so update it with transfer function
+#   <transfer_function_name>: {'attr': [attribute names], 'param': [parameter names]}
+TF_INPUTS = {
+    'norm_prec_tf1':           {'attr': ['prec_annual', 'prec_annual_mean'], 'param': []},
+    'retention_slope_tf1':     {'attr': ['clay_pct', 'sand_pct'], 'param': []},
+    'matric_potential_tf1':    {'attr': ['sand_pct', 'silt_pct'], 'param': []},
+    'theta_sat_tf1':           {'attr': ['clay_pct', 'bulk_density'], 'param': []},
+    'theta_sat_tf2':           {'attr': ['sand_pct', 'clay_pct'], 'param': []},
+    'fieldCapacity_tf1':       {'attr': [], 'param': ['theta_sat', 'matric_potential', 'retention_slope']},
+    'critSoilWilting_tf1':     {'attr': [], 'param': ['theta_sat', 'matric_potential', 'retention_slope']},
+    'critSoilTranspire_tf1':   {'attr': [], 'param': ['theta_sat', 'critSoilWilting']},
+    'theta_res_tf1':           {'attr': [], 'param': ['critSoilWilting']},
+    'k_soil_tf1':              {'attr': ['sand_pct', 'clay_pct'], 'param': ['norm_prec']},
+    'k_macropore_tf1':         {'attr': [], 'param': ['norm_prec']},
+    'qSurfScale_tf1':          {'attr': ['slope_mean'], 'param': []},
+    'aquiferBaseflowExp_tf1':  {'attr': ['slope_mean'], 'param': []},
+    'aquiferBaseflowRate_tf1': {'attr': [], 'param': ['k_soil']},
+    'Fcapil_tf1':              {'attr': [], 'param': ['qSurfScale']},
+    'summerLAI_tf1':           {'attr': ['lai_summer'], 'param': []},
+    'heightCanopyTop_tf1':     {'attr': ['ch'], 'param': []},
+    'heightCanopyBottom_tf1':  {'attr': [], 'param': ['heightCanopyTop']},
+    'frozenPrecipMultip_tf1':  {'attr': ['wind_winter'], 'param': []},
+    'vGn_alpha_tf1':           {'attr': ['sand_pct', 'soc', 'bulk_density', 'clay_pct'], 'param': []},
+    'vGn_n_tf1':               {'attr': ['sand_pct', 'clay_pct'], 'param': []},
+    'wettingFrontSuction_tf1': {'attr': [], 'param': ['retention_slope', 'matric_potential']},
+    'zScale_TOPMODEL_tf1':     {'attr': [], 'param': []},
+    'routingGammaScale_tf1':   {'attr': [], 'param': []},
+    'routingGammaShape_tf1':   {'attr': [], 'param': []},
+}
+
+# domain statistics, attribute (or derived attribute) reduced over entire source grid, e.g., domain mean.
+# these are computed over the full grid before attributes are gathered to cells, split into tiles or windowed
+# (see pipeline.gather_attributes and IO.load_geophysical_attributes), so that parameters do not depend on
+# the cells evaluated. read in transfer functions with domain_statistic(attr_data, '<domain statistic name>')
+#   <domain statistic name>: {'attr': attribute name, 'stat': reduction, DataArray method, e.g., mean}
+DOMAIN_STAT = {
+    'prec_annual_mean': {'attr': 'prec_annual', 'stat': 'mean'},
+}
+
+# derived attributes, monthly climatology reduced to mean over months.
+# these are computed once when attributes are loaded (see IO.load_geophysical_attributes), and
+# read in transfer functions with derived_attribute(attr_data, '<derived attribute name>')
+#   <derived attribute name>: {'attr': monthly attribute name, 'months': months averaged (all months if None)}
+DERIVED_ATTR = {
+    'prec_annual': {'attr': 'prec', 'months': None},
+    'lai_summer':  {'attr': 'lai',  'months': [6,7,8]},
+    'wind_winter': {'attr': 'wind', 'months': [12,1,2]},
+}
 
 
 class transfer_function():
 
     def norm_prec_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
         # normalized precipitation
-        a = attr_data['prec'].mean(dim='month')
-        b = a/a.mean()
+        a = derived_attribute(attr_data, 'prec_annual')
+        b = a/domain_statistic(attr_data, 'prec_annual_mean')
         return b
 
     def retention_slope_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
@@ -88,7 +141,7 @@ class transfer_function():
         return coef[0]*a
 
     def summerLAI_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
-        a = attr_data['lai'].sel(month=[6,7,8]).mean(dim='month')/10
+        a = derived_attribute(attr_data, 'lai_summer')/10
         return coef[0]*a
 
     def heightCanopyTop_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
@@ -99,7 +152,7 @@ class transfer_function():
         return coef[0]*param_data['heightCanopyTop']
 
     def frozenPrecipMultip_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
-        a = logistic_fun(attr_data['wind'].sel(month=[12,1,2]).mean(dim='month'), A=1.0, L=param_cfg['max'], x0=coef[0], k=coef[1])
+        a = logistic_fun(derived_attribute(attr_data, 'wind_winter'), A=1.0, L=param_cfg['max'], x0=coef[0], k=coef[1])
         return a
 
     def vGn_alpha_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
@@ -130,8 +183,448 @@ class transfer_function():
         pass
 
 
+class transfer_kernel():
+    # numpy kernels of transfer functions (kernel mode, see get_transfer_function)
+    #
+    # same convention and arguments as transfer_function, but attributes and parameters are read as numpy arrays
+    # and each expression is evaluated in one output array in place (and one scratch array for second terms),
+    # instead of allocating full size temporaries with xarray metadata at every operation.
+    # operations are in the same order and dtype as transfer_function, so results are identical.
+    # returns numpy array [(lyr), cell] (or [(lyr), lat, lon])
+
+    def norm_prec_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return np.divide(_attr(attr_data, 'prec_annual'), _attr(attr_data, 'prec_annual_mean'))
+
+    def retention_slope_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(attr_data, 'clay_pct'), 0.157)
+        np.add(out, 3.1, out=out)
+        np.subtract(out, np.multiply(_attr(attr_data, 'sand_pct'), 0.003, out=np.empty_like(out)), out=out)
+        np.multiply(out, coef[0], out=out)
+        return out
+
+    def matric_potential_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(attr_data, 'sand_pct'), 0.0095)
+        np.subtract(1.54, out, out=out)
+        np.add(out, np.multiply(_attr(attr_data, 'silt_pct'), 0.0063, out=np.empty_like(out)), out=out)
+        np.power(10.0, out, out=out)
+        np.multiply(out, -1, out=out)
+        np.multiply(out, const.cmH2O2kPa, out=out)
+        np.multiply(out, coef[0], out=out)
+        return out
+
+    def theta_sat_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(attr_data, 'clay_pct'), 0.001)
+        np.add(out, 0.788, out=out)
+        scratch = np.multiply(_attr(attr_data, 'bulk_density'), 0.263, out=np.empty_like(out))
+        np.multiply(scratch, const.KGCM2GCCM, out=scratch)
+        np.subtract(out, scratch, out=out)
+        np.multiply(out, coef[0], out=out)
+        return _logistic(out, A=param_cfg['min'], L=param_cfg['max'], x0=(param_cfg['max']-param_cfg['min'])/2, k=12.5, out=out)
+
+    def theta_sat_tf2(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(attr_data, 'sand_pct'), 0.142)
+        np.subtract(50.5, out, out=out)
+        np.subtract(out, np.multiply(_attr(attr_data, 'clay_pct'), 0.037, out=np.empty_like(out)), out=out)
+        np.multiply(out, coef[0], out=out)
+        np.divide(out, 100.0, out=out)
+        return out
+
+    def fieldCapacity_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return _soil_water(-10.0, param_data, coef)
+
+    def critSoilWilting_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return _soil_water(-1500.0, param_data, coef)
+
+    def critSoilTranspire_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(param_data, 'theta_sat'), coef[0])
+        np.add(out, np.multiply(_attr(param_data, 'critSoilWilting'), 1.0 - coef[0], out=np.empty_like(out)), out=out)
+        return out
+
+    def theta_res_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return np.multiply(_attr(param_data, 'critSoilWilting'), coef[0])
+
+    def k_soil_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(attr_data, 'sand_pct'), 0.0126)
+        np.add(out, -0.6, out=out)
+        np.subtract(out, np.multiply(_attr(attr_data, 'clay_pct'), 0.0064, out=np.empty_like(out)), out=out)
+        np.power(10.0, out, out=out)
+        np.multiply(out, coef[0], out=out)
+        np.multiply(out, const.INCH2M, out=out)
+        np.divide(out, const.HR2SEC, out=out)
+        np.multiply(out, _logistic(_attr(param_data, 'norm_prec'), A=0.5, L=1.5, x0=1.0, k=coef[1]), out=out)
+        return out
+
+    def k_macropore_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return _logistic(_attr(param_data, 'norm_prec'), A=0.0005, L=0.09, x0=1.0, k=coef[0])
+
+    def qSurfScale_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return _logistic(_attr(attr_data, 'slope_mean'), A=param_cfg['max'], L=param_cfg['min'], x0=coef[0], k=coef[1])
+
+    def aquiferBaseflowExp_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return _logistic(_attr(attr_data, 'slope_mean'), A=1.0, L=param_cfg['max'], x0=coef[0], k=coef[1])
+
+    def aquiferBaseflowRate_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return np.multiply(_attr(param_data, 'k_soil'), 10**coef[0])
+
+    def Fcapil_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(param_data, 'qSurfScale'), 0.0)  # keep missing values of qSurfScale
+        np.add(out, 1.0, out=out)
+        np.multiply(out, coef[0], out=out)
+        return out
+
+    def summerLAI_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.divide(_attr(attr_data, 'lai_summer'), 10)
+        np.multiply(out, coef[0], out=out)
+        return out
+
+    def heightCanopyTop_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        ch = _attr(attr_data, 'ch')
+        out = np.where(ch>0, ch, 0.1)
+        np.multiply(out, coef[0], out=out)
+        return out
+
+    def heightCanopyBottom_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return np.multiply(_attr(param_data, 'heightCanopyTop'), coef[0])
+
+    def frozenPrecipMultip_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        return _logistic(_attr(attr_data, 'wind_winter'), A=1.0, L=param_cfg['max'], x0=coef[0], k=coef[1])
+
+    def vGn_alpha_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        out = np.multiply(_attr(attr_data, 'sand_pct'), 0.025)
+        np.add(out, -2.486, out=out)
+        scratch = np.multiply(_attr(attr_data, 'soc'), 0.351, out=np.empty_like(out))
+        np.multiply(scratch, 0.1, out=scratch)
+        np.subtract(out, scratch, out=out)
+        np.multiply(_attr(attr_data, 'bulk_density'), 2.617, out=scratch)
+        np.multiply(scratch, const.KGCM2GCCM, out=scratch)
+        np.subtract(out, scratch, out=out)
+        np.subtract(out, np.multiply(_attr(attr_data, 'clay_pct'), 0.023, out=scratch), out=out)
+        np.exp(out, out=out)
+        np.multiply(out, -1.0, out=out)
+        np.divide(out, const.CM2M, out=out)
+        np.multiply(out, coef[0], out=out)
+        return out
+
+    def vGn_n_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        sand = _attr(attr_data, 'sand_pct')
+        out = np.multiply(sand, 0.009)
+        np.add(out, 0.053, out=out)
+        scratch = np.multiply(_attr(attr_data, 'clay_pct'), 0.013, out=np.empty_like(out))
+        np.subtract(out, scratch, out=out)
+        np.square(sand, out=scratch)
+        np.multiply(scratch, 0.00015, out=scratch)
+        np.add(out, scratch, out=out)
+        np.exp(out, out=out)
+        np.multiply(out, coef[0], out=out)
+        np.copyto(out, 1.01, where=~(out>=1.0))  # missing values become 1.01 as in DataArray.where
+        return out
+
+    def wettingFrontSuction_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None):
+        retention_slope = _attr(param_data, 'retention_slope')
+        out = np.multiply(retention_slope, 2.0)
+        np.add(out, 3.0, out=out)
+        np.divide(out, np.add(retention_slope, 3.0, out=np.empty_like(out)), out=out)
+        np.multiply(out, _attr(param_data, 'matric_potential'), out=out)
+        np.multiply(out, const.kPa2mH2O, out=out)
+        np.multiply(out, -1.0, out=out)
+        np.multiply(out, coef[0], out=out)
+        return out
+
+
+class transfer_jvp():
+    # forward-mode derivatives of transfer functions, Jacobian-vector products w.r.t. coefficients (see gradient.py)
+    #
+    # def <transfer_function_name>(attr_data, param_data, param_cfg, coef, dparam, dcoef):
+    #
+    #   -- additional arguments
+    #   dparam: dictionary, tangent of upstream parameters, numpy array [nDir, (lyr), cell] or None (zero)
+    #   dcoef:  list,       tangent of coefficients, numpy array [nDir, 1, ..] broadcast to parameter or None (zero)
+    #   return: tangent of parameter, numpy array [nDir, (lyr), cell] in accumulation precision, or None (zero)
+    #
+    # attributes and parameters are read as numpy arrays in accumulation precision (see precision.py).
+    # derivatives of where(), e.g., heightCanopyTop_tf1 and vGn_n_tf1, are zero at replaced values
+
+    def norm_prec_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return None
+
+    def retention_slope_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        a = 3.1 + 0.157*_value(attr_data, 'clay_pct') - 0.003*_value(attr_data, 'sand_pct')
+        return _tmul(a, dcoef[0])
+
+    def matric_potential_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        a = -1*(10.0**(1.54 - 0.0095*_value(attr_data, 'sand_pct') + 0.0063*_value(attr_data, 'silt_pct')))*const.cmH2O2kPa
+        return _tmul(a, dcoef[0])
+
+    def theta_sat_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        a = 0.788 + 0.001*_value(attr_data, 'clay_pct') - 0.263*_value(attr_data, 'bulk_density')*const.KGCM2GCCM
+        return _dlogistic(coef[0]*a, _tmul(a, dcoef[0]), A=param_cfg['min'], L=param_cfg['max'],
+                          x0=(param_cfg['max']-param_cfg['min'])/2, k=12.5)
+
+    def theta_sat_tf2(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        a = 50.5 - 0.142*_value(attr_data, 'sand_pct') - 0.037*_value(attr_data, 'clay_pct')
+        return _tmul(a/100.0, dcoef[0])
+
+    def fieldCapacity_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _dsoil_water(-10.0, param_data, coef, dparam, dcoef)
+
+    def critSoilWilting_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _dsoil_water(-1500.0, param_data, coef, dparam, dcoef)
+
+    def critSoilTranspire_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        theta_sat, wilting = _value(param_data, 'theta_sat'), _value(param_data, 'critSoilWilting')
+        return _tadd(_tmul(theta_sat - wilting, dcoef[0]), _tmul(coef[0], dparam['theta_sat']),
+                     _tmul(1.0 - coef[0], dparam['critSoilWilting']))
+
+    def theta_res_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _tadd(_tmul(_value(param_data, 'critSoilWilting'), dcoef[0]), _tmul(coef[0], dparam['critSoilWilting']))
+
+    def k_soil_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        a = 10.0**(-0.6 + 0.0126*_value(attr_data, 'sand_pct') - 0.0064*_value(attr_data, 'clay_pct'))*const.INCH2M/const.HR2SEC
+        norm_prec = _value(param_data, 'norm_prec')
+        b  = logistic_fun(norm_prec, A=0.5, L=1.5, x0=1.0, k=coef[1])
+        db = _dlogistic(norm_prec, dparam['norm_prec'], A=0.5, L=1.5, x0=1.0, k=coef[1], dk=dcoef[1])
+        return _tadd(_tmul(a*b, dcoef[0]), _tmul(coef[0]*a, db))
+
+    def k_macropore_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _dlogistic(_value(param_data, 'norm_prec'), dparam['norm_prec'], A=0.0005, L=0.09, x0=1.0, k=coef[0], dk=dcoef[0])
+
+    def qSurfScale_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _dlogistic(_value(attr_data, 'slope_mean'), None, A=param_cfg['max'], L=param_cfg['min'], x0=coef[0], k=coef[1],
+                          dx0=dcoef[0], dk=dcoef[1])
+
+    def aquiferBaseflowExp_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _dlogistic(_value(attr_data, 'slope_mean'), None, A=1.0, L=param_cfg['max'], x0=coef[0], k=coef[1],
+                          dx0=dcoef[0], dk=dcoef[1])
+
+    def aquiferBaseflowRate_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        k_soil = _value(param_data, 'k_soil')
+        return _tadd(_tmul(np.log(10.0)*(10**coef[0])*k_soil, dcoef[0]), _tmul(10**coef[0], dparam['k_soil']))
+
+    def Fcapil_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _tmul(_value(param_data, 'qSurfScale')*0.0 + 1.0, dcoef[0])
+
+    def summerLAI_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _tmul(_value(attr_data, 'lai_summer')/10, dcoef[0])
+
+    def heightCanopyTop_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        ch = _value(attr_data, 'ch')
+        return _tmul(np.where(ch>0, ch, 0.1), dcoef[0])
+
+    def heightCanopyBottom_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _tadd(_tmul(_value(param_data, 'heightCanopyTop'), dcoef[0]), _tmul(coef[0], dparam['heightCanopyTop']))
+
+    def frozenPrecipMultip_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        return _dlogistic(_value(attr_data, 'wind_winter'), None, A=1.0, L=param_cfg['max'], x0=coef[0], k=coef[1],
+                          dx0=dcoef[0], dk=dcoef[1])
+
+    def vGn_alpha_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        a = -1.0*np.exp(-2.486 + 0.025*_value(attr_data, 'sand_pct') - 0.351*_value(attr_data, 'soc')*0.1
+                        - 2.617*_value(attr_data, 'bulk_density')*const.KGCM2GCCM - 0.023*_value(attr_data, 'clay_pct'))/const.CM2M
+        return _tmul(a, dcoef[0])
+
+    def vGn_n_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        sand = _value(attr_data, 'sand_pct')
+        a = np.exp(0.053 + 0.009*sand - 0.013*_value(attr_data, 'clay_pct') + 0.00015*sand**2)
+        return _tmul(np.where(coef[0]*a >= 1.0, a, 0.0), dcoef[0])
+
+    def wettingFrontSuction_tf1(attr_data=None, param_data=None, param_cfg=None, coef=None, dparam=None, dcoef=None):
+        retention_slope, matric_potential = _value(param_data, 'retention_slope'), _value(param_data, 'matric_potential')
+        ratio  = (2.0*retention_slope + 3.0)/(retention_slope + 3.0)
+        dratio = _tmul(3.0/(retention_slope + 3.0)**2, dparam['retention_slope'])
+        factor = const.kPa2mH2O*(-1.0)
+        return _tadd(_tmul(ratio*matric_potential*factor, dcoef[0]),
+                     _tmul(coef[0]*factor, _tadd(_tmul(matric_potential, dratio), _tmul(ratio, dparam['matric_potential']))))
+
+
+def get_transfer_function(tf_name, kernel=False):
+    '''
+    Return transfer function, numpy kernel in transfer_kernel if kernel is True and the kernel is defined
+    '''
+    if kernel and hasattr(transfer_kernel, tf_name):
+        return getattr(transfer_kernel, tf_name)
+    return getattr(transfer_function, tf_name)
+
+
+def get_transfer_jvp(tf_name):
+    '''
+    Return derivative of transfer function in transfer_jvp. raise ValueError if it is not defined
+    '''
+    if not has_transfer_jvp(tf_name):
+        raise ValueError(f'derivative of transfer function "{tf_name}" is not defined in transfer_jvp')
+    return getattr(transfer_jvp, tf_name)
+
+
+def has_transfer_jvp(tf_name):
+    return hasattr(transfer_jvp, tf_name)
+
+
+def derived_attribute(attr_data, name):
+    '''
+    Return derived attribute (see DERIVED_ATTR), precomputed in attr_data or computed from monthly attribute
+    '''
+    if name in attr_data:
+        return attr_data[name]
+    return comp_derived_attribute(attr_data[DERIVED_ATTR[name]['attr']], name)
+
+
+def comp_derived_attribute(da, name):
+    '''
+    Compute derived attribute from monthly attribute DataArray [month, ...]
+    '''
+    months = DERIVED_ATTR[name]['months']
+    if months is not None:
+        da = da.sel(month=months)
+    return da.mean(dim='month').rename(name)
+
+
+def add_derived_attributes(attr_data, names=None):
+    '''
+    Return attr_data with derived attributes whose monthly attribute is in attr_data.
+    names: list of attribute names. derived attributes in names (all the derived attributes if None) are added
+    derived attributes already in attr_data are not recomputed
+    '''
+    new = {}
+    for name in (DERIVED_ATTR if names is None else names):
+        if name in DERIVED_ATTR and not name in attr_data and DERIVED_ATTR[name]['attr'] in attr_data:
+            new[name] = comp_derived_attribute(attr_data[DERIVED_ATTR[name]['attr']], name)
+    return attr_data.assign(new) if new else attr_data
+
+
+def domain_statistic(attr_data, name):
+    '''
+    Return domain statistic (see DOMAIN_STAT), precomputed in attr_data or computed from attributes in attr_data
+    '''
+    if name in attr_data:
+        return attr_data[name]
+    return comp_domain_statistic(_source_attribute(attr_data, DOMAIN_STAT[name]['attr']), name)
+
+
+def comp_domain_statistic(da, name):
+    '''
+    Compute domain statistic from attribute DataArray over all of its cells. return 0-d DataArray
+    '''
+    # loaded in C order, so that the statistic does not depend on chunks or memory layout of source data
+    da = da.copy(data=np.asarray(da.values, order='C'))
+    return getattr(da, DOMAIN_STAT[name]['stat'])().rename(name)
+
+
+def add_domain_statistics(attr_data, names=None):
+    '''
+    Return attr_data with domain statistics whose attribute (or monthly attribute of derived attribute) is in attr_data.
+    names: list of attribute names. domain statistics in names (all the domain statistics if None) are added
+    domain statistics already in attr_data are not recomputed
+    '''
+    new = {}
+    for name in (DOMAIN_STAT if names is None else names):
+        if name in DOMAIN_STAT and not name in attr_data and _has_source(attr_data, DOMAIN_STAT[name]['attr']):
+            new[name] = comp_domain_statistic(_source_attribute(attr_data, DOMAIN_STAT[name]['attr']), name)
+    return attr_data.assign(new) if new else attr_data
+
+
+def get_tf_inputs(tf_name):
+    '''
+    Return geophysical attributes and parameters read by transfer function, declared in TF_INPUTS
+
+    return: dictionary, {'attr': [attribute names], 'param': [parameter names]}
+    '''
+    if not tf_name in TF_INPUTS:
+        raise ValueError(f'inputs of transfer function "{tf_name}" are not declared in TF_INPUTS')
+    return TF_INPUTS[tf_name]
+
+
+def get_required_attributes(param_meta):
+    '''
+    Return list of geophysical attributes read by transfer functions of parameters with compute: True
+    '''
+    attr_list = []
+    for par, meta in param_meta.items():
+        if meta['compute']:
+            attr_list += get_tf_inputs(meta['tf'])['attr']
+    return list(dict.fromkeys(attr_list))
+
+
 def logistic_fun(x, L=1, k=1, x0=0, A=0):
     return A + (L-A) / (1 + np.exp(-k*(x-x0)))
 
+
+def _logistic(x, L=1, k=1, x0=0, A=0, out=None):
+    # logistic_fun in place. x is overwritten if out is x
+    out = np.subtract(x, x0, out=out)
+    np.multiply(out, -k, out=out)
+    np.exp(out, out=out)
+    np.add(out, 1, out=out)
+    np.divide(L-A, out, out=out)
+    np.add(out, A, out=out)
+    return out
+
+
+def _dlogistic(x, dx, L=1, k=1, x0=0, A=0, dk=None, dx0=None):
+    # tangent of logistic_fun(x, L, k, x0, A) given tangents of x, k and x0 (None: zero)
+    if dx is None and dk is None and dx0 is None:
+        return None
+    e = np.exp(-k*(x-x0))
+    slope = (L-A)*e/(1 + e)**2  # d/dz of A + (L-A)/(1+exp(-z)), z = k*(x-x0)
+    return _tmul(slope, _tadd(_tmul(k, dx), _tmul(x-x0, dk), _tmul(-k, dx0)))
+
+
+def _dsoil_water(psi, param_data, coef, dparam, dcoef):
+    # tangent of _soil_water. d(u**v) = u**v*(v*du/u + log(u)*dv), u = psi/matric_potential, v = -1/retention_slope
+    theta_sat = _value(param_data, 'theta_sat')
+    matric_potential, retention_slope = _value(param_data, 'matric_potential'), _value(param_data, 'retention_slope')
+    u = psi/matric_potential
+    g = u**(-1.0/retention_slope)
+    dg = _tmul(g, _tadd(_tmul(1.0/(retention_slope*matric_potential), dparam['matric_potential']),
+                        _tmul(np.log(u)/retention_slope**2, dparam['retention_slope'])))
+    return _tadd(_tmul(theta_sat*g, dcoef[0]), _tmul(coef[0], _tadd(_tmul(g, dparam['theta_sat']), _tmul(theta_sat, dg))))
+
+
+def _value(data, name):
+    # numpy array of attribute or parameter in accumulation precision (see transfer_jvp)
+    return _attr(data, name).astype(get_dtype('accum'), copy=False)
+
+
+def _tmul(a, tangent):
+    # a*tangent, None (zero) if tangent is None
+    return None if tangent is None else a*tangent
+
+
+def _tadd(*tangents):
+    # sum of tangents, None (zero) if all are None
+    tangents = [t for t in tangents if t is not None]
+    if not tangents:
+        return None
+    total = tangents[0]
+    for t in tangents[1:]:
+        total = total + t
+    return total
+
+
+def _soil_water(psi, param_data, coef):
+    # water content at matric potential psi [kPa] (fieldCapacity_tf1, critSoilWilting_tf1)
+    out = np.divide(psi, _attr(param_data, 'matric_potential'))
+    np.power(out, np.divide(-1.0, _attr(param_data, 'retention_slope'), out=np.empty_like(out)), out=out)
+    np.multiply(out, _attr(param_data, 'theta_sat'), out=out)
+    np.multiply(out, coef[0], out=out)
+    return out
+
+
+def _attr(data, name):
+    # numpy array of attribute or parameter (DataArray or numpy array)
+    if name in DOMAIN_STAT:
+        return np.asarray(domain_statistic(data, name))
+    if name in DERIVED_ATTR:
+        return np.asarray(derived_attribute(data, name))
+    return np.asarray(data[name])
+
+
+def _source_attribute(attr_data, name):
+    # attribute, or derived attribute precomputed or computed from monthly attribute
+    return derived_attribute(attr_data, name) if name in DERIVED_ATTR else attr_data[name]
+
+
+def _has_source(attr_data, name):
+    # True if attribute, or derived attribute or its monthly attribute is in attr_data
+    return name in attr_data or (name in DERIVED_ATTR and DERIVED_ATTR[name]['attr'] in attr_data)
+
 # additional van Genuchten parameters
 # Zacharias, S. and Wessolek, G. (2007), Excluding Organic Matter Content from Pedotransfer Predictors of Soil Water Retention. Soil Sci. Soc. Am. J., 71: 43-50. https://doi.org/10.2136/sssaj2006.0098
@@ -17,6 +17,11 @@ with open("README.md") as f:
 
 PYTHON_REQUIRES = '>=3.6'
 
+INSTALL_REQUIRES = ['numpy', 'scipy', 'xarray', 'netCDF4', 'pyyaml']
+
+# dask: lazily loaded attributes (CHUNKS in IO.yml, tiled run), zarr: zarr output (write from multiple workers)
+EXTRAS_REQUIRE = {'dask': ['dask'], 'zarr': ['zarr', 'dask'], 'test': ['pytest']}
+
 description = ("Python version Multi-scale Parameter Regionalization")
 setup(
     name="mpr",
@@ -29,7 +34,10 @@ setup(
     url="https://github.com/NCAR/mpr-python",
     py_modules=['mpr'],
     packages=find_packages(),
+    entry_points={'console_scripts': ['mpr = mpr.cli:main']},
     python_requires=PYTHON_REQUIRES,
+    install_requires=INSTALL_REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
     license="Apache",
     keywords="hydrologic model, parameter estimation",
 )
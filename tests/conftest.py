@@ -0,0 +1,88 @@
+# Shared fixtures of mpr tests: synthetic attributes and mapping data (see benchmarks/synthetic.py)
+# with config in config/ directory
+#
+# mapping data has HRUs without overlap (empty_fraction), so that source grid cells referenced
+# in mapping data are part of the domain
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from synthetic import make_attributes, make_mapping
+from mpr.IO import load_geophysical_attributes, load_mapping_data
+from mpr.scaling import comp_remap_operator
+from mpr.model_layer import comp_layer_weight
+
+CONFIG_DIR = os.path.join(ROOT, 'config')
+NY, NX, NHRU = 36, 48, 120
+MODEL_THICKNESS = [0.1, 0.3, 0.6]
+MAPPING_VARS = ['polyid', 'overlaps', 'weight', 'i_index', 'j_index']
+
+
+def load_config(name):
+    with open(os.path.join(CONFIG_DIR, name)) as f:
+        return yaml.safe_load(f)
+
+
+@pytest.fixture(scope='session')
+def cfg():
+    return load_config('param_meta.yml')
+
+
+@pytest.fixture(scope='session')
+def param_meta(cfg):
+    return cfg['param']
+
+
+@pytest.fixture(scope='session')
+def tf_coef():
+    return load_config('tf_coef.yml')
+
+
+@pytest.fixture(scope='session')
+def io_cfg(tmp_path_factory):
+    io_cfg = load_config('IO.yml')
+    dire = str(tmp_path_factory.mktemp('synthetic'))
+    io_cfg['INPUT'] = {'DIRE': dire, 'MAP_FILE': 'spatialweights.nc'}
+    io_cfg['OUTPUT'] = {'DIRE': dire, 'PARAM_FILE_NAME': 'param.nc'}
+    io_cfg.pop('CACHE', None)
+
+    make_attributes(dire, io_cfg, NY, NX, seed=0)
+    make_mapping(os.path.join(dire, 'spatialweights.nc'), io_cfg, NY, NX, NHRU, empty_fraction=0.2, seed=0)
+    return io_cfg
+
+
+@pytest.fixture(scope='session')
+def attr_data(io_cfg, param_meta):
+    return load_geophysical_attributes(io_cfg, param_meta=param_meta).load()
+
+
+@pytest.fixture(scope='session')
+def mapping_data(io_cfg):
+    return load_mapping_data(io_cfg, var_list=MAPPING_VARS)
+
+
+@pytest.fixture(scope='session')
+def remap_op(mapping_data):
+    return comp_remap_operator(mapping_data, (NY, NX))
+
+
+@pytest.fixture(scope='session')
+def layer_op(cfg):
+    return comp_layer_weight(cfg['layer_thickness']['soil'], MODEL_THICKNESS)
+
+
+def assert_params_equal(actual, desired, par_list=None):
+    '''
+    Assert parameters (dictionary {parameter name: array}) are identical, including missing values
+    '''
+    par_list = list(desired) if par_list is None else par_list
+    assert par_list
+    for par in par_list:
+        np.testing.assert_array_equal(np.asarray(actual[par]), np.asarray(desired[par]), err_msg=par)
@@ -0,0 +1,69 @@
+import os
+import time
+
+import numpy as np
+
+from mpr import cache
+from mpr.IO import load_mapping_data
+
+from tests.conftest import MAPPING_VARS
+
+
+def test_key(io_cfg, tmp_path):
+    map_file = tmp_path/'map.nc'
+    map_file.write_bytes(b'mapping')
+    key = cache.mapping_cache_key(map_file, io_cfg, var_list=['weight', 'polyid'], compact=True)
+
+    assert cache.mapping_cache_key(map_file, io_cfg, var_list=['polyid', 'weight'], compact=True) == key
+    assert cache.mapping_cache_key(map_file, io_cfg, var_list=['polyid', 'weight'], compact=False) != key
+
+    st = os.stat(map_file)
+    os.utime(map_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    mtime_key = cache.mapping_cache_key(map_file, io_cfg, var_list=['weight', 'polyid'], compact=True)
+    assert mtime_key != key
+
+    map_file.write_bytes(b'mapping data')
+    os.utime(map_file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert cache.mapping_cache_key(map_file, io_cfg, var_list=['weight', 'polyid'], compact=True) not in [key, mtime_key]
+
+
+def test_incomplete_entry_is_rebuilt(io_cfg, tmp_path):
+    cache_dir = str(tmp_path)
+    mapping_data = load_mapping_data(io_cfg, var_list=MAPPING_VARS, cache_dir=cache_dir)
+    (key, meta, size), = cache.list_cache(cache_dir)
+    os.remove(os.path.join(cache_dir, key, 'weight.npy'))
+
+    assert cache.load_cache(cache_dir, key) is None
+    assert cache.list_cache(cache_dir) == []
+
+    rebuilt = load_mapping_data(io_cfg, var_list=MAPPING_VARS, cache_dir=cache_dir)
+    assert os.path.isfile(os.path.join(cache_dir, key, 'weight.npy'))
+    for var, array in mapping_data.items():
+        np.testing.assert_array_equal(rebuilt[var], array)
+
+    cached = load_mapping_data(io_cfg, var_list=MAPPING_VARS, cache_dir=cache_dir)
+    assert isinstance(cached['weight'], np.memmap) and not cached['weight'].flags.writeable
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path)
+    for key in ['a', 'b', 'c']:
+        cache.save_cache(cache_dir, key, {'x': np.arange(10)})
+        time.sleep(0.01)
+    cache.load_cache(cache_dir, 'a')  # a is used after c
+
+    assert cache.evict_cache(cache_dir, max_entries=3) == []
+    assert cache.evict_cache(cache_dir, max_entries=2) == ['b']
+    assert [key for key, meta, size in cache.list_cache(cache_dir)] == ['c', 'a']
+
+    # size of meta.json varies with access time, so limit is set just below total size
+    total = sum(size for key, meta, size in cache.list_cache(cache_dir))
+    assert cache.evict_cache(cache_dir, max_bytes=total - 1) == ['c']
+
+
+def test_max_entries_in_io_cfg(io_cfg, tmp_path):
+    io_cfg = dict(io_cfg, CACHE={'DIRE': str(tmp_path), 'MAX_ENTRIES': 2})
+    for compact, var_list in [(False, MAPPING_VARS), (True, MAPPING_VARS), (True, MAPPING_VARS[:3])]:
+        load_mapping_data(io_cfg, var_list=var_list, compact=compact)
+        time.sleep(0.01)
+    assert len(cache.list_cache(str(tmp_path))) == 2
@@ -0,0 +1,53 @@
+import copy
+
+import numpy as np
+import pytest
+import xarray as xr
+import yaml
+
+from mpr.cli import get_parser, main, parse_size
+from mpr.pipeline import run_mpr
+from mpr.scaling import FILL_VALUE
+
+from tests.conftest import MODEL_THICKNESS
+
+
+def test_parser():
+    assert parse_size('8GB') == 8*1024**3 and parse_size('512mb') == 512*1024**2 and parse_size('1e9') == 10**9
+    args = get_parser().parse_args(['-c', 'cfg', '--memory', '1GB', '--hru', '3', '5', '--precision', 'float64'])
+    assert args.config_dir == 'cfg' and args.memory == 1024**3 and args.hru == [3, 5] and args.workers == 1
+    with pytest.raises(SystemExit):
+        get_parser().parse_args(['--memory', '8XB'])
+
+
+@pytest.fixture(scope='module')
+def config_dir(tmp_path_factory, io_cfg, cfg, tf_coef):
+    # layer dimension of parameters renamed from "lyr" in param_meta.yml
+    cfg = copy.deepcopy(cfg)
+    for meta in cfg['param'].values():
+        meta['dim'] = ['soil_layer' if dim == 'lyr' else dim for dim in meta['dim']]
+    cfg['layer_thickness']['model'] = MODEL_THICKNESS
+
+    dire = tmp_path_factory.mktemp('config')
+    for name, data in [('IO.yml', io_cfg), ('param_meta.yml', cfg), ('tf_coef.yml', tf_coef)]:
+        with open(dire/name, 'w') as f:
+            yaml.safe_dump(data, f)
+    return dire
+
+
+@pytest.mark.parametrize('options', [[], ['--max-cells', '200']])
+def test_cli_run(config_dir, tmp_path, attr_data, mapping_data, param_meta, tf_coef, layer_op, options):
+    output = tmp_path/'param.nc'
+    main(['-c', str(config_dir), '-o', str(output), '--no-cache'] + options)
+
+    expected = run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+    with xr.open_dataset(output) as ds:
+        assert ds['k_soil'].dims == ('soil_layer', 'hru')
+        np.testing.assert_array_equal(ds['hruId'].values, mapping_data['polyid'])
+        for par, array in expected.items():
+            np.testing.assert_array_equal(ds[par].fillna(FILL_VALUE).values, np.nan_to_num(array, nan=FILL_VALUE), err_msg=par)
+
+
+def test_cli_missing_config(tmp_path):
+    with pytest.raises(SystemExit):
+        main(['-c', str(tmp_path)])
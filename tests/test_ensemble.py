@@ -0,0 +1,47 @@
+import copy
+
+import numpy as np
+import pytest
+
+from mpr.ensemble import get_coef_names, get_coef_array, run_ensemble
+from mpr.pipeline import run_mpr
+from mpr.precision import precision_policy
+
+from tests.conftest import assert_params_equal
+
+
+def member_coef(tf_coef, coef_names, coef):
+    member = copy.deepcopy(tf_coef)
+    for (par, k), value in zip(coef_names, coef):
+        member[par][k] = float(value)
+    return member
+
+
+@pytest.fixture(scope='module')
+def coef_array(tf_coef, param_meta):
+    coef_names = get_coef_names(tf_coef, param_meta)
+    base = get_coef_array(tf_coef, coef_names).astype('float64')
+    rng = np.random.default_rng(0)
+    return base * rng.uniform(0.9, 1.1, size=(3, base.size))
+
+
+@pytest.mark.parametrize('storage', ['float32', 'float64'])
+def test_members_equal_run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op, coef_array, storage):
+    # each ensemble member is identical to single run with the same coefficients, in both storage precisions
+    coef_names = get_coef_names(tf_coef, param_meta)
+    with precision_policy(storage=storage):
+        attr = attr_data.astype(storage)
+        ensemble = run_ensemble(attr, mapping_data, param_meta, tf_coef, coef_array, layer_op=layer_op)
+        for m, coef in enumerate(coef_array):
+            # scalar coefficients of run_mpr are rounded to storage precision as in ensemble
+            coef = coef.astype(storage).astype('float64')
+            single = run_mpr(attr, mapping_data, param_meta, member_coef(tf_coef, coef_names, coef), layer_op=layer_op)
+            assert all(ensemble[par].dtype == np.dtype(storage) for par in single)
+            assert_params_equal({par: array[m] for par, array in ensemble.items()}, single)
+
+
+def test_batch_size(attr_data, mapping_data, param_meta, tf_coef, layer_op, coef_array):
+    full = run_ensemble(attr_data, mapping_data, param_meta, tf_coef, coef_array, layer_op=layer_op)
+    batched = run_ensemble(attr_data, mapping_data, param_meta, tf_coef, coef_array, layer_op=layer_op, batch_size=2)
+    assert all(array.shape[0] == len(coef_array) for array in batched.values())
+    assert_params_equal(batched, full)
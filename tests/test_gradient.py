@@ -0,0 +1,49 @@
+import copy
+
+import numpy as np
+import pytest
+
+import mpr.gradient as gradient
+from mpr.gradient import run_mpr_jvp
+from mpr.ensemble import get_coef_names
+from mpr.pipeline import run_mpr
+from mpr.precision import precision_policy
+
+
+def test_jvp_equals_central_difference(attr_data, mapping_data, param_meta, tf_coef, layer_op):
+    coef_names = get_coef_names(tf_coef, param_meta)
+    with precision_policy(storage='float64', accum='float64'):
+        out_data, jvp_data = run_mpr_jvp(attr_data, mapping_data, param_meta, tf_coef, coef_names=coef_names, layer_op=layer_op)
+        base = run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+        assert sorted(out_data) == sorted(base)
+        assert np.any(jvp_data['k_soil'][coef_names.index(('k_soil', 1))] != 0)
+
+        for j, (par, k) in enumerate(coef_names):
+            h = 1e-6*max(abs(tf_coef[par][k]), 1.0)
+            runs = []
+            for sign in [1, -1]:
+                coef = copy.deepcopy(tf_coef)
+                coef[par][k] += sign*h
+                runs.append(run_mpr(attr_data, mapping_data, param_meta, coef, layer_op=layer_op))
+            for name, jvp in jvp_data.items():
+                valid = np.isfinite(base[name]) & (base[name] != -9999.0)
+                fd = (runs[0][name] - runs[1][name])/(2*h)
+                np.testing.assert_allclose(jvp[j][valid], fd[valid], rtol=1e-5, atol=1e-6*np.abs(base[name][valid]).max(),
+                                           err_msg=f'd {name} / d {par}[{k}]')
+
+
+def test_jvp_rejects_unsupported_params(attr_data, mapping_data, param_meta, tf_coef, layer_op):
+    # transfer functions without derivative (e.g., routingGammaScale_tf1) are rejected before computation
+    param_meta = dict(param_meta, routingGammaScale=dict(param_meta['routingGammaScale'], compute=True),
+                      zScale_TOPMODEL=dict(param_meta['zScale_TOPMODEL'], compute=True))
+    with pytest.raises(ValueError, match="routingGammaScale.*zScale_TOPMODEL|zScale_TOPMODEL.*routingGammaScale"):
+        run_mpr_jvp(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+
+
+@pytest.mark.parametrize('stat', ['max', ['amean', 'std']])
+def test_jvp_rejects_unsupported_stats(attr_data, mapping_data, param_meta, tf_coef, layer_op, monkeypatch, stat):
+    # statistics other than generalized means (e.g., max) are rejected before computation
+    param_meta = dict(param_meta, summerLAI=dict(param_meta['summerLAI'], horizontal_stat=stat))
+    monkeypatch.setattr(gradient, 'get_transfer_function', lambda *args, **kwargs: pytest.fail('computed'))
+    with pytest.raises(ValueError, match='summerLAI'):
+        run_mpr_jvp(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from mpr.IO import FILL_VALUE, ParamWriter, write_param, load_subset, load_geophysical_attributes
+from mpr.pipeline import run_mpr, partition_hrus
+from mpr.shared import open_shared_params, unlink_shared_params
+from mpr.transfer_function import DERIVED_ATTR, get_required_attributes
+
+from tests.conftest import MODEL_THICKNESS, NY, NX, assert_params_equal
+
+
+@pytest.fixture(scope='module')
+def param_data(attr_data, mapping_data, param_meta, tf_coef, layer_op):
+    return run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+
+
+def read_params(output, backend):
+    # {parameter name: array}, hru ID, {parameter name: (dims, units)} written by ParamWriter
+    if backend == 'shared':
+        with open_shared_params(output) as params:
+            data = {par: params[par].copy() for par in params.keys()}
+            meta = {par: (var['dims'], var['attrs']['units']) for par, var in params.header['variables'].items()}
+            return data, params.hru.copy(), meta
+    ds = xr.open_zarr(output) if backend == 'zarr' else xr.open_dataset(output)
+    with ds:
+        ds = ds.load()
+    data = {par: ds[par].values for par in ds.data_vars if par != 'hruId'}
+    meta = {par: (list(ds[par].dims), ds[par].attrs['units']) for par in data}
+    return data, ds['hruId'].values, meta
+
+
+@pytest.fixture(params=['netcdf', 'zarr', 'shared'])
+def output(request, tmp_path):
+    if request.param == 'zarr':
+        pytest.importorskip('zarr')
+        pytest.importorskip('dask')
+    name = {'netcdf': tmp_path/'param.nc', 'zarr': tmp_path/'param.zarr',
+            'shared': f'shm://mpr_test_{tmp_path.name}'}[request.param]
+    yield str(name), request.param
+    if request.param == 'shared':
+        unlink_shared_params(str(name))
+
+
+def test_write_param_round_trip(output, param_data, param_meta, cfg, io_cfg, mapping_data):
+    output, backend = output
+    write_param(param_data, param_meta, mapping_data['polyid'], cfg['hru_meta'], io_cfg, output=output)
+
+    data, hru, meta = read_params(output, backend)
+    np.testing.assert_array_equal(hru, mapping_data['polyid'])
+    assert sorted(data) == sorted(param_data)
+    for par, array in param_data.items():
+        # missing values are written as fill value (read as nan with netcdf and zarr decoding)
+        expected = np.where(np.isnan(array), FILL_VALUE, array)
+        actual = np.where(np.isnan(data[par]), FILL_VALUE, data[par])
+        np.testing.assert_array_equal(actual, expected, err_msg=par)
+        assert data[par].dtype == array.dtype
+        assert meta[par] == (param_meta[par]['dim'], param_meta[par]['units'])
+
+
+def test_writer_hru_subsets(output, param_data, param_meta, cfg, mapping_data):
+    output, backend = output
+    nHRU = len(mapping_data['polyid'])
+    tiles = np.array_split(np.random.default_rng(0).permutation(nHRU), 3)
+    par_list = ['k_soil', 'summerLAI']
+    with ParamWriter(output, param_meta, mapping_data['polyid'], cfg['hru_meta'], par_list=par_list,
+                     dim_sizes={'lyr': len(MODEL_THICKNESS)}) as writer:
+        for tile in tiles[:2]:
+            tile = np.sort(tile)
+            for par in par_list:
+                writer.write(par, param_data[par][..., tile], hru_index=tile)
+
+    data, _, _ = read_params(output, backend)
+    written = np.sort(np.concatenate(tiles[:2]))
+    for par in par_list:
+        actual = np.where(np.isnan(data[par]), FILL_VALUE, data[par])
+        np.testing.assert_array_equal(actual[..., written], np.where(np.isnan(param_data[par]), FILL_VALUE,
+                                                                     param_data[par])[..., written])
+        assert np.all(actual[..., np.sort(tiles[2])] == FILL_VALUE)  # not written
+
+
+def test_write_param_par_list(tmp_path, param_data, param_meta, cfg, io_cfg, mapping_data):
+    # parameters with write: False (e.g., norm_prec) are written only if given in par_list
+    assert not param_meta['norm_prec']['write'] and not 'norm_prec' in param_data
+    data = dict(param_data, norm_prec=np.ones(len(mapping_data['polyid']), dtype='float32'))
+
+    write_param(data, param_meta, mapping_data['polyid'], cfg['hru_meta'], io_cfg, output=str(tmp_path/'default.nc'))
+    assert sorted(read_params(str(tmp_path/'default.nc'), 'netcdf')[0]) == sorted(param_data)
+
+    write_param(data, param_meta, mapping_data['polyid'], cfg['hru_meta'], io_cfg, output=str(tmp_path/'norm_prec.nc'),
+                par_list=['norm_prec', 'k_soil'])
+    assert sorted(read_params(str(tmp_path/'norm_prec.nc'), 'netcdf')[0]) == ['k_soil', 'norm_prec']
+
+
+@pytest.mark.parametrize('derived_cache', [False, True])
+def test_subset_equals_full_domain(io_cfg, mapping_data, remap_op, param_meta, tf_coef, layer_op, param_data, derived_cache,
+                                   tmp_path):
+    # domain statistics of subset (e.g., domain mean in norm_prec_tf1) are those of entire domain
+    io_cfg = dict(io_cfg, INPUT=dict(io_cfg['INPUT'], DERIVED_CACHE=str(tmp_path) if derived_cache else None))
+    hru_index = partition_hrus(remap_op, max_cells=200)[0]
+    hru_ids = np.asarray(mapping_data['polyid'])[hru_index]
+
+    sub_attr, sub_mapping = load_subset(io_cfg, hru_ids, param_meta=param_meta)
+    assert sub_attr.sizes['lat'] < NY or sub_attr.sizes['lon'] < NX
+    sub_data = run_mpr(sub_attr.load(), sub_mapping, param_meta, tf_coef, layer_op=layer_op)
+
+    assert sorted(sub_data) == sorted(param_data)
+    assert_params_equal(sub_data, {par: array[..., hru_index] for par, array in param_data.items()})
+
+
+@pytest.mark.parametrize('derived_cache', [False, True])
+def test_derived_attributes_deferred_without_cache(io_cfg, param_meta, derived_cache, tmp_path):
+    # without DERIVED_CACHE, monthly attributes are loaded and derived attributes are computed after gathering
+    io_cfg = dict(io_cfg, INPUT=dict(io_cfg['INPUT'], DERIVED_CACHE=str(tmp_path) if derived_cache else None))
+    attr_data = load_geophysical_attributes(io_cfg, param_meta=param_meta)
+    assert ('prec_annual' in attr_data) == derived_cache
+    assert ('prec' in attr_data) != derived_cache
+    assert 'prec_annual_mean' in attr_data
+
+
+def test_lazy_load_required_attributes(io_cfg, param_meta, attr_data):
+    # only attributes read by transfer functions of computed parameters are loaded, lazily with chunks
+    pytest.importorskip('dask')
+    lazy = load_geophysical_attributes(io_cfg, param_meta=param_meta, chunks={})
+    required = get_required_attributes(param_meta)
+    assert set(lazy.data_vars) <= set(required) | {DERIVED_ATTR[var]['attr'] for var in required if var in DERIVED_ATTR}
+    assert all(lazy[var].chunks is not None for var in lazy.data_vars if lazy[var].ndim > 0)
+    assert_params_equal(lazy.compute(), attr_data, list(lazy.data_vars))
+
+    some = load_geophysical_attributes(io_cfg, var_list=['sand_pct'])
+    assert list(some.data_vars) == ['sand_pct']
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from mpr.model_layer import comp_layer_weight, comp_layer_weight_array
+from mpr.scaling import FILL_VALUE, vertical_weighted_mean
+from mpr.precision import precision_policy
+
+from tests.conftest import NY, NX, MODEL_THICKNESS
+
+
+def test_comp_layer_weight():
+    # model layers within a soil layer, and model layer bottom at soil layer bottom
+    layer_map = comp_layer_weight([0.5, 0.5], [0.2, 0.3, 0.5])
+    np.testing.assert_array_equal(layer_map['overlaps'], [1, 1, 1])
+    np.testing.assert_array_equal(layer_map['soil_index'], [[0], [0], [1]])
+    np.testing.assert_array_equal(layer_map['weight'], [[1.0], [1.0], [1.0]])
+
+    layer_map = comp_layer_weight([0.05, 0.1, 0.15, 0.3, 0.4, 1.0], MODEL_THICKNESS)
+    np.testing.assert_array_equal(layer_map['overlaps'], [2, 3, 2])
+    np.testing.assert_array_equal(layer_map['soil_index'], [[0, 1, 0], [1, 2, 3], [3, 4, 0]])
+    np.testing.assert_allclose(layer_map['weight'], [[1/2, 1/2, 0], [1/6, 1/2, 1/3], [1/3, 2/3, 0]], rtol=1e-6)
+
+
+@pytest.fixture(scope='module')
+def soil_thickness(cfg):
+    # per-cell soil layer thickness [nSlyr, lat, lon] limited by depth to bedrock (0.05 - 2 m)
+    thickness = np.asarray(cfg['layer_thickness']['soil'], dtype='float64')
+    bedrock = np.random.default_rng(0).uniform(0.05, 2.0, size=(NY, NX))
+    top = np.concatenate([[0.0], np.cumsum(thickness)[:-1]])
+    return np.clip(bedrock - top[:, np.newaxis, np.newaxis], 0.0, thickness[:, np.newaxis, np.newaxis])
+
+
+def test_per_cell_weight_sums_to_one(soil_thickness):
+    operator = comp_layer_weight_array(soil_thickness, MODEL_THICKNESS, dtype='float64')
+    assert operator.shape == (len(MODEL_THICKNESS), len(soil_thickness), NY, NX)
+
+    # model layers covered (partially) by soil layers sum to 1, and others have no weight
+    model_top = np.cumsum(MODEL_THICKNESS) - MODEL_THICKNESS
+    covered = model_top[:, np.newaxis, np.newaxis] < soil_thickness.sum(axis=0)
+    np.testing.assert_allclose(operator.sum(axis=1), np.where(covered, 1.0, 0.0), atol=1e-12)
+    assert np.any(~covered) and np.any(covered[-1])
+
+
+def test_per_cell_mean_of_uniform_value(soil_thickness):
+    # generalized mean of a uniform value is the value in model layers partially below bedrock
+    operator = comp_layer_weight_array(soil_thickness, MODEL_THICKNESS)
+    array = np.full(soil_thickness.shape, 0.71)
+    covered = operator.sum(axis=1) > 0
+    for pvalue in [1.0, 0.0, -1.0]:
+        with precision_policy(storage='float64'):
+            result = vertical_weighted_mean(operator, array, pvalue)
+        np.testing.assert_allclose(result[covered], 0.71, rtol=1e-6)
+        assert np.all(result[~covered] == FILL_VALUE)
+
+
+def test_per_cell_equals_1d_for_uniform_depth(cfg, attr_data):
+    soil = np.asarray(cfg['layer_thickness']['soil'])
+    uniform = np.broadcast_to(soil[:, np.newaxis, np.newaxis], (len(soil), NY, NX))
+    operator = comp_layer_weight_array(uniform, MODEL_THICKNESS)
+    operator_1d = comp_layer_weight_array(soil, MODEL_THICKNESS)
+    np.testing.assert_array_equal(operator, np.broadcast_to(operator_1d[..., np.newaxis, np.newaxis], operator.shape))
+
+    array = attr_data['sand_pct'].values
+    for pvalue in [1.0, 0.0, -1.0]:
+        with precision_policy(storage='float64', accum='float64'):
+            np.testing.assert_allclose(vertical_weighted_mean(operator, array, pvalue),
+                                       vertical_weighted_mean(comp_layer_weight(soil, MODEL_THICKNESS), array, pvalue),
+                                       rtol=1e-12)
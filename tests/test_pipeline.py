@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from mpr.IO import load_geophysical_attributes, subset_mapping_data
+from mpr.pipeline import run_mpr, run_mpr_tiled, run_mpr_multi, partition_hrus, gather_attributes
+from mpr.transfer_function import derived_attribute
+from mpr.precision import precision_policy
+
+from tests.conftest import assert_params_equal
+
+
+@pytest.fixture(scope='module')
+def fused(attr_data, mapping_data, param_meta, tf_coef, layer_op):
+    return run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+
+
+def test_fused_equals_full_grid(attr_data, mapping_data, param_meta, tf_coef, layer_op, fused):
+    full = run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op, fused=False)
+    assert sorted(full) == sorted(fused)
+    assert_params_equal(fused, full)
+
+
+def test_domain_statistic_over_full_grid(attr_data, remap_op):
+    # domain mean of norm_prec_tf1 is over the full grid, not over the cells referenced in mapping data
+    gathered = gather_attributes(attr_data, remap_op)
+    prec = np.asarray(derived_attribute(attr_data, 'prec_annual'))
+    np.testing.assert_allclose(float(gathered['prec_annual_mean']), np.nanmean(prec), rtol=1e-6)
+    assert remap_op['cell_index'].size < prec.size
+
+
+def test_kernel_equals_xarray(attr_data, mapping_data, param_meta, tf_coef, layer_op, fused):
+    kernel = run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op, kernel=True)
+    assert_params_equal(kernel, fused)
+
+
+def test_threads_equal_serial(attr_data, mapping_data, param_meta, tf_coef, layer_op, fused):
+    threaded = run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op, workers=4)
+    assert_params_equal(threaded, fused)
+
+
+def test_partition_hrus(remap_op):
+    tiles = partition_hrus(remap_op, max_cells=200)
+    assert len(tiles) > 1
+    assert sorted(hru for tile in tiles for hru in tile) == list(range(remap_op['matrix'].shape[0]))
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_tiled_equals_untiled(io_cfg, mapping_data, param_meta, tf_coef, layer_op, fused, workers):
+    lazy = load_geophysical_attributes(io_cfg, param_meta=param_meta, chunks={})
+    tiled = run_mpr_tiled(lazy, mapping_data, param_meta, tf_coef, layer_op=layer_op, max_cells=200, workers=workers)
+    assert_params_equal(tiled, fused)
+
+
+@pytest.mark.parametrize('tiled', [False, True])
+def test_multi_target_equals_single(attr_data, mapping_data, remap_op, param_meta, tf_coef, layer_op, fused, tiled):
+    # output of a target does not depend on other targets, e.g., domain mean in norm_prec_tf1
+    tiles = partition_hrus(remap_op, max_cells=200)
+    targets = {'west': subset_mapping_data(mapping_data, tiles[0]), 'all': mapping_data}
+    kwargs = {'max_cells': 200} if tiled else {}
+
+    multi = run_mpr_multi(attr_data, targets, param_meta, tf_coef, tiled=tiled, layer_op=layer_op, **kwargs)
+    single = run_mpr(attr_data, targets['west'], param_meta, tf_coef, layer_op=layer_op)
+    assert_params_equal(multi['west'], single)
+    assert_params_equal(multi['all'], fused)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_tiled_equals_untiled_float64(io_cfg, mapping_data, param_meta, tf_coef, layer_op, workers):
+    # bit-identical in float64 storage too. precision policy is passed to worker processes and threads
+    with precision_policy(storage='float64'):
+        lazy = load_geophysical_attributes(io_cfg, param_meta=param_meta, chunks={})
+        fused = run_mpr(lazy.compute(), mapping_data, param_meta, tf_coef, layer_op=layer_op, workers=2)
+        tiled = run_mpr_tiled(lazy, mapping_data, param_meta, tf_coef, layer_op=layer_op, max_cells=200, workers=workers,
+                              threads=2)
+    assert all(array.dtype == np.float64 for array in fused.values())
+    assert_params_equal(tiled, fused)
@@ -0,0 +1,52 @@
+import threading
+
+import numpy as np
+
+from mpr.precision import precision_policy, set_precision, get_dtype, get_policy, validate_precision
+from mpr.scheduler import run_transfer_functions
+
+
+def test_policy_is_local_to_thread():
+    seen = {}
+    entered, release = threading.Event(), threading.Event()
+
+    def _other():
+        with precision_policy(storage='float64'):
+            entered.set()
+            release.wait()
+            seen['other'] = get_dtype()
+
+    thread = threading.Thread(target=_other)
+    thread.start()
+    entered.wait()
+    seen['main'] = get_dtype()
+    release.set()
+    thread.join()
+
+    assert seen == {'main': np.float32, 'other': np.float64}
+    assert get_policy() == {'storage': 'float32', 'accum': 'float64'}
+
+
+def test_policy_restored():
+    with precision_policy(storage='float64', accum='float32'):
+        set_precision(storage='float32')
+        assert get_policy() == {'storage': 'float32', 'accum': 'float32'}
+    assert get_policy() == {'storage': 'float32', 'accum': 'float64'}
+
+
+def test_scheduler_threads_use_caller_policy(attr_data, param_meta, tf_coef):
+    with precision_policy(storage='float64'):
+        out = run_transfer_functions(attr_data, param_meta, tf_coef, workers=4)
+    assert out and all(np.asarray(array).dtype == np.float64 for array in out.values())
+
+
+def test_validate_precision(attr_data, mapping_data, param_meta, tf_coef, layer_op, capsys):
+    report = validate_precision(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+    assert sorted(report) == sorted(par for par, meta in param_meta.items() if meta['compute'] and meta.get('write', True))
+    for par, stat in report.items():
+        assert 0 <= stat['max_rel'] < 1e-5 and stat['nan_mismatch'] == 0, par
+    assert any(stat['max_abs'] > 0 for stat in report.values())
+
+    same = validate_precision(attr_data, mapping_data, param_meta, tf_coef, storage='float64', layer_op=layer_op)
+    assert all(stat == {'max_abs': 0.0, 'max_rel': 0.0, 'nan_mismatch': 0} for stat in same.values())
+    assert not 'Precision' in capsys.readouterr().out  # report is printed by caller
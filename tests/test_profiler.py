@@ -0,0 +1,84 @@
+import csv
+import json
+import threading
+
+import numpy as np
+import pytest
+
+from mpr import profiler
+from mpr.profiler import span, traced
+
+
+@pytest.fixture
+def records():
+    profiler.enable(trace_memory=True)
+    try:
+        with span('outer', param='k_soil'):
+            for k in range(3):
+                with span('inner', index=k) as rec:
+                    rec['extra'] = k*2
+            _double(np.ones((4, 5)))
+        thread = threading.Thread(target=span_in_thread, name='worker')
+        thread.start()
+        thread.join()
+    finally:
+        profiler.disable()
+    return profiler.get_records()
+
+
+def span_in_thread():
+    with span('inner'):
+        pass
+
+
+@traced('double', array_arg=0)
+def _double(array):
+    return np.concatenate([array, array])
+
+
+def test_nested_spans(records):
+    by_name = {}
+    for rec in records:
+        by_name.setdefault(rec['name'], []).append(rec)
+
+    outer = by_name['outer'][0]
+    assert outer['param'] == 'k_soil'
+    assert [rec['path'] for rec in by_name['inner']] == ['outer/inner']*3 + ['inner']  # path is per thread
+    assert [rec.get('extra') for rec in by_name['inner']] == [0, 2, 4, None]
+    assert by_name['inner'][-1]['thread'] == 'worker'
+    assert outer['wall'] >= sum(rec['wall'] for rec in by_name['inner'][:3])
+
+    double = by_name['double'][0]
+    assert double['path'] == 'outer/double'
+    assert double['in_shape'] == [4, 5] and double['shape'] == [8, 5] and double['nbytes'] == 8*5*8
+    assert double['peak'] >= double['nbytes'] and outer['peak'] >= double['peak']
+
+    summary = profiler.summarize(records)
+    assert summary['inner']['count'] == 4 and summary['outer']['count'] == 1
+    assert summary['inner']['wall'] == pytest.approx(sum(rec['wall'] for rec in by_name['inner']))
+    assert summary['outer']['peak'] == outer['peak']
+
+
+def test_disabled():
+    profiler.clear()
+    with span('outer') as rec:
+        assert rec is None
+    assert _double(np.ones(3)).shape == (6,)
+    assert profiler.get_records() == []
+
+
+def test_report_round_trip(records, tmp_path):
+    profiler.write_report(str(tmp_path/'profile.json'), records)
+    with open(tmp_path/'profile.json') as f:
+        report = json.load(f)
+    assert report['records'] == sorted(records, key=lambda rec: rec['start'])
+    assert report['summary'] == profiler.summarize(records)
+
+    profiler.write_report(str(tmp_path/'profile.csv'), records)
+    with open(tmp_path/'profile.csv', newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len(records)
+    for row, rec in zip(rows, report['records']):
+        assert row['name'] == rec['name'] and row['path'] == rec['path']
+        assert float(row['wall']) == rec['wall']
+        assert (json.loads(row['shape']) if row['shape'] else None) == rec.get('shape')
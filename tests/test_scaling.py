@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+from mpr.IO import load_mapping_data
+from mpr.scaling import FILL_VALUE, horizontal_weighted_mean, vertical_weighted_mean, sparse_weighted_stats, gather_cells
+from mpr.model_layer import comp_layer_weight
+from mpr.precision import precision_policy
+
+from tests.conftest import MAPPING_VARS, MODEL_THICKNESS
+
+
+def loop_weighted_mean(mapping_data, array, pvalue, default=FILL_VALUE):
+    # reference: HRU by HRU weighted generalized mean of padded mapping data, weight re-scaled over valid cells
+    array = np.asarray(array, dtype='float64')
+    out = np.full((*array.shape[:-2], len(mapping_data['overlaps'])), default)
+    for k, n in enumerate(mapping_data['overlaps']):
+        vals = array[..., mapping_data['j_index'][k, :n], mapping_data['i_index'][k, :n]]
+        weight = mapping_data['weight'][k, :n].astype('float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.log(vals) if pvalue == 0 else vals**pvalue
+            valid = ~np.isnan(terms)
+            sum_weight = (weight*valid).sum(axis=-1)
+            mean = np.where(valid, terms, 0.0) @ weight / np.where(sum_weight > 0, sum_weight, 1.0)
+            mean = np.exp(mean) if pvalue == 0 else mean**(1.0/pvalue)
+        out[..., k] = np.where(sum_weight > 0, mean, default)
+    return out
+
+
+def loop_vertical_mean(layer_map, array, pvalue, default=FILL_VALUE):
+    # reference: model layer by model layer weighted generalized mean of padded layer mapping data,
+    # nan soil layers are skipped without re-scaling weight
+    array = np.asarray(array, dtype='float64')
+    out = np.full((len(layer_map['overlaps']), *array.shape[1:]), default)
+    for m, n in enumerate(layer_map['overlaps']):
+        if n == 0:
+            continue
+        vals = array[layer_map['soil_index'][m, :n]]
+        weight = layer_map['weight'][m, :n].astype('float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            terms = np.log(vals) if pvalue == 0 else vals**pvalue
+            valid = ~np.isnan(terms)
+            mean = np.tensordot(weight, np.where(valid, terms, 0.0), axes=1)
+            mean = np.exp(mean) if pvalue == 0 else mean**(1.0/pvalue)
+        out[m] = np.where(valid.any(axis=0), mean, np.nan)
+    return out
+
+
+@pytest.fixture(scope='module')
+def grid_array(attr_data):
+    # positive [lyr, lat, lon] with missing values
+    return attr_data['sand_pct'].values
+
+
+@pytest.mark.parametrize('pvalue', [1.0, 0.0, -1.0, 0.5])
+def test_sparse_remap_equals_loop(mapping_data, grid_array, pvalue):
+    with precision_policy(storage='float64', accum='float64'):
+        sparse_result = horizontal_weighted_mean(mapping_data, grid_array, pvalue)
+    np.testing.assert_allclose(sparse_result, loop_weighted_mean(mapping_data, grid_array, pvalue), rtol=1e-12)
+
+    assert np.any(sparse_result == FILL_VALUE)  # HRUs without overlap
+    assert np.any(np.isnan(grid_array))
+
+
+def test_sparse_remap_2d_float32(mapping_data, grid_array):
+    result = horizontal_weighted_mean(mapping_data, grid_array[0], 1.0)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, loop_weighted_mean(mapping_data, grid_array[0], 1.0), rtol=1e-6)
+
+
+def test_compact_mapping_equals_padded(io_cfg, mapping_data, grid_array):
+    compact = load_mapping_data(io_cfg, var_list=MAPPING_VARS, compact=True)
+    assert 'offsets' in compact and compact['weight'].ndim == 1
+    np.testing.assert_array_equal(horizontal_weighted_mean(compact, grid_array, 1.0),
+                                  horizontal_weighted_mean(mapping_data, grid_array, 1.0))
+
+
+def test_stats_pmean_equals_mean(remap_op, grid_array):
+    cells = gather_cells(remap_op, grid_array)
+    stats = sparse_weighted_stats(remap_op['matrix'], cells, ['amean', 'gmean', 'hmean', 'min', 'max'])
+    for k, pvalue in enumerate([1.0, 0.0, -1.0]):
+        np.testing.assert_array_equal(stats[k], horizontal_weighted_mean(None, grid_array, pvalue, remap_op=remap_op))
+    valid = stats[3] != FILL_VALUE
+    assert np.all(stats[3][valid] <= stats[0][valid]) and np.all(stats[0][valid] <= stats[4][valid])
+
+
+@pytest.mark.parametrize('block_size', [None, 7])
+@pytest.mark.parametrize('pvalue', [1.0, 0.0, -1.0])
+def test_vertical_mean_equals_loop(cfg, grid_array, pvalue, block_size):
+    # last model layer is below soil layers (2 m, default value)
+    layer_map = comp_layer_weight(cfg['layer_thickness']['soil'], list(MODEL_THICKNESS) + [1.0, 0.5])
+    array = grid_array.copy()
+    array[1, :2] = np.nan   # nan in some soil layers
+    array[:, 3, :4] = np.nan  # nan in all soil layers
+    kwargs = {} if block_size is None else {'block_size': block_size}
+
+    with precision_policy(storage='float64', accum='float64'):
+        result = vertical_weighted_mean(layer_map, array, pvalue, **kwargs)
+    reference = loop_vertical_mean(layer_map, array, pvalue)
+    np.testing.assert_allclose(result, reference, rtol=1e-12)
+
+    assert np.all(result[-1] == FILL_VALUE)
+    assert np.all(np.isnan(result[:-1, 3, :4]))
+    assert np.all(np.isfinite(result[:-1, :2]) | np.isnan(grid_array[:, :2]).all(axis=0))
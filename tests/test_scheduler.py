@@ -0,0 +1,41 @@
+import pytest
+
+import mpr.scheduler as scheduler
+from mpr.scheduler import build_param_graph, topological_order, run_transfer_functions
+from tests.conftest import assert_params_equal
+
+
+def test_topological_order(param_meta):
+    graph = build_param_graph(param_meta)
+    order = topological_order(graph)
+    assert sorted(order) == sorted(graph)
+    for par, deps in graph.items():
+        assert all(order.index(dep) < order.index(par) for dep in deps)
+
+    with pytest.raises(ValueError):
+        topological_order({'a': ['b'], 'b': ['a']})
+
+
+def test_presupplied_params_released(attr_data, param_meta, tf_coef, monkeypatch):
+    # norm_prec is read by k_soil and k_macropore only. with all of them supplied, norm_prec is not kept
+    full = run_transfer_functions(attr_data, param_meta, tf_coef)
+    graph = build_param_graph(param_meta)
+    native = {par: full[par] for par in ['k_soil', 'k_macropore']}
+    native['norm_prec'] = full['k_soil']  # not read
+
+    seen = []
+    get_transfer_function = scheduler.get_transfer_function
+
+    def _spy(tf_name, **kwargs):
+        tf = get_transfer_function(tf_name, **kwargs)
+        def _tf(param_data, **args):
+            seen.append(set(param_data))
+            return tf(param_data=param_data, **args)
+        return _tf
+
+    monkeypatch.setattr(scheduler, 'get_transfer_function', _spy)
+    out = run_transfer_functions(attr_data, param_meta, tf_coef, param_data=native)
+
+    assert seen and all(not 'norm_prec' in keys for keys in seen)
+    assert sorted(out) == sorted(par for par in full if not par in native and par in graph)
+    assert_params_equal(out, full, par_list=list(out))
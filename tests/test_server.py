@@ -0,0 +1,76 @@
+import os
+import json
+import socket
+import threading
+
+import pytest
+
+from mpr.session import MPRSession
+from mpr.server import MPRServer, MPRClient, _pack
+
+from tests.conftest import assert_params_equal
+
+
+@pytest.fixture(scope='module')
+def server(attr_data, mapping_data, param_meta, tf_coef, layer_op, cfg, io_cfg, tmp_path_factory):
+    out_dir = str(tmp_path_factory.mktemp('server'))
+    io_cfg = dict(io_cfg, OUTPUT=dict(io_cfg['OUTPUT'], DIRE=out_dir))
+    session = MPRSession(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+    server = MPRServer(session, hru_data=mapping_data['polyid'], hru_meta=cfg['hru_meta'], io_cfg=io_cfg)
+
+    ready = threading.Event()
+    address = []
+    thread = threading.Thread(target=server.serve, kwargs={'ready': lambda addr: (address.append(addr), ready.set())})
+    thread.start()
+    assert ready.wait(30)
+    yield address[0], out_dir, session
+
+    with MPRClient(*address[0]) as client:
+        client.shutdown()
+    thread.join(30)
+
+
+def raw_request(sock, payload):
+    # send payload and return json header of response
+    sock.sendall(_pack(payload))
+    header = json.loads(_recv(sock))
+    _recv(sock)
+    return header
+
+
+def _recv(sock):
+    size = int.from_bytes(_recv_exact(sock, 8), 'big')
+    return _recv_exact(sock, size)
+
+
+def _recv_exact(sock, size):
+    buf = b''
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        assert chunk
+        buf += chunk
+    return buf
+
+
+def test_invalid_requests(server):
+    address, out_dir, session = server
+    with socket.create_connection(address, timeout=30) as sock:
+        for payload in [b'[]', b'"run"', b'{not json', b'{"cmd": 1}', b'{"coef": []}', b'\xff']:
+            header = raw_request(sock, payload)
+            assert header['status'] == 'error', payload
+        # connection is kept after invalid requests
+        assert raw_request(sock, b'{"cmd": "ping"}')['status'] == 'ok'
+
+
+def test_output_in_output_dire(server, tmp_path):
+    address, out_dir, session = server
+    with MPRClient(*address, timeout=30) as client:
+        for output in [str(tmp_path/'param.nc'), '../param.nc', '.']:
+            with pytest.raises(RuntimeError, match='OUTPUT DIRE'):
+                client.run(output=output)
+        assert not os.path.exists(tmp_path/'param.nc')
+
+        path = client.run(params=['k_soil'], output='param.nc')
+        assert path == os.path.join(os.path.realpath(out_dir), 'param.nc') and os.path.isfile(path)
+
+        assert_params_equal(client.run(params=['k_soil']), session.run(session.tf_coef), ['k_soil'])
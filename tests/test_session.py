@@ -0,0 +1,66 @@
+import copy
+
+import numpy as np
+import pytest
+
+from mpr.session import MPRSession
+from mpr.pipeline import run_mpr
+from mpr.precision import precision_policy
+
+from tests.conftest import assert_params_equal
+
+
+@pytest.fixture
+def session(attr_data, mapping_data, param_meta, tf_coef, layer_op):
+    return MPRSession(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op)
+
+
+def computed_params(session, run):
+    # names of parameters computed (cache miss) in run()
+    before = set(session.cache)
+    run()
+    return {key[0] for key in session.cache if not key in before}
+
+
+def test_session_equals_run_mpr(session, attr_data, mapping_data, param_meta, tf_coef, layer_op):
+    param_data = session.run()
+    assert_params_equal(param_data, run_mpr(attr_data, mapping_data, param_meta, tf_coef, layer_op=layer_op))
+    assert all(not array.flags.writeable for array in param_data.values())
+    with pytest.raises(ValueError):
+        param_data['k_soil'][...] = 0.0
+
+
+def test_incremental_invalidation(session, attr_data, mapping_data, param_meta, tf_coef, layer_op):
+    # changing coefficients of k_soil recomputes only k_soil and its downstream parameter
+    session.run()
+    coef = copy.deepcopy(tf_coef)
+    coef['k_soil'] = [1.2, -1.0]
+    assert computed_params(session, lambda: session.run(coef)) == {'k_soil', 'aquiferBaseflowRate'}
+    assert_params_equal(session.run(coef), run_mpr(attr_data, mapping_data, param_meta, coef, layer_op=layer_op))
+    assert computed_params(session, session.run) == set()
+
+    # precision policy and attributes are part of cache key
+    with precision_policy(storage='float64'):
+        assert computed_params(session, session.run) == set(session.graph)
+        assert all(array.dtype == np.float64 for array in session.run().values())
+    session.attr_data = session.attr_data.copy()
+    assert computed_params(session, session.run) == set(session.graph)
+
+
+def test_evict_least_recently_used(session):
+    session.run()
+    total = session.nbytes
+    assert session.stats['evict'] == 0
+
+    session.clear()
+    session.max_bytes = total // 2
+    param_data = session.run()
+    assert 0 < session.nbytes <= session.max_bytes
+    assert session.stats['evict'] > 0
+    # the most recently used parameters are kept
+    assert list(session.cache)[-1][0] == session.order[-1]
+
+    # evicted parameters are recomputed with the same values
+    hit = session.stats['hit']
+    assert_params_equal(session.run(), param_data)
+    assert session.stats['hit'] - hit < len(param_data)
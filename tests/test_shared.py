@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from mpr.IO import ParamWriter
+from mpr.shared import open_shared_params, unlink_shared_params
+
+PARAM_META = {'k_soil': {'compute': True, 'write': True, 'dim': ['lyr', 'hru'], 'long_name': 'hydraulic conductivity',
+                         'units': 'm s-1'}}
+HRU_META = {'name': 'hruId', 'dim': 'hru'}
+
+
+@pytest.fixture(params=['shm', 'mpr'])
+def source(request, tmp_path):
+    source = f'shm://mpr_test_shared_{tmp_path.name}' if request.param == 'shm' else str(tmp_path/'param.mpr')
+    yield source
+    unlink_shared_params(source)
+
+
+def publish(source, values, create=True):
+    kwargs = {'param_meta': PARAM_META, 'hru_data': np.arange(values.shape[-1]), 'hru_meta': HRU_META,
+              'dim_sizes': {'lyr': values.shape[0]}} if create else {}
+    with ParamWriter(source, create=create, **kwargs) as writer:
+        writer.write('k_soil', values)
+
+
+def test_close_with_arrays_referenced(source):
+    values = np.arange(12, dtype='float32').reshape(3, 4)
+    publish(source, values)
+
+    params = open_shared_params(source)
+    k_soil = params['k_soil']
+    with pytest.raises(BufferError):
+        params.close()
+    # still open and readable, no access to unmapped memory
+    np.testing.assert_array_equal(k_soil, values)
+    np.testing.assert_array_equal(params['k_soil'], values)
+    assert not k_soil.flags.writeable
+
+    copied = k_soil.copy()
+    del k_soil
+    params.close()
+    params.close()
+    np.testing.assert_array_equal(copied, values)
+    with pytest.raises(KeyError):
+        params['k_soil']
+
+
+def test_republish(source):
+    values = np.arange(12, dtype='float32').reshape(3, 4)
+    publish(source, values)
+    with open_shared_params(source) as params:
+        seq = params.sequence
+        assert seq % 2 == 0
+
+    publish(source, values*2, create=False)
+    with open_shared_params(source) as params:
+        assert params.sequence == seq + 2
+        np.testing.assert_array_equal(params['k_soil'], values*2)
+        np.testing.assert_array_equal(params.hru, np.arange(4))
@@ -0,0 +1,39 @@
+import re
+import inspect
+
+import pytest
+
+from mpr.transfer_function import TF_INPUTS, transfer_function, get_tf_inputs, get_required_attributes
+
+
+def source_inputs(tf_name):
+    # attributes and parameters read in source code of transfer function, attr_data['xxx'],
+    # derived_attribute(attr_data, 'xxx'), domain_statistic(attr_data, 'xxx') and param_data['xxx']
+    src = re.sub(r'#.*', '', inspect.getsource(getattr(transfer_function, tf_name)))
+    inputs = {}
+    for key, arg in zip(['attr', 'param'], ['attr_data', 'param_data']):
+        names = re.findall(arg + r"\[['\"](\w+)['\"]\]|(?:derived_attribute|domain_statistic)\(\s*" + arg + r"\s*,\s*['\"](\w+)['\"]", src)
+        inputs[key] = sorted(set(name or derived for name, derived in names))
+    return inputs
+
+
+TF_NAMES = [name for name in vars(transfer_function) if not name.startswith('_')]
+
+
+@pytest.mark.parametrize('tf_name', TF_NAMES)
+def test_tf_inputs_match_source(tf_name):
+    # consistency check of TF_INPUTS table against source code
+    declared = get_tf_inputs(tf_name)
+    assert {key: sorted(names) for key, names in declared.items()} == source_inputs(tf_name)
+
+
+def test_tf_inputs_declared():
+    assert sorted(TF_INPUTS) == sorted(TF_NAMES)
+    with pytest.raises(ValueError):
+        get_tf_inputs('unknown_tf')
+
+
+def test_required_attributes(param_meta):
+    attr_list = get_required_attributes(param_meta)
+    assert 'prec_annual' in attr_list and 'sand_pct' in attr_list
+    assert len(attr_list) == len(set(attr_list))